@@ -16,11 +16,131 @@ def _rate_limit_key():
     return get_remote_address()
 
 
-limiter = Limiter(key_func=_rate_limit_key, default_limits=["30 per minute"], storage_uri="memory://")
+# Storage được chọn trong create_app() qua RATE_LIMIT_STORAGE_URI (mặc định memory://)
+limiter = Limiter(key_func=_rate_limit_key, default_limits=["30 per minute"])
+
+
+def _register_cli_commands(app: Flask) -> None:
+    """Đăng ký các maintenance job (chạy qua: flask --app run <command>)"""
+    import click
+
+    @app.cli.command("archive-logs")
+    @click.option("--older-than-days", type=int, default=None, help="Mặc định: LOG_ARCHIVE_AFTER_DAYS (90)")
+    @click.option("--batch-size", type=int, default=5000)
+    def archive_logs_command(older_than_days, batch_size):
+        """Chuyển request_logs cũ sang archive nén và xóa khỏi bảng hot"""
+        from services.log_archive_service import archive_request_logs
+        result = archive_request_logs(older_than_days=older_than_days, batch_size=batch_size)
+        click.echo(
+            f"archived_rows={result['archived_rows']} | batches={result['batches']} | "
+            f"days={','.join(result['days']) or '-'}"
+        )
+
+    @app.cli.command("calibrate-bcrypt")
+    @click.option("--target-ms", type=float, default=250.0, help="Thời gian verify mong muốn (ms)")
+    def calibrate_bcrypt_command(target_ms):
+        """Đo bcrypt trên máy hiện tại và gợi ý BCRYPT_ROUNDS"""
+        from services.password_hasher import calibrate, get_rounds
+        result = calibrate(target_ms=target_ms)
+        for rounds, elapsed_ms in result["timings_ms"].items():
+            click.echo(f"rounds={rounds} | verify_ms={elapsed_ms}")
+        click.echo(f"BCRYPT_ROUNDS={result['rounds']} (hiện tại: {get_rounds()})")
+
+    @app.cli.command("invalidate-cache")
+    @click.argument("scope")
+    @click.argument("entity_ids", nargs=-1)
+    def invalidate_cache_command(scope, entity_ids):
+        """Evict cache của mọi worker (vd: invalidate-cache province current_34)"""
+        from services import change_log
+        from services.api_key_service import _get_db_connection
+        conn = _get_db_connection()
+        try:
+            with conn.cursor() as cursor:
+                change_log.publish(cursor, scope, entity_ids or (None,))
+            conn.commit()
+        finally:
+            conn.close()
+        click.echo(f"scope={scope} | entities={','.join(entity_ids) or '*'}")
+
+    @app.cli.command("prune-change-log")
+    @click.option("--older-than-hours", type=float, default=None, help="Mặc định: CHANGE_LOG_RETENTION_HOURS (24)")
+    def prune_change_log_command(older_than_hours):
+        """Xóa các row cũ trong cache_invalidations"""
+        import os
+        from services import change_log
+        if older_than_hours is None:
+            older_than_hours = float(os.getenv("CHANGE_LOG_RETENTION_HOURS", "24"))
+        click.echo(f"deleted_rows={change_log.prune(older_than_hours)}")
+
+    @app.cli.command("drain-email-outbox")
+    @click.option("--prune-days", type=float, default=None, help="Xóa email đã gửi cũ hơn N ngày")
+    def drain_email_outbox_command(prune_days):
+        """Gửi ngay các email đến hạn trong email_outbox (1 SMTP session)"""
+        from services import email_outbox
+        from services.email_service import SMTPSession
+        with SMTPSession() as session:
+            click.echo(f"sent={email_outbox.drain(session)}")
+        if prune_days is not None:
+            click.echo(f"deleted_rows={email_outbox.prune(prune_days)}")
+
+    @app.cli.command("send-key-expiry-warnings")
+    def send_key_expiry_warnings_command():
+        """Gửi cảnh báo key sắp hết hạn (gom theo người nhận, 1 SMTP session) - chạy bằng cron"""
+        from services import key_expiry_warnings
+        if not key_expiry_warnings.is_enabled():
+            raise click.ClickException("Thiếu bảng key_expiry_notifications (DDL trong services/key_expiry_warnings.py)")
+        result = key_expiry_warnings.run()
+        click.echo(f"recipients={result['recipients']} | keys={result['keys']} | failed={result['failed']}")
+
+    @app.cli.command("sweep-expired")
+    def sweep_expired_command():
+        """Expire ngay các subscription/key đã quá expires_at"""
+        from services import expiry_sweeper
+        result = expiry_sweeper.run_once()
+        if result is None:
+            raise click.ClickException("Đang có process khác quét (GET_LOCK), thử lại sau")
+        click.echo(f"subscriptions={result['subscriptions']} | keys={result['keys']}")
+
+    @app.cli.command("rebuild-admin-stats")
+    def rebuild_admin_stats_command():
+        """Tính lại api_key_tier_counters từ api_keys (seed lần đầu / sau khi sửa dữ liệu bằng tay)"""
+        from services.admin_stats import rebuild_key_counters
+        for tier, counts in sorted(rebuild_key_counters().items()):
+            click.echo(f"tier={tier} | total={counts['total']} | active={counts['active']}")
+
+
+class _App(Flask):
+    """
+    Flask app trả 504 khi request hết deadline
+
+    DeadlineExceeded kế thừa BaseException (không bị các khối `except Exception` nuốt),
+    Flask chỉ chuyển Exception thành response nên bắt riêng ở đây, một chỗ duy nhất.
+    """
+
+    def full_dispatch_request(self):
+        from services.deadline import DeadlineExceeded
+
+        try:
+            return super().full_dispatch_request()
+        except DeadlineExceeded:
+            # Request hết deadline: bỏ dở thay vì làm tiếp khi client đã bỏ đi
+            req_id = g.get("request_id", "-")
+            self.logger.warning(f"deadline_exceeded | request_id={req_id} | path={request.path}")
+            response = jsonify(
+                {
+                    "success": False,
+                    "is_valid_format": False,
+                    "data": None,
+                    "message": "Request vượt quá thời gian xử lý cho phép. Vui lòng thử lại.",
+                    "request_id": req_id,
+                }
+            )
+            response.status_code = 504
+            return self.finalize_request(response)
 
 
 def create_app() -> Flask:
-    app = Flask(__name__)
+    app = _App(__name__)
     
     # Session configuration for user authentication
     import os
@@ -53,6 +173,13 @@ def create_app() -> Flask:
     settings = Settings.from_env()
     app.config["SETTINGS"] = settings
 
+    # memory:// → counter riêng từng worker; shm:// → dùng chung giữa các worker trên node
+    from services import rate_limit_storage  # đăng ký scheme shm:// (nếu platform hỗ trợ)
+    storage_uri = os.getenv("RATE_LIMIT_STORAGE_URI", "memory://")
+    if storage_uri.startswith("shm://") and not rate_limit_storage.IS_SUPPORTED:
+        app.logger.warning("RATE_LIMIT_STORAGE_URI=shm:// cần mmap/fcntl (không có trên platform này) → dùng memory://")
+        storage_uri = "memory://"
+    app.config["RATELIMIT_STORAGE_URI"] = storage_uri
     limiter.init_app(app)
 
     # Generate request_id for each request (for tracing)
@@ -60,6 +187,12 @@ def create_app() -> Flask:
     def assign_request_id():
         g.request_id = request.headers.get("X-Request-ID") or str(uuid.uuid4())[:8]
 
+    # Deadline cho request: timeout theo endpoint, client có thể rút ngắn qua X-Request-Timeout
+    @app.before_request
+    def assign_request_deadline():
+        from services import deadline
+        deadline.start(request.endpoint, request.headers.get("X-Request-Timeout"))
+
     # Remove Server header to prevent information disclosure
     # Note: Werkzeug development server adds Server header AFTER after_request runs
     # This means we cannot fully remove it in dev mode
@@ -96,6 +229,10 @@ def create_app() -> Flask:
     @app.errorhandler(429)
     def ratelimit_handler(e):
         app.logger.warning(f"rate_limited | request_id={g.get('request_id', '-')} | {e.description}")
+        headers = {}
+        retry_after = getattr(e, "retry_after", None)
+        if retry_after is not None:
+            headers["Retry-After"] = str(retry_after)
         return (
             jsonify(
                 {
@@ -106,6 +243,7 @@ def create_app() -> Flask:
                 }
             ),
             429,
+            headers,
         )
 
     # Custom 404 handler: return HTML page for web requests, JSON for API requests
@@ -219,6 +357,42 @@ def create_app() -> Flask:
         from routes.admin import admin_bp
         app.register_blueprint(admin_bp)
 
+        # Probe schema 1 lần khi khởi động - services dùng cache này thay vì INFORMATION_SCHEMA mỗi request
+        from services import schema_registry
+        schema_registry.refresh()
+
+        # Snapshot key active trong RAM (cần cột api_keys.updated_at) - validate key không tra DB
+        from services import key_snapshot
+        key_snapshot.start()
+
+        # Bus invalidate cache giữa các worker/node (bảng cache_invalidations)
+        from services import change_log
+        from services.province_mapping import clear_cache
+
+        def evict_province_cache(versions):
+            for version in ([None] if None in versions else versions):
+                clear_cache(version)
+
+        change_log.subscribe("province", evict_province_cache)
+        change_log.start()
+
+        # Worker gửi email từ outbox (bảng email_outbox) - kể cả email còn tồn từ lần chạy trước
+        from services import email_outbox
+        email_outbox.start()
+
+        # Chuyển subscription/key hết hạn sang trạng thái hết hạn (1 process quét nhờ GET_LOCK)
+        from services import expiry_sweeper
+        expiry_sweeper.start()
+
+        # gunicorn --preload: worker sau fork không có thread nền của process cha
+        @app.before_request
+        def start_background_workers():
+            change_log.start()
+            email_outbox.start()
+            expiry_sweeper.start()
+
+    _register_cli_commands(app)
+
     return app
 
 
@@ -589,6 +589,8 @@ function showMessage(message, type) {
 
 let currentUsersPage = 1;
 let currentUserSearch = '';
+// Keyset pagination: userPageCursors[i] = cursor của trang i + 1 (trang 1 không có cursor)
+let userPageCursors = [null];
 
 async function loadUsersList(page = 1) {
   const adminKey = document.getElementById('adminKey')?.value.trim() || '';
@@ -602,11 +604,18 @@ async function loadUsersList(page = 1) {
   }
   
   const search = document.getElementById('userSearchInput')?.value.trim() || '';
+  if (page === 1 || search !== currentUserSearch || userPageCursors[page - 1] === undefined) {
+    page = 1;
+    userPageCursors = [null];
+  }
   currentUsersPage = page;
   currentUserSearch = search;
   
   try {
-    let url = `/admin/users?page=${page}&per_page=20`;
+    let url = `/admin/users?per_page=20`;
+    if (userPageCursors[page - 1]) {
+      url += `&cursor=${encodeURIComponent(userPageCursors[page - 1])}`;
+    }
     if (search) {
       url += `&search=${encodeURIComponent(search)}`;
     }
@@ -632,6 +641,7 @@ async function loadUsersList(page = 1) {
     const data = await resp.json();
     const users = data.users || [];
     const pagination = data.pagination || {};
+    userPageCursors[page] = pagination.next_cursor || undefined;
     
     if (users.length === 0) {
       usersContainer.innerHTML = 
@@ -680,37 +690,19 @@ async function loadUsersList(page = 1) {
     
     html += '</tbody></table></div>';
     
-    // Add pagination
-    if (pagination.total_pages > 1) {
-      html += '<div class="px-6 py-4 border-t border-glass-border flex justify-between items-center bg-surface-dark/30"><span class="text-xs text-slate-400">Trang ' + pagination.page + '/' + pagination.total_pages + ' - Tổng: ' + pagination.total + ' users</span><div class="flex gap-1">';
-      
-      if (pagination.page > 1) {
-        html += `<button class="px-2 py-1 rounded border border-slate-700 text-slate-400 hover:text-white hover:border-slate-500" onclick="loadUsersList(${pagination.page - 1})"><span class="material-symbols-outlined text-sm">chevron_left</span></button>`;
-      }
-      
-      const startPage = Math.max(1, pagination.page - 2);
-      const endPage = Math.min(pagination.total_pages, pagination.page + 2);
+    // Add pagination (keyset: chỉ có trang trước/sau)
+    if (page > 1 || pagination.has_more) {
+      const totalLabel = (pagination.total_is_estimate ? '~' : '') + pagination.total;
+      html += '<div class="px-6 py-4 border-t border-glass-border flex justify-between items-center bg-surface-dark/30"><span class="text-xs text-slate-400">Trang ' + page + ' - Tổng: ' + totalLabel + ' users</span><div class="flex gap-1">';
       
-      if (startPage > 1) {
-        html += `<button class="px-3 py-1 rounded border border-slate-700 text-slate-400 hover:text-white hover:border-slate-500 text-xs" onclick="loadUsersList(1)">1</button>`;
-        if (startPage > 2) html += '<span class="px-2 text-slate-500">...</span>';
+      if (page > 1) {
+        html += `<button class="px-2 py-1 rounded border border-slate-700 text-slate-400 hover:text-white hover:border-slate-500" onclick="loadUsersList(${page - 1})"><span class="material-symbols-outlined text-sm">chevron_left</span></button>`;
       }
       
-      for (let i = startPage; i <= endPage; i++) {
-        if (i === pagination.page) {
-          html += `<button class="px-3 py-1 rounded bg-primary text-white text-xs font-bold">${i}</button>`;
-        } else {
-          html += `<button class="px-3 py-1 rounded border border-slate-700 text-slate-400 hover:text-white hover:border-slate-500 text-xs" onclick="loadUsersList(${i})">${i}</button>`;
-        }
-      }
-      
-      if (endPage < pagination.total_pages) {
-        if (endPage < pagination.total_pages - 1) html += '<span class="px-2 text-slate-500">...</span>';
-        html += `<button class="px-3 py-1 rounded border border-slate-700 text-slate-400 hover:text-white hover:border-slate-500 text-xs" onclick="loadUsersList(${pagination.total_pages})">${pagination.total_pages}</button>`;
-      }
+      html += `<button class="px-3 py-1 rounded bg-primary text-white text-xs font-bold">${page}</button>`;
       
-      if (pagination.page < pagination.total_pages) {
-        html += `<button class="px-2 py-1 rounded border border-slate-700 text-slate-400 hover:text-white hover:border-slate-500" onclick="loadUsersList(${pagination.page + 1})"><span class="material-symbols-outlined text-sm">chevron_right</span></button>`;
+      if (pagination.has_more) {
+        html += `<button class="px-2 py-1 rounded border border-slate-700 text-slate-400 hover:text-white hover:border-slate-500" onclick="loadUsersList(${page + 1})"><span class="material-symbols-outlined text-sm">chevron_right</span></button>`;
       }
       
       html += '</div></div>';
@@ -14,8 +14,10 @@ from app import limiter
 from services.admin_security import (
     get_failed_attempts_count,
     get_security_stats,
+    get_tarpit_remaining,
     is_ip_blocked,
     record_failed_attempt,
+    start_tarpit,
 )
 
 admin_bp = Blueprint("admin", __name__, url_prefix="/admin")
@@ -120,6 +122,27 @@ def _get_request_id() -> str:
     return g.get("request_id", "-")
 
 
+def _tarpit_response(retry_after: float):
+    """429 + Retry-After cho IP đang trong tarpit"""
+    seconds = max(1, int(retry_after + 0.999))
+    response = jsonify({
+        "error": f"Thử lại sau {seconds} giây.",
+        "remaining_seconds": seconds,
+    })
+    response.status_code = 429
+    response.headers["Retry-After"] = str(seconds)
+    return response
+
+
+@admin_bp.after_request
+def add_tarpit_retry_after(response):
+    """Admin key sai → báo client chờ bao lâu (Retry-After) trước lần thử kế tiếp"""
+    retry_after = g.get("admin_retry_after")
+    if retry_after and "Retry-After" not in response.headers:
+        response.headers["Retry-After"] = str(max(1, int(retry_after + 0.999)))
+    return response
+
+
 @admin_bp.before_request
 def check_admin_auth():
     """
@@ -141,6 +164,17 @@ def check_admin_auth():
         # Đã đăng nhập qua session → cho phép
         return None
     
+    # Lấy IP address của request
+    ip_address = get_remote_address()
+    
+    # ===== TARPIT =====
+    # IP vừa thử sai còn trong thời gian chờ → lần thử key kế tiếp bị từ chối ngay, trước khi so key
+    # (không sleep trong request thread, thử dồn dập cũng không nhanh hơn backoff)
+    if request.headers.get("X-Admin-Key"):
+        retry_after = get_tarpit_remaining(ip_address)
+        if retry_after > 0:
+            return _tarpit_response(retry_after)
+    
     # ===== FALLBACK: HEADER-BASED AUTH (cho API calls) =====
     admin_secret = os.getenv("ADMIN_SECRET")
     if admin_secret:
@@ -150,8 +184,6 @@ def check_admin_auth():
             return None
     
     # ===== CHỐNG BRUTE FORCE =====
-    # Lấy IP address của request
-    ip_address = get_remote_address()
     
     # Kiểm tra xem IP có bị block không
     is_blocked, unblock_time = is_ip_blocked(ip_address)
@@ -189,9 +221,9 @@ def check_admin_auth():
                 f"failed_count={failed_count}"
             )
             
-            # Delay để làm chậm brute force (exponential backoff)
-            delay_seconds = min(0.1 * (2 ** (failed_count - 1)), 2.0)
-            time.sleep(delay_seconds)
+            # Làm chậm brute force (exponential backoff) mà không sleep trong request thread:
+            # response trả ngay kèm Retry-After, request tới trước thời hạn đó bị 429 ở bước TARPIT
+            g.admin_retry_after = start_tarpit(ip_address, failed_count)
             
             # Kiểm tra lại xem có bị block sau khi record attempt không
             is_blocked, unblock_time = is_ip_blocked(ip_address)
@@ -215,63 +247,6 @@ def check_admin_auth():
     
     # API request → 403
     return jsonify({"error": "Unauthorized - Vui lòng đăng nhập hoặc cung cấp admin key hợp lệ"}), 403
-    
-    # ===== CHỐNG BRUTE FORCE =====
-    # Lấy IP address của request
-    ip_address = get_remote_address()
-    
-    # Kiểm tra xem IP có bị block không
-    is_blocked, unblock_time = is_ip_blocked(ip_address)
-    if is_blocked:
-        remaining_seconds = int(unblock_time - time.time())
-        current_app.logger.warning(
-            f"admin_blocked_ip | request_id={_get_request_id()} | "
-            f"ip={ip_address} | endpoint={request.endpoint} | "
-            f"unblock_in={remaining_seconds}s"
-        )
-        return jsonify({
-            "error": f"IP bị tạm khóa do quá nhiều lần thử sai. Vui lòng thử lại sau {remaining_seconds} giây.",
-            "blocked_until": int(unblock_time),
-            "remaining_seconds": remaining_seconds,
-        }), 429  # 429 Too Many Requests
-    
-    # Cho TẤT CẢ routes khác (API endpoints), yêu cầu admin key trong header
-    provided_key = request.headers.get("X-Admin-Key")
-    
-    if provided_key != admin_secret:
-        # Key sai → ghi lại failed attempt và block nếu cần
-        endpoint = request.endpoint or request.path
-        record_failed_attempt(ip_address, endpoint)
-        
-        failed_count = get_failed_attempts_count(ip_address)
-        
-        # Log failed attempt
-        current_app.logger.warning(
-            f"admin_auth_failed | request_id={_get_request_id()} | "
-            f"ip={ip_address} | endpoint={endpoint} | "
-            f"failed_count={failed_count}"
-        )
-        
-        # Delay để làm chậm brute force (exponential backoff)
-        # Delay tăng dần theo số lần failed: 0.1s, 0.2s, 0.4s, 0.8s, 1.6s
-        delay_seconds = min(0.1 * (2 ** (failed_count - 1)), 2.0)  # Max 2 seconds
-        time.sleep(delay_seconds)
-        
-        # Kiểm tra lại xem có bị block sau khi record attempt không
-        is_blocked, unblock_time = is_ip_blocked(ip_address)
-        if is_blocked:
-            remaining_seconds = int(unblock_time - time.time())
-            return jsonify({
-                "error": f"IP bị tạm khóa do quá nhiều lần thử sai. Vui lòng thử lại sau {remaining_seconds} giây.",
-                "blocked_until": int(unblock_time),
-                "remaining_seconds": remaining_seconds,
-            }), 429
-        
-        # Trả về error message (không tiết lộ thông tin về key)
-        return jsonify({"error": "Unauthorized - Admin key không hợp lệ"}), 403
-    
-    # Key đúng → reset failed attempts cho IP này (nếu có)
-    # (Có thể implement reset logic nếu cần)
 
 
 @admin_bp.post("/keys/create")
@@ -366,26 +341,14 @@ def get_key_info(key_prefix: str):
 @admin_bp.post("/keys/<key_prefix>/deactivate")
 def deactivate_key(key_prefix: str):
     """Vô hiệu hóa key theo prefix"""
-    import pymysql
+    from services.api_key_service import deactivate_key_by_prefix
     
-    conn = None
     try:
-        from services.api_key_service import _get_db_connection
-        conn = _get_db_connection()
-        with conn.cursor() as cursor:
-            cursor.execute(
-                "UPDATE api_keys SET active = FALSE WHERE key_prefix = %s",
-                (key_prefix,),
-            )
-            affected = cursor.rowcount
-        conn.commit()
+        found = deactivate_key_by_prefix(key_prefix)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
-    finally:
-        if conn:
-            conn.close()
     
-    if affected == 0:
+    if not found:
         return jsonify({"error": "Không tìm thấy key"}), 404
     
     return jsonify({
@@ -449,6 +412,64 @@ def get_key_usage(key_prefix: str):
     })
 
 
+@admin_bp.get("/keys/<key_prefix>/archive")
+def get_key_archive(key_prefix: str):
+    """
+    Tra cứu request logs đã archive (cold storage) của key theo ngày
+    Query: ?date=YYYY-MM-DD (xem log chi tiết) hoặc ?from=YYYY-MM-DD&to=YYYY-MM-DD (thống kê theo ngày)
+    """
+    from datetime import date, timedelta
+
+    from services.log_archive_service import get_archived_daily_stats, get_archived_logs
+
+    try:
+        day = date.fromisoformat(request.args["date"]) if request.args.get("date") else None
+        end = date.fromisoformat(request.args["to"]) if request.args.get("to") else date.today()
+        start = date.fromisoformat(request.args["from"]) if request.args.get("from") else end - timedelta(days=30)
+    except ValueError:
+        return jsonify({"error": "Ngày không hợp lệ (định dạng YYYY-MM-DD)"}), 400
+
+    if start > end or (end - start).days > 3660:
+        return jsonify({"error": "Khoảng ngày không hợp lệ"}), 400
+
+    conn = None
+    try:
+        from services.api_key_service import _get_db_connection
+        conn = _get_db_connection()
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT id, tier FROM api_keys WHERE key_prefix = %s",
+                (key_prefix,),
+            )
+            key_row = cursor.fetchone()
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    finally:
+        if conn:
+            conn.close()
+
+    if not key_row:
+        return jsonify({"error": "Không tìm thấy key"}), 404
+
+    if day:
+        limit = request.args.get("limit", 1000, type=int)
+        logs = get_archived_logs(key_row["id"], day, limit=max(1, min(limit, 10000)))
+        return jsonify({
+            "key_prefix": key_prefix,
+            "date": day.isoformat(),
+            "count": len(logs),
+            "logs": logs,
+        })
+
+    return jsonify({
+        "key_prefix": key_prefix,
+        "tier": key_row["tier"],
+        "from": start.isoformat(),
+        "to": end.isoformat(),
+        "daily": get_archived_daily_stats(key_row["id"], start, end),
+    })
+
+
 @admin_bp.get("/security-stats")
 @limiter.limit("10 per minute")  # Rate limit cho security stats
 def get_security_stats_endpoint():
@@ -460,50 +481,41 @@ def get_security_stats_endpoint():
     })
 
 
+@admin_bp.get("/admission")
+@limiter.limit("30 per minute")
+def get_admission_metrics():
+    """Metrics load shedding của worker xử lý request này (load, in-flight, admitted/shed theo tier)"""
+    from services.admission_control import get_metrics
+    return jsonify({
+        "success": True,
+        "admission": get_metrics(),
+    })
+
+
+@admin_bp.get("/status")
+@limiter.limit("30 per minute")
+def get_worker_status():
+    """Trạng thái các thành phần nền của worker xử lý request này (auth breaker, change-log, outbox, sweeper)"""
+    from services import change_log, email_outbox, expiry_sweeper
+    from services.api_key_service import get_auth_status
+    return jsonify({
+        "success": True,
+        "auth_breaker": get_auth_status(),
+        "change_log": change_log.get_status(),
+        "email_outbox": email_outbox.get_status(),
+        "expiry_sweeper": expiry_sweeper.get_status(),
+    })
+
+
 @admin_bp.get("/stats")
 @limiter.limit("30 per minute")  # Rate limit cho admin stats
 def get_stats():
-    """Thống kê tổng quan"""
-    import pymysql
-    
-    conn = None
+    """Thống kê tổng quan (counter đã materialize, cache ngắn trong RAM) + requests/phút, error rate"""
+    from services.admin_stats import get_overview
     try:
-        from services.api_key_service import _get_db_connection
-        conn = _get_db_connection()
-        with conn.cursor() as cursor:
-            cursor.execute(
-                """
-                SELECT 
-                    tier,
-                    COUNT(*) as total_keys,
-                    SUM(active) as active_keys
-                FROM api_keys
-                GROUP BY tier
-                """
-            )
-            tier_stats = cursor.fetchall()
-            
-            cursor.execute(
-                """
-                SELECT SUM(request_count) as total
-                FROM api_usage
-                WHERE request_date = CURDATE()
-                """
-            )
-            today_row = cursor.fetchone()
+        return jsonify(get_overview())
     except Exception as e:
         return jsonify({"error": str(e)}), 500
-    finally:
-        if conn:
-            conn.close()
-    
-    return jsonify({
-        "tiers": {
-            r["tier"]: {"total": r["total_keys"], "active": r["active_keys"]}
-            for r in tier_stats
-        },
-        "requests_today": today_row["total"] or 0,
-    })
 
 
 @admin_bp.get("/payments")
@@ -637,29 +649,29 @@ def admin_search_user():
 
 @admin_bp.get("/users")
 def admin_list_users():
-    """Admin API: List users with pagination (JSON)"""
-    from services.user_service import get_users_list
+    """Admin API: List users with keyset pagination (JSON) - ?cursor=<next_cursor của trang trước>"""
+    from services.user_service import InvalidCursor, get_users_list
     
-    page = request.args.get("page", 1, type=int)
+    cursor = request.args.get("cursor", "").strip() or None
     per_page = request.args.get("per_page", 20, type=int)
     search = request.args.get("search", "").strip() or None
     
-    if page < 1:
-        page = 1
     if per_page < 1 or per_page > 100:
         per_page = 20
     
-    users, total_count = get_users_list(page=page, per_page=per_page, search=search)
-    
-    total_pages = (total_count + per_page - 1) // per_page if total_count > 0 else 1
+    try:
+        result = get_users_list(cursor=cursor, per_page=per_page, search=search)
+    except InvalidCursor as e:
+        return jsonify({"error": str(e)}), 400
     
     return jsonify({
-        "users": users,
+        "users": result["users"],
         "pagination": {
-            "page": page,
             "per_page": per_page,
-            "total": total_count,
-            "total_pages": total_pages,
+            "total": result["total"],
+            "total_is_estimate": result["total_is_estimate"],
+            "next_cursor": result["next_cursor"],
+            "has_more": result["next_cursor"] is not None,
         }
     })
 
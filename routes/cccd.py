@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import os
 import time
 from datetime import date
 
@@ -8,6 +9,8 @@ from flask import Blueprint, current_app, g, jsonify, render_template, request
 from services.cccd_parser import parse_cccd
 from services.province_mapping import ProvinceVersion, map_province_name
 from app import limiter
+from services.concurrency_limiter import concurrency_limited
+from services.cost_limiter import cost_limited
 
 cccd_bp = Blueprint("cccd", __name__)
 
@@ -48,8 +51,11 @@ def _log_to_database_if_enabled(
         
         # Chỉ log khi tiered mode (có MySQL)
         if api_key_mode == "tiered":
+            from services import admin_stats
             from services.logging_service import log_request_to_database
             
+            admin_stats.record_response(status_code)
+            
             log_request_to_database(
                 request_id=request_id,
                 api_key_id=api_key_id,
@@ -72,6 +78,50 @@ def _log_to_database_if_enabled(
         current_app.logger.warning(f"Failed to log to database: {e}")
 
 
+@cccd_bp.before_request
+def _admission_control():
+    """Load shedding theo tier khi worker quá tải (trước mọi thao tác DB)"""
+    if request.endpoint != "cccd.cccd_parse" or request.method != "POST":
+        return None
+    from services.admission_control import admit, parse_request_start
+    decision = admit(
+        request.headers.get("X-API-Key"),
+        queue_delay_ms=parse_request_start(request.headers.get("X-Request-Start")),
+    )
+    if decision.admitted:
+        g.admission_admitted = True
+        return None
+    current_app.logger.warning(
+        f"load_shed | request_id={_get_request_id()} | tier={decision.tier} | load={decision.load:.2f}"
+    )
+    response = jsonify({
+        "success": False,
+        "is_valid_format": False,
+        "data": None,
+        "message": "Hệ thống đang quá tải. Vui lòng thử lại sau.",
+    })
+    response.headers["Retry-After"] = str(decision.retry_after)
+    return response, 503
+
+
+@cccd_bp.teardown_request
+def _admission_release(exc):
+    if g.pop("admission_admitted", False):
+        from services.admission_control import release
+        release()
+
+
+@cccd_bp.after_request
+def _add_quota_headers(response):
+    """X-Quota-* headers khi key có quota/ngày (free tier)"""
+    quota = g.get("quota")
+    if quota is not None and quota.limit is not None:
+        response.headers["X-Quota-Limit"] = str(quota.limit)
+        response.headers["X-Quota-Remaining"] = str(quota.remaining)
+        response.headers["X-Quota-Reset"] = str(int(quota.reset_at))
+    return response
+
+
 @cccd_bp.route("/v1/cccd/parse", methods=["OPTIONS"])
 @limiter.exempt  # Exempt OPTIONS from rate limiting
 def cccd_parse_options():
@@ -98,8 +148,20 @@ def _check_api_key():
     
     if api_key_mode == "tiered":
         # Tiered mode: validate với MySQL
-        from services.api_key_service import validate_api_key, log_request
-        is_valid, error_msg, key_info = validate_api_key(provided_api_key)
+        from services.api_key_service import AuthServiceUnavailable, validate_api_key, log_request
+        try:
+            is_valid, error_msg, key_info = validate_api_key(provided_api_key)
+        except AuthServiceUnavailable:
+            # MySQL lỗi và key không có trong last-known-good → fail fast
+            current_app.logger.warning("api_key_check_failed | mode=tiered | reason=auth_backend_unavailable")
+            response = jsonify({
+                "success": False,
+                "is_valid_format": False,
+                "data": None,
+                "message": "Hệ thống xác thực tạm thời gián đoạn. Vui lòng thử lại sau.",
+            })
+            response.headers["Retry-After"] = os.getenv("AUTH_BREAKER_OPEN_SECONDS", "30")
+            return False, (response, 503), None
         if not is_valid:
             current_app.logger.warning(
                 f"api_key_check_failed | mode=tiered | reason={error_msg}"
@@ -113,8 +175,27 @@ def _check_api_key():
                 }),
                 401,
             ), None
-        # Log usage
-        log_request(provided_api_key)
+        # Quota/ngày theo tier: counter trong memory, từ chối trước khi ghi usage hay parse
+        from services.quota_service import consume
+        quota = consume(key_info.id, key_info.tier)
+        g.quota = quota
+        if not quota.allowed:
+            current_app.logger.warning(
+                f"quota_exceeded | key_prefix={key_info.key_prefix} | limit={quota.limit}"
+            )
+            response = jsonify({
+                "success": False,
+                "is_valid_format": False,
+                "data": None,
+                "message": f"Đã vượt quota {quota.limit} requests/ngày. Vui lòng thử lại vào ngày mai hoặc nâng cấp gói.",
+            })
+            response.headers["Retry-After"] = str(max(1, int(quota.reset_at - time.time())))
+            return False, (response, 429), None
+        # Log usage (không critical: lỗi ghi usage không làm hỏng request)
+        try:
+            log_request(provided_api_key)
+        except Exception as e:
+            current_app.logger.warning(f"Failed to log usage: {e}")
         return True, None, key_info
     else:
         # Simple mode: so sánh với API_KEY trong .env
@@ -166,8 +247,28 @@ def _get_rate_limit():
     return "30 per minute"
 
 
+def _get_concurrency_limit():
+    """Số request đồng thời tối đa theo tier của API key"""
+    settings = current_app.config.get("SETTINGS")
+    api_key_mode = getattr(settings, "api_key_mode", "simple")
+    
+    if api_key_mode == "tiered":
+        provided_api_key = request.headers.get("X-API-Key")
+        if provided_api_key:
+            from services.api_key_service import get_concurrency_limit_for_key
+            return get_concurrency_limit_for_key(provided_api_key)
+    
+    # Default cho simple mode hoặc không có key
+    try:
+        return int(os.getenv("CONCURRENCY_DEFAULT_LIMIT", "10"))
+    except ValueError:
+        return 10
+
+
 @cccd_bp.route("/v1/cccd/parse", methods=["POST"])
-@limiter.limit(_get_rate_limit)
+@limiter.exempt  # Budget theo tier do cost_limited (GCRA) xử lý
+@cost_limited(_get_rate_limit, cost=1, scope="cccd_parse")
+@concurrency_limited(_get_concurrency_limit)
 def cccd_parse():
     """
     Parse CCCD number to extract information
@@ -336,6 +437,9 @@ def cccd_parse():
     # API Key check
     is_valid, error_response, key_info = _check_api_key()
     if not is_valid:
+        # Vượt quota/ngày hoặc auth backend lỗi: trả ngay, không tốn thêm DB write
+        if isinstance(error_response, tuple) and error_response[1] in (429, 503):
+            return error_response
         current_app.logger.warning(
             f"auth_failed | request_id={req_id} | reason=invalid_or_missing_api_key"
         )
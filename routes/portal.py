@@ -4,18 +4,21 @@ Portal routes - Customer-facing web portal
 from __future__ import annotations
 
 from datetime import datetime
+from functools import partial
 
-from flask import Blueprint, current_app, flash, redirect, render_template, request, session, url_for
+from flask import Blueprint, current_app, flash, g, redirect, render_template, request, session, url_for
 
 import os
 import pymysql
 
 from app import limiter
+
+from services import deadline, fan_out
+from services.cost_limiter import cost_limited
 from services.email_service import send_password_reset_email
+from services.user_context import get_user_context, invalidate_user_context
 from services.user_service import (
     authenticate_user,
-    get_user_by_id,
-    get_user_subscription,
     invalidate_user_sessions,
     register_user,
     request_password_reset,
@@ -24,6 +27,19 @@ from services.user_service import (
 
 portal_bp = Blueprint("portal", __name__, url_prefix="/portal")
 
+# Budget cho các trang thống kê (mỗi user), tính theo cost thay vì số request
+PORTAL_USAGE_RATE_LIMIT = "30 per minute"
+# Cost theo khoảng thời gian của query thống kê (aggregate 365 ngày đắt hơn nhiều so với 7 ngày)
+_USAGE_DAYS_COST = {7: 1, 30: 2, 90: 4, 365: 12}
+
+
+def _current_user_and_subscription() -> tuple[dict | None, dict | None]:
+    """(user, subscription) của user đang login - 1 query, memoize trong request"""
+    context = get_user_context()
+    if not context:
+        return None, None
+    return context["user"], context["subscription"]
+
 
 def require_login(f):
     """Decorator để yêu cầu login - hỗ trợ AJAX requests"""
@@ -177,6 +193,7 @@ def forgot_password():
                 password=os.getenv("MYSQL_PASSWORD", ""),
                 database=os.getenv("MYSQL_DATABASE", "cccd_api"),
                 cursorclass=pymysql.cursors.DictCursor,
+                **deadline.db_timeouts(),
             )
             try:
                 with conn.cursor() as cursor:
@@ -251,6 +268,11 @@ def reset_password(token: str):
             return render_template("portal/reset_password.html", token=token)
     
     # GET: Show reset form - Validate token first
+    from services import schema_registry
+    if not schema_registry.has_column("users", "password_reset_token"):
+        flash("Password reset feature chưa được kích hoạt", "error")
+        return redirect(url_for("portal.login"))
+    
     try:
         conn = pymysql.connect(
             host=os.getenv("MYSQL_HOST", "localhost"),
@@ -259,23 +281,18 @@ def reset_password(token: str):
             password=os.getenv("MYSQL_PASSWORD", ""),
             database=os.getenv("MYSQL_DATABASE", "cccd_api"),
             cursorclass=pymysql.cursors.DictCursor,
+            **deadline.db_timeouts(),
         )
         try:
             with conn.cursor() as cursor:
-                try:
-                    cursor.execute(
-                        """
-                        SELECT id, password_reset_expires, status
-                        FROM users
-                        WHERE password_reset_token = %s
-                        """,
-                        (token,),
-                    )
-                except Exception:
-                    # Columns don't exist
-                    flash("Password reset feature chưa được kích hoạt", "error")
-                    return redirect(url_for("portal.login"))
-                
+                cursor.execute(
+                    """
+                    SELECT id, password_reset_expires, status
+                    FROM users
+                    WHERE password_reset_token = %s
+                    """,
+                    (token,),
+                )
                 user = cursor.fetchone()
                 
                 if not user:
@@ -319,6 +336,7 @@ def login():
                 session["user_id"] = user_data["id"]
                 session["user_email"] = user_data["email"]
                 session["user_name"] = user_data["full_name"]
+                invalidate_user_context()
                 
                 # Remember me: set permanent session (24h) if checked
                 if remember_me:
@@ -428,8 +446,7 @@ def dashboard():
             flash("Vui lòng đăng nhập", "warning")
             return redirect(url_for("portal.login"))
         
-        user = get_user_by_id(user_id)
-        subscription = get_user_subscription(user_id)
+        user, subscription = _current_user_and_subscription()
         
         if not user:
             session.clear()
@@ -441,6 +458,7 @@ def dashboard():
             "portal/dashboard.html",
             user=user,
             subscription=subscription,
+            api_key_count=g.user_context["api_key_count"],
         )
     except Exception as e:
         # NEVER expose raw data or exceptions to users
@@ -455,7 +473,16 @@ def dashboard():
 def keys():
     """Quản lý API keys"""
     user_id = session.get("user_id")
-    user = get_user_by_id(user_id)
+    from services.api_key_service import get_user_api_keys
+    if request.method == "GET":
+        # Danh sách key không phụ thuộc user context → load đồng thời
+        (user, subscription), api_keys = fan_out.gather(
+            _current_user_and_subscription,
+            partial(get_user_api_keys, user_id),
+        )
+    else:
+        user, subscription = _current_user_and_subscription()
+        api_keys = None
     
     # Check if this is an AJAX POST request (delete/update_label) - return JSON if auth fails
     if request.method == "POST":
@@ -472,7 +499,6 @@ def keys():
         flash("Phiên đăng nhập đã hết hạn", "warning")
         return redirect(url_for("portal.login"))
     
-    subscription = get_user_subscription(user_id)
     current_tier = subscription["tier"] if subscription else "free"
     
     # POST: Create new key or AJAX actions
@@ -538,6 +564,7 @@ def keys():
                 )
                 # Store in session to show once
                 session["new_api_key"] = api_key
+                invalidate_user_context()
                 if days_valid:
                     flash(f"Tạo API key thành công! Key sẽ hết hạn sau {days_valid} ngày. Vui lòng lưu lại ngay.", "success")
                 else:
@@ -558,6 +585,7 @@ def keys():
                 key_id_int = int(key_id)
                 from services.api_key_service import delete_key_by_id
                 if delete_key_by_id(key_id_int, user_id):
+                    invalidate_user_context()
                     return jsonify({"success": True, "message": "Đã xóa API key thành công (đã xóa khỏi database)"})
                 else:
                     return jsonify({"success": False, "error": "Không tìm thấy API key hoặc bạn không có quyền xóa"}), 404
@@ -583,9 +611,9 @@ def keys():
             except (ValueError, Exception) as e:
                 return jsonify({"success": False, "error": f"Lỗi: {str(e)}"}), 500
     
-    # GET: List keys
-    from services.api_key_service import get_user_api_keys
-    api_keys = get_user_api_keys(user_id)
+    # GET: List keys (đã load cùng user context ở trên)
+    if api_keys is None:
+        api_keys = get_user_api_keys(user_id)
     
     # Get new key from session (show once)
     new_api_key = session.pop("new_api_key", None)
@@ -603,8 +631,20 @@ def keys():
 
 
 
+def _portal_user_rate_limit_key():
+    return f"user:{session.get('user_id')}"
+
+
+def _usage_days_cost() -> int:
+    """Cost của query thống kê theo ?days= (giá trị không hợp lệ → 30 như route)"""
+    days = request.args.get("days", "30", type=int)
+    return _USAGE_DAYS_COST.get(days, _USAGE_DAYS_COST[30])
+
+
 @portal_bp.route("/keys/<int:key_id>/usage")
+@limiter.exempt
 @require_login
+@cost_limited(PORTAL_USAGE_RATE_LIMIT, cost=_usage_days_cost, key_func=_portal_user_rate_limit_key, scope="portal_usage")
 def key_usage(key_id: int):
     """Get usage stats for a specific key (JSON API) - AJAX endpoint"""
     from flask import jsonify
@@ -613,7 +653,7 @@ def key_usage(key_id: int):
         return jsonify({"success": False, "error": "Unauthorized"}), 401
     
     # Verify user exists
-    user = get_user_by_id(user_id)
+    user, _ = _current_user_and_subscription()
     if not user:
         return jsonify({"success": False, "error": "Phiên đăng nhập đã hết hạn"}), 401
     
@@ -632,26 +672,36 @@ def key_usage(key_id: int):
 
 
 @portal_bp.route("/usage")
+@limiter.exempt
 @require_login
+@cost_limited(
+    PORTAL_USAGE_RATE_LIMIT,
+    cost=lambda: 2 * _usage_days_cost(),  # 2 aggregate: tổng + theo từng key
+    key_func=_portal_user_rate_limit_key,
+    scope="portal_usage",
+)
 def usage():
     """Usage statistics dashboard"""
     user_id = session.get("user_id")
-    user = get_user_by_id(user_id)
-    
-    if not user:
-        session.clear()
-        flash("Phiên đăng nhập đã hết hạn", "warning")
-        return redirect(url_for("portal.login"))
     
     # Get days parameter (default 30)
     days = request.args.get("days", "30", type=int)
     if days not in (7, 30, 90, 365):
         days = 30
     
-    # Get usage stats
+    # Kiểm tra user trước: session hết hạn thì không chạy 2 aggregate nặng
+    user, _ = _current_user_and_subscription()
+    if not user:
+        session.clear()
+        flash("Phiên đăng nhập đã hết hạn", "warning")
+        return redirect(url_for("portal.login"))
+    
+    # 2 aggregate chạy đồng thời (latency ≈ query chậm nhất)
     from services.usage_service import get_user_usage_stats, get_usage_stats_by_key
-    stats = get_user_usage_stats(user_id, days=days)
-    stats_by_key = get_usage_stats_by_key(user_id, days=days)
+    stats, stats_by_key = fan_out.gather(
+        partial(get_user_usage_stats, user_id, days=days),
+        partial(get_usage_stats_by_key, user_id, days=days),
+    )
     
     return render_template(
         "portal/usage.html",
@@ -663,7 +713,9 @@ def usage():
 
 
 @portal_bp.route("/usage/api")
+@limiter.exempt
 @require_login
+@cost_limited(PORTAL_USAGE_RATE_LIMIT, cost=_usage_days_cost, key_func=_portal_user_rate_limit_key, scope="portal_usage")
 def usage_api():
     """API endpoint để lấy usage stats (JSON) - dùng cho AJAX/Chart.js"""
     user_id = session.get("user_id")
@@ -690,14 +742,13 @@ def usage_api():
 def billing():
     """Billing history và subscription management"""
     user_id = session.get("user_id")
-    user = get_user_by_id(user_id)
+    user, subscription = _current_user_and_subscription()
     
     if not user:
         session.clear()
         flash("Phiên đăng nhập đã hết hạn", "warning")
         return redirect(url_for("portal.login"))
     
-    subscription = get_user_subscription(user_id)
     from services.billing_service import get_user_payments, get_tier_pricing
     
     payments = get_user_payments(user_id)
@@ -717,14 +768,13 @@ def billing():
 def upgrade():
     """Upgrade tier - Manual payment flow"""
     user_id = session.get("user_id")
-    user = get_user_by_id(user_id)
+    user, subscription = _current_user_and_subscription()
     
     if not user:
         session.clear()
         flash("Phiên đăng nhập đã hết hạn", "warning")
         return redirect(url_for("portal.login"))
     
-    subscription = get_user_subscription(user_id)
     current_tier = subscription["tier"] if subscription else "free"
     
     from services.billing_service import get_tier_pricing, create_payment, approve_payment
@@ -792,6 +842,7 @@ def upgrade():
                 try:
                     payment_id_int = int(payment_id)
                     if approve_payment(payment_id_int, user_id):
+                        invalidate_user_context()
                         flash("Thanh toán đã được approve và subscription đã được update", "success")
                     else:
                         flash("Không thể approve payment", "error")
@@ -3,10 +3,12 @@ Admin Authentication Service - Quản lý đăng nhập admin
 """
 from __future__ import annotations
 
-import bcrypt
 import pymysql
 from typing import Dict, Optional, Tuple
 
+from services import deadline, password_hasher
+from services.password_hasher import PasswordHasherBusy
+
 
 def _get_db_connection():
     """Lấy MySQL connection"""
@@ -18,21 +20,19 @@ def _get_db_connection():
         database=os.getenv("MYSQL_DATABASE", "cccd_api"),
         charset="utf8mb4",
         cursorclass=pymysql.cursors.DictCursor,
+        **deadline.db_timeouts(),
         autocommit=False,
     )
 
 
 def hash_password(password: str) -> str:
-    """Hash password bằng bcrypt"""
-    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
+    """Hash password bằng bcrypt (process pool, raise PasswordHasherBusy khi quá tải)"""
+    return password_hasher.hash_password(password)
 
 
 def verify_password(password: str, password_hash: str) -> bool:
-    """Verify password với hash"""
-    try:
-        return bcrypt.checkpw(password.encode("utf-8"), password_hash.encode("utf-8"))
-    except Exception:
-        return False
+    """Verify password với hash (process pool, raise PasswordHasherBusy khi quá tải)"""
+    return password_hasher.verify_password(password, password_hash)
 
 
 def authenticate_admin(username: str, password: str) -> Tuple[bool, Optional[Dict], Optional[str]]:
@@ -75,6 +75,14 @@ def authenticate_admin(username: str, password: str) -> Tuple[bool, Optional[Dic
             if not verify_password(password, admin["password_hash"]):
                 return False, None, "Username hoặc password không đúng"
             
+            # Hash cũ có cost khác BCRYPT_ROUNDS → rehash trong lúc còn password plaintext
+            new_hash = password_hasher.rehash_if_needed(password, admin["password_hash"])
+            if new_hash:
+                cursor.execute(
+                    "UPDATE admin_users SET password_hash = %s WHERE id = %s",
+                    (new_hash, admin["id"]),
+                )
+            
             # Update last_login
             cursor.execute(
                 "UPDATE admin_users SET last_login = NOW() WHERE id = %s",
@@ -92,6 +100,8 @@ def authenticate_admin(username: str, password: str) -> Tuple[bool, Optional[Dic
             
             return True, admin_data, None
             
+    except PasswordHasherBusy:
+        return False, None, password_hasher.BUSY_MESSAGE
     except pymysql.Error as e:
         if conn:
             conn.rollback()
@@ -182,6 +192,10 @@ def change_admin_password(admin_id: int, old_password: str, new_password: str) -
             
             return True, None
             
+    except PasswordHasherBusy:
+        if conn:
+            conn.rollback()
+        return False, password_hasher.BUSY_MESSAGE
     except pymysql.Error as e:
         if conn:
             conn.rollback()
@@ -1,148 +1,291 @@
 """
 Admin Security Service - Chống brute force attack
+
+Bộ nhớ và CPU bị chặn trên dù bị scan từ rất nhiều IP:
+- Mỗi IP đếm failed attempts bằng sliding window chia bucket cố định (WINDOW_BUCKETS ô),
+  record/check là O(1) thay vì lọc lại list timestamp.
+- Số IP được theo dõi tối đa MAX_TRACKED_IPS (LRU: IP lâu không thử sai bị bỏ trước),
+  IP đang bị block giữ riêng tối đa MAX_BLOCKED_IPS.
+- Tổng failed attempts cho get_security_stats đếm bằng 1 window chung, không quét từng IP.
+- Tarpit không sleep trong request thread: sau mỗi lần thử sai IP phải chờ (backoff mũ), request tới
+  trong thời gian chờ bị từ chối ngay (429 + Retry-After) trước khi so key. Chỉ IP đã thử sai mới bị chờ;
+  bảng tarpit tối đa MAX_TARPITTED_IPS IP, đầy (scan từ rất nhiều IP) → bỏ IP thử sai lâu nhất.
+
+ADMIN_SECURITY_STORAGE=shm|mysql (services/admin_security_storage.py): counter/block dùng chung
+giữa các worker/node, để N worker không cho kẻ tấn công N lần thử và block không mất khi restart.
+Trạng thái cục bộ vẫn được giữ để block ngay lập tức và khi storage lỗi.
 """
 from __future__ import annotations
 
+import logging
+import os
+import threading
 import time
-from collections import defaultdict
-from datetime import datetime, timedelta
+from collections import OrderedDict
 from typing import Dict, Tuple
 
-# In-memory storage cho failed attempts (trong production nên dùng Redis)
-# Format: {ip_address: [(timestamp, endpoint), ...]}
-_failed_attempts: Dict[str, list] = defaultdict(list)
-
-# IP blocking: {ip_address: unblock_timestamp}
-_blocked_ips: Dict[str, float] = {}
-
 # Configuration
 MAX_FAILED_ATTEMPTS = 5  # Số lần thử sai tối đa
 BLOCK_DURATION_SECONDS = 300  # Block 5 phút sau khi vượt quá limit
 WINDOW_SECONDS = 60  # Time window để đếm failed attempts (60 giây)
-CLEANUP_INTERVAL = 3600  # Cleanup old records mỗi 1 giờ
-_last_cleanup = time.time()
+WINDOW_BUCKETS = 12  # Window chia thành 12 ô 5 giây
+TARPIT_BASE_SECONDS = 0.1  # Delay sau lần thử sai đầu tiên, gấp đôi mỗi lần tiếp theo
+TARPIT_MAX_SECONDS = 2.0
+MAX_TRACKED_IPS = int(os.getenv("ADMIN_SECURITY_MAX_TRACKED_IPS", "10000"))
+MAX_BLOCKED_IPS = int(os.getenv("ADMIN_SECURITY_MAX_BLOCKED_IPS", "10000"))
+MAX_TARPITTED_IPS = int(os.getenv("ADMIN_TARPIT_MAX_IPS", "1000"))
+
+_BUCKET_SECONDS = WINDOW_SECONDS / WINDOW_BUCKETS
+
+logger = logging.getLogger(__name__)
+
+
+class _SlidingWindow:
+    """Bộ đếm sliding window kích thước cố định: ô i giữ số lần của bucket epoch[i]"""
+
+    __slots__ = ("counts", "epochs")
+
+    def __init__(self):
+        self.counts = [0] * WINDOW_BUCKETS
+        self.epochs = [-1] * WINDOW_BUCKETS
+
+    def add(self, now: float) -> None:
+        epoch = int(now // _BUCKET_SECONDS)
+        slot = epoch % WINDOW_BUCKETS
+        if self.epochs[slot] != epoch:
+            self.epochs[slot] = epoch
+            self.counts[slot] = 0
+        self.counts[slot] += 1
+
+    def count(self, now: float, window_seconds: float = WINDOW_SECONDS) -> int:
+        current = int(now // _BUCKET_SECONDS)
+        oldest = current - min(WINDOW_BUCKETS, max(1, int(window_seconds // _BUCKET_SECONDS))) + 1
+        return sum(c for c, e in zip(self.counts, self.epochs) if oldest <= e <= current)
+
+
+class _IPState:
+    __slots__ = ("window",)
+
+    def __init__(self):
+        self.window = _SlidingWindow()
+
+
+_lock = threading.Lock()
+
+# IP có failed attempts gần đây (LRU, tối đa MAX_TRACKED_IPS)
+_tracked_ips: "OrderedDict[str, _IPState]" = OrderedDict()
+
+# IP blocking: {ip_address: unblock_timestamp} (LRU, tối đa MAX_BLOCKED_IPS)
+_blocked_ips: "OrderedDict[str, float]" = OrderedDict()
+
+# IP đang bị tarpit: {ip_address: tarpit_until} (tối đa MAX_TARPITTED_IPS, thứ tự theo lần thử sai gần nhất)
+_tarpitted_ips: "OrderedDict[str, float]" = OrderedDict()
+_tarpit_lock = threading.Lock()
+
+# Tổng failed attempts của mọi IP (cho stats)
+_total_window = _SlidingWindow()
+
+# Storage dùng chung (None = chỉ dùng bộ nhớ của process)
+_storage = None
+_storage_loaded = False
+
+
+def get_storage():
+    global _storage, _storage_loaded
+    if not _storage_loaded:
+        from services.admin_security_storage import create_storage
+        _storage = create_storage(WINDOW_SECONDS, WINDOW_BUCKETS, BLOCK_DURATION_SECONDS, MAX_FAILED_ATTEMPTS)
+        _storage_loaded = True
+    return _storage
+
+
+def _block_locally(ip_address: str, until: float) -> None:
+    """Ghi block vào bảng cục bộ; gọi khi đang giữ _lock"""
+    _blocked_ips[ip_address] = max(until, _blocked_ips.get(ip_address, 0.0))
+    _blocked_ips.move_to_end(ip_address)
+    while len(_blocked_ips) > MAX_BLOCKED_IPS:
+        _blocked_ips.popitem(last=False)
+
+
+def _get_state(ip_address: str) -> _IPState:
+    """State của IP (tạo mới nếu chưa có); gọi khi đang giữ _lock"""
+    state = _tracked_ips.get(ip_address)
+    if state is None:
+        state = _tracked_ips[ip_address] = _IPState()
+        while len(_tracked_ips) > MAX_TRACKED_IPS:
+            _tracked_ips.popitem(last=False)
+    else:
+        _tracked_ips.move_to_end(ip_address)
+    return state
 
 
 def record_failed_attempt(ip_address: str, endpoint: str) -> None:
     """
     Ghi lại failed attempt từ một IP
-    
+
     Args:
         ip_address: IP address của request
         endpoint: Endpoint bị failed
     """
-    global _last_cleanup
-    
     current_time = time.time()
-    
-    # Cleanup old records định kỳ
-    if current_time - _last_cleanup > CLEANUP_INTERVAL:
-        _cleanup_old_records(current_time)
-        _last_cleanup = current_time
-    
-    # Thêm failed attempt
-    _failed_attempts[ip_address].append((current_time, endpoint))
-    
+
+    with _lock:
+        state = _get_state(ip_address)
+        state.window.add(current_time)
+        _total_window.add(current_time)
+        attempts = state.window.count(current_time)
+
+    storage = get_storage()
+    if storage is not None:
+        try:
+            # Số lần thử của IP trên mọi worker/node
+            attempts = max(attempts, storage.record_failure(ip_address, current_time))
+        except Exception as e:
+            logger.warning(f"admin_security_storage_failed | {type(e).__name__}: {e}")
+
     # Kiểm tra xem có vượt quá limit không
-    recent_attempts = [
-        ts for ts, ep in _failed_attempts[ip_address]
-        if current_time - ts <= WINDOW_SECONDS
-    ]
-    
-    if len(recent_attempts) >= MAX_FAILED_ATTEMPTS:
+    if attempts >= MAX_FAILED_ATTEMPTS:
         # Block IP này
-        _blocked_ips[ip_address] = current_time + BLOCK_DURATION_SECONDS
+        until = current_time + BLOCK_DURATION_SECONDS
+        with _lock:
+            _block_locally(ip_address, until)
+        if storage is not None:
+            try:
+                storage.block(ip_address, until)
+            except Exception as e:
+                logger.warning(f"admin_security_storage_failed | {type(e).__name__}: {e}")
 
 
 def is_ip_blocked(ip_address: str) -> Tuple[bool, float | None]:
     """
     Kiểm tra xem IP có bị block không
-    
+
     Args:
         ip_address: IP address cần kiểm tra
-        
+
     Returns:
         Tuple (is_blocked, unblock_timestamp)
     """
-    if ip_address not in _blocked_ips:
-        return False, None
-    
-    unblock_time = _blocked_ips[ip_address]
-    current_time = time.time()
-    
-    if current_time >= unblock_time:
+    unblock_time = _blocked_ips.get(ip_address)
+    if unblock_time is None:
+        storage = get_storage()
+        if storage is None:
+            return False, None
+        try:
+            unblock_time = storage.blocked_until(ip_address, time.time())
+        except Exception as e:
+            logger.warning(f"admin_security_storage_failed | {type(e).__name__}: {e}")
+            return False, None
+        if unblock_time is None:
+            return False, None
+        # Block từ worker/node khác → nhớ cục bộ, lần kiểm tra sau không cần storage
+        with _lock:
+            _block_locally(ip_address, unblock_time)
+
+    if time.time() >= unblock_time:
         # Hết thời gian block, xóa khỏi danh sách
-        del _blocked_ips[ip_address]
+        with _lock:
+            _blocked_ips.pop(ip_address, None)
         return False, None
-    
+
     return True, unblock_time
 
 
+def _prune_tarpits(now: float) -> None:
+    """Bỏ mọi tarpit đã hết hạn (delay khác nhau nên không chỉ ở đầu hàng); gọi khi đang giữ _tarpit_lock"""
+    for ip_address in [ip for ip, until in _tarpitted_ips.items() if until <= now]:
+        del _tarpitted_ips[ip_address]
+
+
+def start_tarpit(ip_address: str, failed_count: int) -> float:
+    """
+    Bắt IP chờ trước lần thử kế tiếp (exponential backoff: 0.1s, 0.2s, 0.4s... tối đa 2s)
+
+    Không sleep trong request thread: request tới trong thời gian chờ bị từ chối ngay
+    (get_tarpit_remaining > 0 → 429 + Retry-After), nên kẻ tấn công không giữ được thread nào của worker.
+
+    Returns:
+        Số giây phải chờ
+    """
+    delay = min(TARPIT_BASE_SECONDS * (2 ** max(failed_count - 1, 0)), TARPIT_MAX_SECONDS)
+    now = time.time()
+    with _tarpit_lock:
+        until = max(now + delay, _tarpitted_ips.pop(ip_address, 0.0))
+        if len(_tarpitted_ips) >= MAX_TARPITTED_IPS:
+            _prune_tarpits(now)
+            while len(_tarpitted_ips) >= MAX_TARPITTED_IPS:
+                # Vẫn đầy → bỏ IP thử sai lâu nhất (tarpit sắp hết), không bắt IP khác phải chờ
+                _tarpitted_ips.popitem(last=False)
+        _tarpitted_ips[ip_address] = until
+        return until - now
+
+
+def get_tarpit_remaining(ip_address: str) -> float:
+    """Số giây IP còn phải chờ trước khi được thử key (0 nếu IP không bị tarpit)"""
+    with _tarpit_lock:
+        until = _tarpitted_ips.get(ip_address)
+        if until is None:
+            return 0.0
+        remaining = until - time.time()
+        if remaining <= 0:
+            del _tarpitted_ips[ip_address]
+            return 0.0
+        return remaining
+
+
 def get_failed_attempts_count(ip_address: str, window_seconds: int = WINDOW_SECONDS) -> int:
     """
     Đếm số failed attempts trong time window
-    
+
     Args:
         ip_address: IP address
-        window_seconds: Time window (mặc định 60 giây)
-        
+        window_seconds: Time window (mặc định 60 giây, làm tròn theo bucket, tối đa WINDOW_SECONDS)
+
     Returns:
         Số failed attempts trong window
     """
-    if ip_address not in _failed_attempts:
-        return 0
-    
     current_time = time.time()
-    recent_attempts = [
-        ts for ts, ep in _failed_attempts[ip_address]
-        if current_time - ts <= window_seconds
-    ]
-    
-    return len(recent_attempts)
-
-
-def _cleanup_old_records(current_time: float) -> None:
-    """Xóa các records cũ hơn WINDOW_SECONDS"""
-    global _failed_attempts, _blocked_ips
-    
-    # Cleanup failed attempts
-    for ip in list(_failed_attempts.keys()):
-        _failed_attempts[ip] = [
-            (ts, ep) for ts, ep in _failed_attempts[ip]
-            if current_time - ts <= WINDOW_SECONDS
-        ]
-        if not _failed_attempts[ip]:
-            del _failed_attempts[ip]
-    
-    # Cleanup blocked IPs đã hết hạn
-    for ip in list(_blocked_ips.keys()):
-        if current_time >= _blocked_ips[ip]:
-            del _blocked_ips[ip]
+    count = 0
+    state = _tracked_ips.get(ip_address)
+    if state is not None:
+        with _lock:
+            count = state.window.count(current_time, window_seconds)
+    storage = get_storage()
+    if storage is not None:
+        try:
+            count = max(count, storage.failure_count(ip_address, current_time))
+        except Exception as e:
+            logger.warning(f"admin_security_storage_failed | {type(e).__name__}: {e}")
+    return count
 
 
 def get_security_stats() -> Dict:
     """
     Lấy thống kê security (cho admin monitoring)
-    
+
     Returns:
         Dict với thông tin về blocked IPs và failed attempts
+        (toàn cục nếu có storage dùng chung, ngược lại chỉ của worker hiện tại)
     """
     current_time = time.time()
-    
-    # Đếm số IP đang bị block
-    active_blocks = sum(
-        1 for unblock_time in _blocked_ips.values()
-        if current_time < unblock_time
-    )
-    
-    # Đếm tổng số failed attempts trong window
-    total_failed = sum(
-        len([ts for ts, ep in attempts if current_time - ts <= WINDOW_SECONDS])
-        for attempts in _failed_attempts.values()
-    )
-    
-    return {
-        "blocked_ips_count": active_blocks,
-        "total_failed_attempts": total_failed,
-        "unique_ips_with_failures": len(_failed_attempts),
-    }
+
+    storage = get_storage()
+    if storage is not None:
+        try:
+            stats = storage.stats(current_time)
+            stats["storage"] = storage.name
+            return stats
+        except Exception as e:
+            logger.warning(f"admin_security_storage_failed | {type(e).__name__}: {e}")
+
+    with _lock:
+        # Bỏ các block đã hết hạn (tối đa MAX_BLOCKED_IPS phần tử)
+        for ip in [ip for ip, unblock_time in _blocked_ips.items() if current_time >= unblock_time]:
+            del _blocked_ips[ip]
+
+        return {
+            "blocked_ips_count": len(_blocked_ips),
+            "total_failed_attempts": _total_window.count(current_time),
+            "unique_ips_with_failures": len(_tracked_ips),
+            "storage": "memory",
+        }
@@ -0,0 +1,355 @@
+"""
+Admin Security Storage - Lưu trạng thái chống brute force dùng chung giữa các worker/node
+
+Chọn backend bằng ADMIN_SECURITY_STORAGE:
+    memory  (mặc định) mỗi process tự đếm/block, như trước
+    shm     SharedMemoryTable (mmap) - mọi worker trên cùng node thấy cùng counter/block
+    mysql   bảng MySQL - mọi node thấy cùng counter/block, ghi theo batch
+
+Với mysql, failed attempts và block được gom trong process và flush mỗi
+ADMIN_SECURITY_FLUSH_SECONDS (1 INSERT ... ON DUPLICATE KEY UPDATE cho cả batch);
+danh sách IP bị block được đọc lại mỗi ADMIN_SECURITY_REFRESH_SECONDS thay vì mỗi request.
+Flush/refresh chạy trong thread nền (mỗi process một thread): request admin thử sai không mở
+connection MySQL; batch flush lỗi được giữ lại cho lần sau.
+Worker vẫn đếm/block cục bộ ngay lập tức (services/admin_security.py), storage bổ sung góc nhìn toàn cục.
+
+    CREATE TABLE admin_auth_failures (
+        ip VARCHAR(45) NOT NULL,
+        bucket_start INT UNSIGNED NOT NULL,
+        attempts INT NOT NULL,
+        PRIMARY KEY (ip, bucket_start),
+        INDEX idx_bucket_start (bucket_start)
+    );
+    CREATE TABLE admin_ip_blocks (
+        ip VARCHAR(45) PRIMARY KEY,
+        blocked_until DOUBLE NOT NULL,
+        INDEX idx_blocked_until (blocked_until)
+    );
+"""
+from __future__ import annotations
+
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from typing import Dict, Optional, Tuple
+
+import pymysql
+
+from services import deadline
+
+logger = logging.getLogger(__name__)
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except ValueError:
+        return default
+
+
+class ShmSecurityStorage:
+    """Counter theo bucket trong SharedMemoryTable: key tự hết hạn, không cần cleanup"""
+
+    name = "shm"
+
+    def __init__(self, window_seconds: float, buckets: int, block_seconds: float, max_attempts: int):
+        from services.shared_memory import get_table
+
+        self.table = get_table()
+        self.window_seconds = window_seconds
+        self.buckets = buckets
+        self.bucket_seconds = window_seconds / buckets
+        self.block_seconds = block_seconds
+
+    def _epochs(self, now: float) -> range:
+        current = int(now // self.bucket_seconds)
+        return range(current - self.buckets + 1, current + 1)
+
+    def _sum(self, prefix: str, now: float) -> int:
+        total = 0
+        for epoch in self._epochs(now):
+            entry = self.table.get(f"{prefix}:{epoch}")
+            if entry:
+                total += int(entry[0])
+        return total
+
+    def record_failure(self, ip_address: str, now: float) -> int:
+        epoch = int(now // self.bucket_seconds)
+        expiry = self.window_seconds + self.bucket_seconds
+        self.table.incr(f"adm:f:{ip_address}:{epoch}", 1, expiry)
+        self.table.incr(f"adm:t:{epoch}", 1, expiry)
+        count = self._sum(f"adm:f:{ip_address}", now)
+        if count == 1:
+            # IP mới có failure trong window (xấp xỉ cho stats)
+            self.table.incr(f"adm:u:{epoch}", 1, expiry)
+        return count
+
+    def failure_count(self, ip_address: str, now: float) -> int:
+        return self._sum(f"adm:f:{ip_address}", now)
+
+    def block(self, ip_address: str, until: float) -> None:
+        def _set(entry, now):
+            if entry is not None and entry[0] >= until:
+                return entry, False
+            return (until, 0.0, until), entry is None
+
+        if self.table.update(f"adm:b:{ip_address}", _set):
+            epoch = int(time.time() // self.bucket_seconds)
+            self.table.incr(f"adm:bs:{epoch}", 1, self.block_seconds + self.bucket_seconds)
+
+    def blocked_until(self, ip_address: str, now: float) -> Optional[float]:
+        entry = self.table.get(f"adm:b:{ip_address}")
+        return entry[0] if entry and entry[0] > now else None
+
+    def stats(self, now: float) -> Dict:
+        block_epochs = int(self.block_seconds // self.bucket_seconds)
+        current = int(now // self.bucket_seconds)
+        blocked = 0
+        for epoch in range(current - block_epochs + 1, current + 1):
+            entry = self.table.get(f"adm:bs:{epoch}")
+            if entry:
+                blocked += int(entry[0])
+        return {
+            "blocked_ips_count": blocked,
+            "total_failed_attempts": self._sum("adm:t", now),
+            "unique_ips_with_failures": self._sum("adm:u", now),
+        }
+
+
+class MySQLSecurityStorage:
+    """Counter/block trong MySQL, ghi theo batch và đọc block list theo chu kỳ"""
+
+    name = "mysql"
+
+    def __init__(self, window_seconds: float, buckets: int, block_seconds: float, max_attempts: int):
+        self.window_seconds = window_seconds
+        self.buckets = buckets
+        self.bucket_seconds = window_seconds / buckets
+        self.block_seconds = block_seconds
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending_failures: Counter = Counter()  # (ip, bucket_start) → attempts
+        self._pending_blocks: Dict[str, float] = {}
+        # ip → (số attempts toàn cục đã biết, hết hiệu lực lúc): cập nhật ở mỗi lần flush có IP đó
+        self._global_counts: Dict[str, Tuple[int, float]] = {}
+        self._blocks: Dict[str, float] = {}
+        self._next_flush_at = 0.0
+        self._next_refresh_at = 0.0
+        self._next_cleanup_at = 0.0
+        self._worker_pid: Optional[int] = None
+
+    @staticmethod
+    def _get_db_connection():
+        return pymysql.connect(
+            host=os.getenv("MYSQL_HOST", "localhost"),
+            port=int(os.getenv("MYSQL_PORT", "3306")),
+            user=os.getenv("MYSQL_USER", "root"),
+            password=os.getenv("MYSQL_PASSWORD", ""),
+            database=os.getenv("MYSQL_DATABASE", "cccd_api"),
+            cursorclass=pymysql.cursors.DictCursor,
+            **deadline.db_timeouts(),
+        )
+
+    def _bucket_start(self, now: float) -> int:
+        return int(now // self.bucket_seconds * self.bucket_seconds)
+
+    def record_failure(self, ip_address: str, now: float) -> int:
+        with self._lock:
+            self._pending_failures[(ip_address, self._bucket_start(now))] += 1
+            pending = sum(n for (ip, _), n in self._pending_failures.items() if ip == ip_address)
+            known = self._known_count(ip_address, now)
+        self._ensure_worker()
+        return known + pending
+
+    def _known_count(self, ip_address: str, now: float) -> int:
+        count, expires_at = self._global_counts.get(ip_address, (0, 0.0))
+        return count if expires_at > now else 0
+
+    def failure_count(self, ip_address: str, now: float) -> int:
+        return self._known_count(ip_address, now)
+
+    def block(self, ip_address: str, until: float) -> None:
+        with self._lock:
+            self._pending_blocks[ip_address] = max(until, self._pending_blocks.get(ip_address, 0.0))
+            self._blocks[ip_address] = max(until, self._blocks.get(ip_address, 0.0))
+
+    def blocked_until(self, ip_address: str, now: float) -> Optional[float]:
+        self._ensure_worker()
+        until = self._blocks.get(ip_address)
+        return until if until is not None and until > now else None
+
+    def _ensure_worker(self) -> None:
+        """Chạy thread flush/refresh (mỗi process một thread; gọi lại sau fork sẽ tạo thread mới)"""
+        if self._worker_pid == os.getpid():
+            return
+        with self._lock:
+            if self._worker_pid == os.getpid():
+                return
+            self._worker_pid = os.getpid()
+        threading.Thread(target=self._sync_loop, name="admin-security-sync", daemon=True).start()
+
+    def _sync_loop(self) -> None:
+        while True:
+            time.sleep(min(
+                _env_float("ADMIN_SECURITY_FLUSH_SECONDS", 1.0),
+                _env_float("ADMIN_SECURITY_REFRESH_SECONDS", 2.0),
+            ))
+            self._maybe_sync(time.time())
+
+    def _maybe_sync(self, now: float) -> None:
+        """Flush batch / refresh block list nếu đến hạn (chỉ một thread làm, thread khác không chờ)"""
+        if now < self._next_flush_at and now < self._next_refresh_at:
+            return
+        if not self._flush_lock.acquire(blocking=False):
+            return
+        try:
+            conn = self._get_db_connection()
+            try:
+                if now >= self._next_flush_at:
+                    self._next_flush_at = now + _env_float("ADMIN_SECURITY_FLUSH_SECONDS", 1.0)
+                    self._flush(conn, now)
+                if now >= self._next_refresh_at:
+                    self._next_refresh_at = now + _env_float("ADMIN_SECURITY_REFRESH_SECONDS", 2.0)
+                    self._refresh_blocks(conn, now)
+            finally:
+                conn.close()
+        except Exception as e:
+            # Storage lỗi → vẫn còn đếm/block cục bộ trong worker
+            logger.warning(f"admin_security_storage_sync_failed | {type(e).__name__}: {e}")
+        finally:
+            self._flush_lock.release()
+
+    def _flush(self, conn, now: float) -> None:
+        with self._lock:
+            failures, self._pending_failures = self._pending_failures, Counter()
+            blocks, self._pending_blocks = self._pending_blocks, {}
+        try:
+            self._write_batch(conn, now, failures, blocks)
+            conn.commit()
+        except Exception:
+            # Giữ lại để flush lần sau
+            with self._lock:
+                self._pending_failures.update(failures)
+                for ip, until in blocks.items():
+                    self._pending_blocks[ip] = max(until, self._pending_blocks.get(ip, 0.0))
+            raise
+
+    def _write_batch(self, conn, now: float, failures: Counter, blocks: Dict[str, float]) -> None:
+        with conn.cursor() as cursor:
+            if failures:
+                cursor.executemany(
+                    """
+                    INSERT INTO admin_auth_failures (ip, bucket_start, attempts)
+                    VALUES (%s, %s, %s)
+                    ON DUPLICATE KEY UPDATE attempts = attempts + VALUES(attempts)
+                    """,
+                    [(ip, bucket, n) for (ip, bucket), n in failures.items()],
+                )
+                # Đếm toàn cục cho các IP vừa flush → block IP vượt limit ở mọi node
+                ips = sorted({ip for ip, _ in failures})
+                placeholders = ", ".join(["%s"] * len(ips))
+                cursor.execute(
+                    f"""
+                    SELECT ip, SUM(attempts) AS attempts
+                    FROM admin_auth_failures
+                    WHERE ip IN ({placeholders}) AND bucket_start > %s
+                    GROUP BY ip
+                    """,
+                    (*ips, now - self.window_seconds),
+                )
+                counts = {row["ip"]: int(row["attempts"]) for row in cursor.fetchall()}
+                with self._lock:
+                    # Merge: count của IP khác (từ lần flush trước) vẫn giữ tới khi hết window
+                    for ip in [ip for ip, (_, expires_at) in self._global_counts.items() if expires_at <= now]:
+                        del self._global_counts[ip]
+                    self._global_counts.update(
+                        (ip, (attempts, now + self.window_seconds)) for ip, attempts in counts.items()
+                    )
+                for ip, attempts in counts.items():
+                    if attempts >= self.max_attempts:
+                        blocks[ip] = max(blocks.get(ip, 0.0), now + self.block_seconds)
+            if blocks:
+                cursor.executemany(
+                    """
+                    INSERT INTO admin_ip_blocks (ip, blocked_until) VALUES (%s, %s)
+                    ON DUPLICATE KEY UPDATE blocked_until = GREATEST(blocked_until, VALUES(blocked_until))
+                    """,
+                    list(blocks.items()),
+                )
+                with self._lock:
+                    for ip, until in blocks.items():
+                        self._blocks[ip] = max(until, self._blocks.get(ip, 0.0))
+            if now >= self._next_cleanup_at:
+                self._next_cleanup_at = now + self.window_seconds
+                cursor.execute(
+                    "DELETE FROM admin_auth_failures WHERE bucket_start < %s LIMIT 10000",
+                    (now - 2 * self.window_seconds,),
+                )
+                cursor.execute(
+                    "DELETE FROM admin_ip_blocks WHERE blocked_until < %s LIMIT 10000",
+                    (now,),
+                )
+
+    def _refresh_blocks(self, conn, now: float) -> None:
+        max_blocked = int(os.getenv("ADMIN_SECURITY_MAX_BLOCKED_IPS", "10000"))
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT ip, blocked_until FROM admin_ip_blocks
+                WHERE blocked_until > %s
+                ORDER BY blocked_until DESC
+                LIMIT %s
+                """,
+                (now, max_blocked),
+            )
+            blocks = {row["ip"]: float(row["blocked_until"]) for row in cursor.fetchall()}
+        with self._lock:
+            # Giữ block cục bộ chưa flush
+            for ip, until in self._pending_blocks.items():
+                blocks[ip] = max(until, blocks.get(ip, 0.0))
+            self._blocks = blocks
+
+    def stats(self, now: float) -> Dict:
+        self._next_flush_at = 0.0
+        self._maybe_sync(now)
+        conn = self._get_db_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "SELECT COUNT(*) AS blocked FROM admin_ip_blocks WHERE blocked_until > %s",
+                    (now,),
+                )
+                blocked = int(cursor.fetchone()["blocked"])
+                cursor.execute(
+                    """
+                    SELECT COALESCE(SUM(attempts), 0) AS attempts, COUNT(DISTINCT ip) AS ips
+                    FROM admin_auth_failures
+                    WHERE bucket_start > %s
+                    """,
+                    (now - self.window_seconds,),
+                )
+                row = cursor.fetchone()
+        finally:
+            conn.close()
+        return {
+            "blocked_ips_count": blocked,
+            "total_failed_attempts": int(row["attempts"]),
+            "unique_ips_with_failures": int(row["ips"]),
+        }
+
+
+_BACKENDS = {
+    "shm": ShmSecurityStorage,
+    "mysql": MySQLSecurityStorage,
+}
+
+
+def create_storage(window_seconds: float, buckets: int, block_seconds: float, max_attempts: int):
+    """Backend theo ADMIN_SECURITY_STORAGE; None nếu dùng memory (mỗi process tự quản)"""
+    backend = _BACKENDS.get(os.getenv("ADMIN_SECURITY_STORAGE", "memory").lower())
+    if backend is None:
+        return None
+    return backend(window_seconds, buckets, block_seconds, max_attempts)
@@ -0,0 +1,346 @@
+"""
+Admin Stats - Số liệu tổng quan cho /admin/stats từ counter đã materialize
+
+Dashboard admin auto-refresh; trước đây mỗi lần gọi chạy GROUP BY tier trên api_keys
+và SUM(request_count) trên api_usage (quét toàn bảng). Giờ:
+- Số key theo tier nằm trong api_key_tier_counters, cập nhật bằng delta trong cùng transaction
+  với write path (tạo key, vô hiệu hóa, xóa key, xóa user).
+- Request/response/lỗi theo phút nằm trong request_minute_stats: mỗi worker gom trong RAM
+  (log_request đếm request được ghi usage, log của /v1/cccd/parse đếm response + lỗi status >= 400)
+  và flush theo batch mỗi ADMIN_STATS_FLUSH_SECONDS.
+- get_overview() cache kết quả trong RAM ADMIN_STATS_CACHE_SECONDS, kèm series requests/phút
+  và error rate ADMIN_STATS_SERIES_MINUTES phút gần nhất.
+
+Thiếu bảng → /admin/stats query trực tiếp như trước (vẫn cache theo TTL).
+Seed/đồng bộ lại counter key: flask --app run rebuild-admin-stats
+
+    CREATE TABLE api_key_tier_counters (
+        tier VARCHAR(16) PRIMARY KEY,
+        total_keys BIGINT NOT NULL DEFAULT 0,
+        active_keys BIGINT NOT NULL DEFAULT 0
+    );
+    CREATE TABLE request_minute_stats (
+        minute_start DATETIME PRIMARY KEY,
+        requests INT NOT NULL DEFAULT 0,
+        responses INT NOT NULL DEFAULT 0,
+        errors INT NOT NULL DEFAULT 0
+    );
+"""
+from __future__ import annotations
+
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Optional
+
+from services import db_router, schema_registry
+
+logger = logging.getLogger(__name__)
+
+_FIELDS = ("requests", "responses", "errors")
+
+_lock = threading.Lock()
+# (minute_start, field) → số lần, chờ flush
+_pending: Counter = Counter()
+_state = {
+    "flush_pid": None,
+    "pruned_at": 0.0,
+}
+_cache = {
+    "expires_at": 0.0,
+    "value": None,
+}
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except ValueError:
+        return default
+
+
+def _counters_enabled() -> bool:
+    return schema_registry.has_table("api_key_tier_counters")
+
+
+def _minutes_enabled() -> bool:
+    return schema_registry.has_table("request_minute_stats")
+
+
+# ===== Counter số key (gọi trong transaction của write path) =====
+
+def _apply_key_delta(cursor, tier: str, total: int, active: int) -> None:
+    cursor.execute(
+        """
+        INSERT INTO api_key_tier_counters (tier, total_keys, active_keys)
+        VALUES (%s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            total_keys = total_keys + VALUES(total_keys),
+            active_keys = active_keys + VALUES(active_keys)
+        """,
+        (tier, total, active),
+    )
+
+
+def record_key_created(cursor, tier: str) -> None:
+    """Sau INSERT một key mới (active)"""
+    if _counters_enabled():
+        _apply_key_delta(cursor, tier, 1, 1)
+
+
+def record_keys_removed(cursor, where: str, params: tuple, deleting: bool) -> None:
+    """
+    Gọi TRƯỚC khi UPDATE active = FALSE (deleting=False) hoặc DELETE (deleting=True)
+    các key khớp `where`: trừ counter theo tier của chính các row đó
+    """
+    if not _counters_enabled():
+        return
+    cursor.execute(
+        f"""
+        SELECT tier, COUNT(*) AS total, COALESCE(SUM(active), 0) AS active
+        FROM api_keys
+        WHERE {where}
+        GROUP BY tier
+        FOR UPDATE
+        """,
+        params,
+    )
+    for row in cursor.fetchall():
+        total = -int(row["total"]) if deleting else 0
+        active = -int(row["active"])
+        if total or active:
+            _apply_key_delta(cursor, row["tier"], total, active)
+
+
+def record_keys_restored(cursor, where: str, params: tuple) -> None:
+    """Gọi TRƯỚC khi UPDATE active = TRUE các key khớp `where`: cộng counter active theo tier"""
+    if not _counters_enabled():
+        return
+    cursor.execute(
+        f"""
+        SELECT tier, COUNT(*) AS restored
+        FROM api_keys
+        WHERE {where} AND active = FALSE
+        GROUP BY tier
+        FOR UPDATE
+        """,
+        params,
+    )
+    for row in cursor.fetchall():
+        _apply_key_delta(cursor, row["tier"], 0, int(row["restored"]))
+
+
+def rebuild_key_counters() -> dict:
+    """Tính lại counter từ api_keys (seed lần đầu hoặc sau khi sửa dữ liệu bằng tay)"""
+    conn = db_router.get_primary_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("DELETE FROM api_key_tier_counters")
+            cursor.execute(
+                """
+                INSERT INTO api_key_tier_counters (tier, total_keys, active_keys)
+                SELECT tier, COUNT(*), COALESCE(SUM(active), 0)
+                FROM api_keys
+                GROUP BY tier
+                """
+            )
+            cursor.execute("SELECT tier, total_keys, active_keys FROM api_key_tier_counters")
+            rows = cursor.fetchall()
+        conn.commit()
+    finally:
+        conn.close()
+    invalidate_cache()
+    return {r["tier"]: {"total": int(r["total_keys"]), "active": int(r["active_keys"])} for r in rows}
+
+
+# ===== Request theo phút (gom trong RAM, flush theo batch) =====
+
+def _minute_start(now: Optional[float] = None) -> datetime:
+    return datetime.fromtimestamp(now if now is not None else time.time()).replace(second=0, microsecond=0)
+
+
+def _record(field: str) -> None:
+    with _lock:
+        _pending[(_minute_start(), field)] += 1
+    if _state["flush_pid"] != os.getpid():
+        start()
+
+
+def record_request() -> None:
+    """Một request đã được ghi usage (log_request)"""
+    _record("requests")
+
+
+def record_response(status_code: int) -> None:
+    """Một response của /v1/cccd/parse; status >= 400 tính là lỗi"""
+    _record("responses")
+    if status_code >= 400:
+        _record("errors")
+
+
+def flush() -> int:
+    """Ghi các counter đang chờ vào request_minute_stats; trả về số phút đã ghi"""
+    with _lock:
+        pending = dict(_pending)
+        _pending.clear()
+    if not pending:
+        return 0
+
+    rows: dict[datetime, list[int]] = {}
+    for (minute, field), count in pending.items():
+        rows.setdefault(minute, [0, 0, 0])[_FIELDS.index(field)] += count
+    try:
+        if not _minutes_enabled():
+            return 0
+        conn = db_router.get_primary_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.executemany(
+                    """
+                    INSERT INTO request_minute_stats (minute_start, requests, responses, errors)
+                    VALUES (%s, %s, %s, %s)
+                    ON DUPLICATE KEY UPDATE
+                        requests = requests + VALUES(requests),
+                        responses = responses + VALUES(responses),
+                        errors = errors + VALUES(errors)
+                    """,
+                    [(minute, *counts) for minute, counts in sorted(rows.items())],
+                )
+                if time.monotonic() - _state["pruned_at"] > 3600:
+                    cursor.execute(
+                        "DELETE FROM request_minute_stats WHERE minute_start < NOW() - INTERVAL %s DAY LIMIT 10000",
+                        (int(_env_float("ADMIN_STATS_RETENTION_DAYS", 7)),),
+                    )
+                    _state["pruned_at"] = time.monotonic()
+            conn.commit()
+        finally:
+            conn.close()
+    except Exception:
+        # Giữ lại để flush lần sau
+        with _lock:
+            _pending.update(pending)
+        raise
+    return len(rows)
+
+
+def _flush_loop() -> None:
+    while True:
+        time.sleep(_env_float("ADMIN_STATS_FLUSH_SECONDS", 5.0))
+        try:
+            flush()
+        except Exception as e:
+            logger.warning(f"admin_stats_flush_failed | {type(e).__name__}: {e}")
+
+
+def start() -> None:
+    """Chạy thread flush (mỗi process một thread)"""
+    if _state["flush_pid"] == os.getpid():
+        return
+    with _lock:
+        if _state["flush_pid"] == os.getpid():
+            return
+        _state["flush_pid"] = os.getpid()
+    threading.Thread(target=_flush_loop, name="admin-stats-flush", daemon=True).start()
+
+
+# ===== Đọc (cho /admin/stats) =====
+
+def _load_tiers(cursor) -> dict:
+    if _counters_enabled():
+        cursor.execute("SELECT tier, total_keys, active_keys FROM api_key_tier_counters")
+        return {r["tier"]: {"total": int(r["total_keys"]), "active": int(r["active_keys"])} for r in cursor.fetchall()}
+    cursor.execute(
+        """
+        SELECT
+            tier,
+            COUNT(*) as total_keys,
+            SUM(active) as active_keys
+        FROM api_keys
+        GROUP BY tier
+        """
+    )
+    return {r["tier"]: {"total": r["total_keys"], "active": r["active_keys"]} for r in cursor.fetchall()}
+
+
+def _load_minutes(cursor, minutes: int) -> tuple[int, list[dict]]:
+    """(requests hôm nay, series theo phút) từ request_minute_stats"""
+    now = _minute_start()
+    since = now - timedelta(minutes=minutes - 1)
+    cursor.execute(
+        "SELECT COALESCE(SUM(requests), 0) AS total FROM request_minute_stats WHERE minute_start >= %s",
+        (now.replace(hour=0, minute=0),),
+    )
+    requests_today = int(cursor.fetchone()["total"])
+    cursor.execute(
+        """
+        SELECT minute_start, requests, responses, errors
+        FROM request_minute_stats
+        WHERE minute_start >= %s
+        ORDER BY minute_start
+        """,
+        (since,),
+    )
+    by_minute = {r["minute_start"]: r for r in cursor.fetchall()}
+    series = []
+    for i in range(minutes):
+        minute = since + timedelta(minutes=i)
+        row = by_minute.get(minute) or {}
+        responses = int(row.get("responses") or 0)
+        errors = int(row.get("errors") or 0)
+        series.append({
+            "minute": minute.isoformat(),
+            "requests": int(row.get("requests") or 0),
+            "responses": responses,
+            "errors": errors,
+            "error_rate": round(errors / responses, 4) if responses else 0.0,
+        })
+    return requests_today, series
+
+
+def get_overview() -> dict:
+    """Số liệu /admin/stats, cache ADMIN_STATS_CACHE_SECONDS trong RAM"""
+    now = time.monotonic()
+    cached = _cache["value"]
+    if cached is not None and now < _cache["expires_at"]:
+        return cached
+
+    minutes = max(1, int(_env_float("ADMIN_STATS_SERIES_MINUTES", 60)))
+    conn = db_router.get_read_connection()
+    try:
+        with conn.cursor() as cursor:
+            tiers = _load_tiers(cursor)
+            if _minutes_enabled():
+                requests_today, series = _load_minutes(cursor, minutes)
+            else:
+                cursor.execute(
+                    """
+                    SELECT SUM(request_count) as total
+                    FROM api_usage
+                    WHERE request_date = CURDATE()
+                    """
+                )
+                requests_today = cursor.fetchone()["total"] or 0
+                series = []
+    finally:
+        conn.close()
+
+    # Phút hiện tại chưa trọn → requests/phút lấy phút đủ gần nhất
+    recent = series[-5:]
+    responses = sum(p["responses"] for p in recent)
+    value = {
+        "tiers": tiers,
+        "requests_today": requests_today,
+        "requests_per_minute": series[-2 if len(series) > 1 else -1]["requests"] if series else None,
+        "error_rate": round(sum(p["errors"] for p in recent) / responses, 4) if responses else (0.0 if recent else None),
+        "series": series,
+    }
+    _cache["value"] = value
+    _cache["expires_at"] = now + _env_float("ADMIN_STATS_CACHE_SECONDS", 10.0)
+    return value
+
+
+def invalidate_cache() -> None:
+    _cache["expires_at"] = 0.0
@@ -0,0 +1,135 @@
+"""
+Admission Control - Load shedding theo tier khi worker quá tải (vd: MySQL chậm làm thread dồn ứ)
+
+- Đo 2 tín hiệu của worker:
+  + in-flight: số request /v1/cccd/parse đang xử lý (mọi thread trong worker)
+  + queueing delay: thời gian request chờ trước khi tới app, từ header X-Request-Start
+    của nginx/load balancer ("t=<epoch giây|ms|µs>"), làm mượt bằng EWMA
+- load = max(in_flight / ADMISSION_MAX_IN_FLIGHT, queue_delay / ADMISSION_TARGET_QUEUE_DELAY_MS)
+- Quá tải → shed free trước (load ≥ ADMISSION_SHED_FREE_AT), rồi premium (≥ ADMISSION_SHED_PREMIUM_AT);
+  ultra không bao giờ bị shed. Request bị shed nhận 503 + Retry-After trước mọi thao tác DB.
+- Tier xác định từ prefix của key (free_/prem_/ultr_, xem generate_api_key) nên không tốn DB lookup;
+  key giả prefix vẫn bị từ chối ở bước validate.
+"""
+from __future__ import annotations
+
+import os
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass
+from typing import Optional
+
+_EWMA_ALPHA = 0.2
+
+_PREFIX_TIERS = {"free": "free", "prem": "premium", "ultr": "ultra"}
+
+_lock = threading.Lock()
+_state = {
+    "in_flight": 0,
+    "queue_delay_ms": 0.0,
+}
+_admitted: Counter = Counter()
+_shed: Counter = Counter()
+
+
+@dataclass
+class AdmissionDecision:
+    admitted: bool
+    tier: str
+    load: float
+    retry_after: int = 0
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except ValueError:
+        return default
+
+
+def _thresholds() -> dict:
+    return {
+        "max_in_flight": _env_float("ADMISSION_MAX_IN_FLIGHT", 50),
+        "target_queue_delay_ms": _env_float("ADMISSION_TARGET_QUEUE_DELAY_MS", 200),
+        "shed_free_at": _env_float("ADMISSION_SHED_FREE_AT", 0.7),
+        "shed_premium_at": _env_float("ADMISSION_SHED_PREMIUM_AT", 0.9),
+    }
+
+
+def tier_from_key(api_key: Optional[str]) -> str:
+    """Tier theo prefix của key; không có key / prefix lạ → xếp như free"""
+    if not api_key:
+        return "free"
+    return _PREFIX_TIERS.get(api_key.split("_", 1)[0], "free")
+
+
+def parse_request_start(header: Optional[str], now: Optional[float] = None) -> Optional[float]:
+    """Queueing delay (ms) từ X-Request-Start; None nếu header thiếu/không hợp lệ"""
+    if not header:
+        return None
+    value = header.strip()
+    if value.startswith("t="):
+        value = value[2:]
+    try:
+        started = float(value)
+    except ValueError:
+        return None
+    # nginx $msec là giây; một số proxy gửi ms hoặc µs
+    if started > 1e14:
+        started /= 1e6
+    elif started > 1e11:
+        started /= 1e3
+    delay_ms = ((now or time.time()) - started) * 1000.0
+    return delay_ms if delay_ms >= 0 else None
+
+
+def _current_load(thresholds: dict) -> float:
+    return max(
+        _state["in_flight"] / thresholds["max_in_flight"],
+        _state["queue_delay_ms"] / thresholds["target_queue_delay_ms"],
+    )
+
+
+def admit(api_key: Optional[str], queue_delay_ms: Optional[float] = None) -> AdmissionDecision:
+    """
+    Quyết định nhận/shed request. Request được nhận phải gọi release() khi xong.
+    """
+    tier = tier_from_key(api_key)
+    thresholds = _thresholds()
+    with _lock:
+        if queue_delay_ms is not None:
+            _state["queue_delay_ms"] += _EWMA_ALPHA * (queue_delay_ms - _state["queue_delay_ms"])
+        load = _current_load(thresholds)
+
+        shed_at = {
+            "free": thresholds["shed_free_at"],
+            "premium": thresholds["shed_premium_at"],
+        }.get(tier)
+        if shed_at is not None and load >= shed_at:
+            _shed[tier] += 1
+            return AdmissionDecision(False, tier, load, retry_after=1 if tier == "premium" else 5)
+
+        _state["in_flight"] += 1
+        _admitted[tier] += 1
+    return AdmissionDecision(True, tier, load)
+
+
+def release() -> None:
+    with _lock:
+        _state["in_flight"] = max(0, _state["in_flight"] - 1)
+
+
+def get_metrics() -> dict:
+    """Metrics của worker hiện tại (cho admin monitoring)"""
+    thresholds = _thresholds()
+    with _lock:
+        return {
+            "pid": os.getpid(),
+            "load": round(_current_load(thresholds), 3),
+            "in_flight": _state["in_flight"],
+            "queue_delay_ms": round(_state["queue_delay_ms"], 1),
+            "thresholds": thresholds,
+            "admitted": dict(_admitted),
+            "shed": dict(_shed),
+        }
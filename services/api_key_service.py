@@ -4,13 +4,20 @@ API Key Service - Quản lý API key với MySQL và SHA256 hash
 from __future__ import annotations
 
 import hashlib
+import os
 import secrets
+import threading
+import time
+from collections import OrderedDict
 from dataclasses import dataclass
 from datetime import datetime
 from typing import Literal
 
 import pymysql
 
+from services import admin_stats, change_log, db_router, deadline, expiry_sweeper, key_snapshot, schema_registry, signed_keys
+from services.circuit_breaker import CLOSED, CircuitBreaker, CircuitOpenError
+
 TierType = Literal["free", "premium", "ultra"]
 
 # Rate limits per tier (requests per minute)
@@ -20,6 +27,13 @@ TIER_RATE_LIMITS = {
     "ultra": "1000 per minute",
 }
 
+# Số request xử lý đồng thời (in-flight) tối đa per key
+TIER_CONCURRENCY_LIMITS = {
+    "free": 2,
+    "premium": 10,
+    "ultra": 50,
+}
+
 
 @dataclass
 class APIKeyInfo:
@@ -32,9 +46,19 @@ class APIKeyInfo:
     rate_limit: str
 
 
+def _is_expired(expires_at: datetime | None) -> bool:
+    """Expiry sweeper đang quản lý hết hạn → key hết hạn đã bị tắt (active = FALSE), không cần so sánh"""
+    if expires_at is None or expiry_sweeper.trust_active_flag():
+        return False
+    return datetime.now() > expires_at
+
+
+class AuthServiceUnavailable(Exception):
+    """MySQL không phản hồi (breaker mở) và key không có trong last-known-good"""
+
+
 def _get_db_connection():
     """Tạo connection MySQL từ environment variables"""
-    import os
     return pymysql.connect(
         host=os.getenv("MYSQL_HOST", "localhost"),
         port=int(os.getenv("MYSQL_PORT", "3306")),
@@ -42,9 +66,93 @@ def _get_db_connection():
         password=os.getenv("MYSQL_PASSWORD", ""),
         database=os.getenv("MYSQL_DATABASE", "cccd_api"),
         cursorclass=pymysql.cursors.DictCursor,
+        **deadline.db_timeouts(),
+    )
+
+
+def _get_auth_db_connection():
+    """Connection cho auth lookup trên parse path: có timeout để không treo thread khi MySQL stall"""
+    timeout = deadline.bounded(float(os.getenv("AUTH_DB_TIMEOUT_SECONDS", "2")))
+    return pymysql.connect(
+        host=os.getenv("MYSQL_HOST", "localhost"),
+        port=int(os.getenv("MYSQL_PORT", "3306")),
+        user=os.getenv("MYSQL_USER", "root"),
+        password=os.getenv("MYSQL_PASSWORD", ""),
+        database=os.getenv("MYSQL_DATABASE", "cccd_api"),
+        cursorclass=pymysql.cursors.DictCursor,
+        connect_timeout=timeout,
+        read_timeout=timeout,
+        write_timeout=timeout,
     )
 
 
+# ===== Circuit breaker + last-known-good cho auth lookup =====
+# Breaker mở khi MySQL lỗi liên tiếp; trong lúc đó key đã validate thành công gần đây
+# (trong AUTH_LKG_MAX_STALENESS_SECONDS) vẫn được phục vụ từ bảng last-known-good.
+_auth_breaker: CircuitBreaker | None = None
+_last_known_good: "OrderedDict[str, tuple[APIKeyInfo, float]]" = OrderedDict()
+_lkg_lock = threading.Lock()
+
+
+def _get_auth_breaker() -> CircuitBreaker:
+    global _auth_breaker
+    if _auth_breaker is None:
+        _auth_breaker = CircuitBreaker(
+            "auth_db",
+            failure_threshold=int(os.getenv("AUTH_BREAKER_FAILURE_THRESHOLD", "5")),
+            open_seconds=float(os.getenv("AUTH_BREAKER_OPEN_SECONDS", "30")),
+        )
+    return _auth_breaker
+
+
+def _lkg_put(key_hash: str, info: APIKeyInfo) -> None:
+    max_entries = int(os.getenv("AUTH_LKG_MAX_ENTRIES", "10000"))
+    with _lkg_lock:
+        _last_known_good[key_hash] = (info, time.time())
+        _last_known_good.move_to_end(key_hash)
+        while len(_last_known_good) > max_entries:
+            _last_known_good.popitem(last=False)
+
+
+def _lkg_get(key_hash: str) -> APIKeyInfo | None:
+    max_staleness = float(os.getenv("AUTH_LKG_MAX_STALENESS_SECONDS", "900"))
+    with _lkg_lock:
+        entry = _last_known_good.get(key_hash)
+    if entry is None or time.time() - entry[1] > max_staleness:
+        return None
+    return entry[0]
+
+
+def _lkg_forget(key_hash: str | None = None, key_id: int | None = None) -> None:
+    with _lkg_lock:
+        if key_hash is not None:
+            _last_known_good.pop(key_hash, None)
+        if key_id is not None:
+            for cached_hash in [h for h, (info, _) in _last_known_good.items() if info.id == key_id]:
+                del _last_known_good[cached_hash]
+
+
+def _on_keys_changed(entity_ids: list[str | None]) -> None:
+    """Change-log scope api_key: key bị đổi ở worker/node khác → bỏ bản last-known-good"""
+    if None in entity_ids:
+        with _lkg_lock:
+            _last_known_good.clear()
+        return
+    for key_id in entity_ids:
+        _lkg_forget(key_id=int(key_id))
+
+
+change_log.subscribe("api_key", _on_keys_changed)
+
+
+def get_auth_status() -> dict:
+    """Trạng thái breaker + kích thước bảng last-known-good (cho admin monitoring)"""
+    status = _get_auth_breaker().get_status()
+    status["last_known_good_entries"] = len(_last_known_good)
+    status["key_snapshot"] = key_snapshot.get_status()
+    return status
+
+
 def _hash_key(api_key: str) -> str:
     """Hash API key bằng SHA256"""
     return hashlib.sha256(api_key.encode()).hexdigest()
@@ -95,10 +203,23 @@ def create_api_key(
                 """,
                 (key_hash, key_prefix, tier, owner_email, expires_at, user_id),
             )
+            key_id = cursor.lastrowid
+            admin_stats.record_key_created(cursor, tier)
+            if signed_keys.is_enabled():
+                # Signed key cần key_id → insert trước, rồi thay hash/prefix trong cùng transaction
+                api_key = signed_keys.issue(key_prefix.split("_", 1)[0], key_id, expires_at)
+                cursor.execute(
+                    "UPDATE api_keys SET key_hash = %s, key_prefix = %s WHERE id = %s",
+                    (_hash_key(api_key), api_key[:12], key_id),
+                )
         conn.commit()
     finally:
         conn.close()
     
+    key_snapshot.upsert(_hash_key(api_key), key_id, tier, expires_at)
+    # Read-your-writes: trang keys/usage ngay sau đó phải thấy key mới
+    db_router.mark_write(f"user:{user_id}" if user_id else None)
+    
     return api_key
 
 
@@ -106,10 +227,108 @@ def get_key_info(api_key: str) -> APIKeyInfo | None:
     """
     Tra cứu thông tin key từ database
     Returns: APIKeyInfo hoặc None nếu không tìm thấy
+    
+    Thứ tự: signed key (HMAC) → key snapshot trong RAM → database.
+    MySQL lỗi/breaker mở → trả bản last-known-good nếu còn trong staleness window,
+    ngược lại raise AuthServiceUnavailable (fail fast thay vì treo thread).
+    Trong request, kết quả được memoize trên g: rate limit, concurrency limit, validate và
+    log_request của cùng một request chỉ tra 1 lần.
     """
+    from flask import g, has_request_context
+    if not has_request_context():
+        return _lookup_key_info(api_key)
+    memo = g.setdefault("key_info_memo", {})
+    if api_key not in memo:
+        memo[api_key] = _lookup_key_info(api_key)
+    return memo[api_key]
+
+
+def _forget_request_memo(api_key: str) -> None:
+    from flask import g, has_request_context
+    if has_request_context():
+        g.get("key_info_memo", {}).pop(api_key, None)
+
+
+def _lookup_key_info(api_key: str) -> APIKeyInfo | None:
+    signed_info = _get_signed_key_info(api_key)
+    if signed_info is not None:
+        return signed_info
+    
     key_hash = _hash_key(api_key)
+    if key_snapshot.is_ready():
+        entry = key_snapshot.lookup(key_hash)
+        if entry is not None:
+            key_id, tier, expires_at = entry
+            return APIKeyInfo(
+                id=key_id,
+                key_prefix=api_key[:12],
+                tier=tier,
+                owner_email="",  # Snapshot không giữ email; parse path không dùng
+                active=True,
+                expired=_is_expired(expires_at),
+                rate_limit=TIER_RATE_LIMITS.get(tier, "10 per minute"),
+            )
+        if key_snapshot.is_authoritative():
+            return None
     
-    conn = _get_db_connection()
+    breaker = _get_auth_breaker()
+    
+    if breaker.allow_request():
+        try:
+            info = _query_key_info(key_hash)
+        except deadline.DeadlineExceeded:
+            breaker.record_ignored()
+            raise
+        except (pymysql.err.MySQLError, OSError) as e:
+            if deadline.expired():
+                # Timeout do request hết deadline, không phải MySQL lỗi → không tính vào breaker
+                breaker.record_ignored()
+                raise deadline.DeadlineExceeded(str(e)) from e
+            breaker.record_failure()
+            error: Exception = e
+        else:
+            breaker.record_success()
+            if info and info.active and not info.expired:
+                _lkg_put(key_hash, info)
+            else:
+                _lkg_forget(key_hash)
+            return info
+    else:
+        error = CircuitOpenError(f"circuit '{breaker.name}' is open")
+    
+    stale = _lkg_get(key_hash)
+    if stale is None:
+        raise AuthServiceUnavailable(str(error)) from error
+    return stale
+
+
+def _get_signed_key_info(api_key: str) -> APIKeyInfo | None:
+    """
+    Fast path cho signed key: verify HMAC + revocation list, không tra DB.
+    None → không dùng được fast path (key cũ, chữ ký sai, bị revoke, token hết hạn, revocation list cũ),
+    caller validate qua DB như key thường.
+    """
+    if not signed_keys.looks_signed(api_key):
+        return None
+    claims = signed_keys.verify(api_key)
+    # Token hết hạn: có thể hạn đã được gia hạn trong DB (thanh toán) → để DB quyết định
+    if claims is None or claims.expired:
+        return None
+    if not signed_keys.revocation_list_fresh() or signed_keys.is_revoked(claims.key_id):
+        return None
+    return APIKeyInfo(
+        id=claims.key_id,
+        key_prefix=claims.key_prefix,
+        tier=claims.tier,
+        owner_email="",  # Không có trong token; parse path không dùng
+        active=True,
+        expired=False,
+        rate_limit=TIER_RATE_LIMITS.get(claims.tier, "10 per minute"),
+    )
+
+
+def _query_key_info(key_hash: str) -> APIKeyInfo | None:
+    conn = _get_auth_db_connection()
     try:
         with conn.cursor() as cursor:
             cursor.execute(
@@ -127,18 +346,13 @@ def get_key_info(api_key: str) -> APIKeyInfo | None:
     if not row:
         return None
     
-    # Check expired
-    expired = False
-    if row["expires_at"]:
-        expired = datetime.now() > row["expires_at"]
-    
     return APIKeyInfo(
         id=row["id"],
         key_prefix=row["key_prefix"],
         tier=row["tier"],
         owner_email=row["owner_email"],
         active=row["active"],
-        expired=expired,
+        expired=_is_expired(row["expires_at"]),
         rate_limit=TIER_RATE_LIMITS.get(row["tier"], "10 per minute"),
     )
 
@@ -167,29 +381,62 @@ def validate_api_key(api_key: str) -> tuple[bool, str, APIKeyInfo | None]:
 
 def get_rate_limit_for_key(api_key: str) -> str:
     """Lấy rate limit string cho key (dùng với Flask-Limiter)"""
-    info = get_key_info(api_key)
+    try:
+        info = get_key_info(api_key)
+    except AuthServiceUnavailable:
+        info = None
     if info and info.active and not info.expired:
         return info.rate_limit
     return "10 per minute"  # Default cho invalid key
 
 
-def deactivate_key(api_key: str) -> bool:
-    """Vô hiệu hóa key"""
-    key_hash = _hash_key(api_key)
-    
+def get_concurrency_limit_for_key(api_key: str) -> int:
+    """Lấy số request đồng thời tối đa cho key"""
+    try:
+        info = get_key_info(api_key)
+    except AuthServiceUnavailable:
+        info = None
+    if info and info.active and not info.expired:
+        return TIER_CONCURRENCY_LIMITS.get(info.tier, 2)
+    return 2  # Default cho invalid key
+
+
+def _deactivate_where(where: str, params: tuple) -> list[int]:
+    """Vô hiệu hóa các key khớp điều kiện (counter, revocation list, change-log); trả về id các key bị tắt"""
+    key_ids: list[int] = []
     conn = _get_db_connection()
     try:
         with conn.cursor() as cursor:
-            cursor.execute(
-                "UPDATE api_keys SET active = FALSE WHERE key_hash = %s",
-                (key_hash,),
-            )
-            affected = cursor.rowcount
+            admin_stats.record_keys_removed(cursor, where, params, deleting=False)
+            # Vô hiệu hóa thủ công: xóa expired_at để duyệt thanh toán không bật lại key này
+            set_clause = "active = FALSE, expired_at = NULL" if schema_registry.has_column("api_keys", "expired_at") else "active = FALSE"
+            cursor.execute(f"UPDATE api_keys SET {set_clause} WHERE {where}", params)
+            if cursor.rowcount:
+                cursor.execute(f"SELECT id FROM api_keys WHERE {where}", params)
+                key_ids = [row["id"] for row in cursor.fetchall()]
+                signed_keys.record_revocations(cursor, key_ids, "deactivated")
+                change_log.publish(cursor, "api_key", key_ids)
         conn.commit()
     finally:
         conn.close()
-    
-    return affected > 0
+    return key_ids
+
+
+def deactivate_key(api_key: str) -> bool:
+    """Vô hiệu hóa key"""
+    key_hash = _hash_key(api_key)
+    key_ids = _deactivate_where("key_hash = %s", (key_hash,))
+    _lkg_forget(key_hash=key_hash)
+    _forget_request_memo(api_key)
+    return bool(key_ids)
+
+
+def deactivate_key_by_prefix(key_prefix: str) -> bool:
+    """Vô hiệu hóa key theo prefix (admin)"""
+    key_ids = _deactivate_where("key_prefix = %s", (key_prefix,))
+    for key_id in key_ids:
+        _lkg_forget(key_id=key_id)
+    return bool(key_ids)
 
 
 def deactivate_key_by_id(key_id: int, user_id: int) -> bool:
@@ -222,15 +469,7 @@ def delete_key_by_id(key_id: int, user_id: int) -> bool:
             
             # Log deletion in the same transaction (using same connection to avoid deadlock)
             try:
-                cursor.execute(
-                    """
-                    SELECT COUNT(*)
-                    FROM INFORMATION_SCHEMA.TABLES
-                    WHERE TABLE_SCHEMA = DATABASE()
-                    AND TABLE_NAME = 'api_key_history'
-                    """
-                )
-                if cursor.fetchone()["COUNT(*)"] > 0:
+                if schema_registry.has_table("api_key_history"):
                     cursor.execute(
                         """
                         INSERT INTO api_key_history (key_id, action, old_value, new_value, performed_by)
@@ -247,13 +486,20 @@ def delete_key_by_id(key_id: int, user_id: int) -> bool:
             # - DELETE api_key_history (CASCADE)
             # - DELETE api_usage (CASCADE)
             # - SET NULL request_logs.api_key_id (SET NULL)
+            admin_stats.record_keys_removed(cursor, "id = %s AND user_id = %s", (key_id, user_id), deleting=True)
             cursor.execute(
                 "DELETE FROM api_keys WHERE id = %s AND user_id = %s",
                 (key_id, user_id),
             )
             affected = cursor.rowcount
+            signed_keys.record_revocations(cursor, [key_id], "deleted")
+            change_log.publish(cursor, "api_key", [key_id])
             
         conn.commit()
+        db_router.mark_write(f"user:{user_id}")
+        _lkg_forget(key_id=key_id)
+        # Row đã bị xóa → delta sync không thấy; worker khác loại qua change log
+        key_snapshot.remove_ids([key_id])
     except Exception as e:
         try:
             conn.rollback()
@@ -274,21 +520,9 @@ def get_user_api_keys(user_id: int) -> list[dict]:
     conn = _get_db_connection()
     try:
         with conn.cursor() as cursor:
-            # Check if label column exists
-            cursor.execute(
-                """
-                SELECT COLUMN_NAME
-                FROM INFORMATION_SCHEMA.COLUMNS
-                WHERE TABLE_SCHEMA = DATABASE()
-                AND TABLE_NAME = 'api_keys'
-                AND COLUMN_NAME = 'label'
-                """
-            )
-            available_columns = {row["COLUMN_NAME"] for row in cursor.fetchall()}
-            
             # Build SELECT query based on available columns
             base_columns = "id, key_prefix, tier, owner_email, active, created_at, expires_at"
-            if "label" in available_columns:
+            if schema_registry.has_column("api_keys", "label"):
                 base_columns += ", label"
             
             cursor.execute(
@@ -333,13 +567,16 @@ def get_user_api_keys(user_id: int) -> list[dict]:
 
 def log_request(api_key: str):
     """Ghi nhận 1 request cho tracking usage"""
+    # MySQL đang lỗi (breaker không đóng) → bỏ qua ghi usage để parse path vẫn chạy
+    if _get_auth_breaker().state != CLOSED:
+        return
     info = get_key_info(api_key)
     if not info:
         return
     
     today = datetime.now().date()
     
-    conn = _get_db_connection()
+    conn = _get_auth_db_connection()
     try:
         with conn.cursor() as cursor:
             cursor.execute(
@@ -353,6 +590,7 @@ def log_request(api_key: str):
         conn.commit()
     finally:
         conn.close()
+    admin_stats.record_request()
 
 
 def get_usage_stats(api_key: str, days: int = 30) -> dict:
@@ -399,22 +637,13 @@ def get_usage_stats(api_key: str, days: int = 30) -> dict:
 
 def _log_key_history(key_id: int, action: str, old_value: str | None = None, new_value: str | None = None, performed_by: int | None = None):
     """Ghi lại lịch sử thay đổi của key"""
+    if not schema_registry.has_table("api_key_history"):
+        return  # Table doesn't exist yet
+    
     try:
         conn = _get_db_connection()
         try:
             with conn.cursor() as cursor:
-                # Check if table exists
-                cursor.execute(
-                    """
-                    SELECT COUNT(*)
-                    FROM INFORMATION_SCHEMA.TABLES
-                    WHERE TABLE_SCHEMA = DATABASE()
-                    AND TABLE_NAME = 'api_key_history'
-                    """
-                )
-                if cursor.fetchone()["COUNT(*)"] == 0:
-                    return  # Table doesn't exist yet
-                
                 cursor.execute(
                     """
                     INSERT INTO api_key_history (key_id, action, old_value, new_value, performed_by)
@@ -436,6 +665,9 @@ def update_key_label(key_id: int, user_id: int, label: str | None) -> tuple[bool
     if label and len(label) > 100:
         return False, "Label không được quá 100 ký tự"
     
+    if not schema_registry.has_column("api_keys", "label"):
+        return False, "Label feature chưa được kích hoạt"
+    
     conn = _get_db_connection()
     try:
         with conn.cursor() as cursor:
@@ -453,54 +685,31 @@ def update_key_label(key_id: int, user_id: int, label: str | None) -> tuple[bool
             if not key:
                 return False, "Key không tồn tại hoặc không thuộc về bạn"
             
-            # Check if label column exists
+            old_label = key.get("label")
             cursor.execute(
                 """
-                SELECT COLUMN_NAME
-                FROM INFORMATION_SCHEMA.COLUMNS
-                WHERE TABLE_SCHEMA = DATABASE()
-                AND TABLE_NAME = 'api_keys'
-                AND COLUMN_NAME = 'label'
-                """
+                UPDATE api_keys
+                SET label = %s
+                WHERE id = %s
+                """,
+                (label, key_id),
             )
-            has_label = cursor.fetchone() is not None
             
-            if has_label:
-                old_label = key.get("label")
-                cursor.execute(
-                    """
-                    UPDATE api_keys
-                    SET label = %s
-                    WHERE id = %s
-                    """,
-                    (label, key_id),
-                )
-                
-                # Log history using the same connection to avoid deadlock
-                try:
-                    # Check if api_key_history table exists
+            # Log history using the same connection to avoid deadlock
+            try:
+                if schema_registry.has_table("api_key_history"):
                     cursor.execute(
                         """
-                        SELECT COUNT(*)
-                        FROM INFORMATION_SCHEMA.TABLES
-                        WHERE TABLE_SCHEMA = DATABASE()
-                        AND TABLE_NAME = 'api_key_history'
-                        """
+                        INSERT INTO api_key_history (key_id, action, old_value, new_value, performed_by)
+                        VALUES (%s, %s, %s, %s, %s)
+                        """,
+                        (key_id, "label_updated", old_label, label, user_id),
                     )
-                    if cursor.fetchone()["COUNT(*)"] > 0:
-                        cursor.execute(
-                            """
-                            INSERT INTO api_key_history (key_id, action, old_value, new_value, performed_by)
-                            VALUES (%s, %s, %s, %s, %s)
-                            """,
-                            (key_id, "label_updated", old_label, label, user_id),
-                        )
-                except Exception:
-                    # Silently fail if history logging fails (non-critical)
-                    pass
-            else:
-                return False, "Label feature chưa được kích hoạt"
+            except Exception:
+                # Silently fail if history logging fails (non-critical)
+                pass
         conn.commit()
+        db_router.mark_write(f"user:{user_id}")
         return True, None
     except Exception as e:
         try:
@@ -8,6 +8,8 @@ from typing import Literal, Optional
 
 import pymysql
 
+from services import admin_stats, change_log, db_router, deadline, schema_registry, signed_keys
+
 TierType = Literal["free", "premium", "ultra"]
 
 
@@ -21,6 +23,7 @@ def _get_db_connection():
         password=os.getenv("MYSQL_PASSWORD", ""),
         database=os.getenv("MYSQL_DATABASE", "cccd_api"),
         cursorclass=pymysql.cursors.DictCursor,
+        **deadline.db_timeouts(),
     )
 
 
@@ -50,7 +53,7 @@ def has_pending_payment(user_id: int) -> bool:
 def get_user_payments(user_id: int, limit: int = 50) -> list[dict]:
     """Lấy lịch sử thanh toán của user"""
     try:
-        conn = _get_db_connection()
+        conn = db_router.get_read_connection(scope=f"user:{user_id}")
         try:
             with conn.cursor() as cursor:
                 cursor.execute(
@@ -162,6 +165,7 @@ def create_payment(
                 )
                 payment_id = cursor.lastrowid
             conn.commit()
+            db_router.mark_write(f"user:{user_id}")
         finally:
             conn.close()
         
@@ -239,6 +243,7 @@ def approve_payment(payment_id: int, user_id: int) -> bool:
                     return False, "Không thể update payment status (có thể đã được approve rồi)"
                 
             conn.commit()
+            db_router.mark_write(f"user:{user_id}")
             return True
         finally:
             conn.close()
@@ -388,21 +393,45 @@ def approve_payment_admin(payment_id: int) -> tuple[bool, Optional[str]]:
             # API keys sẽ có expires_at = subscription.expires_at (đồng bộ với subscription)
             # NOTE: api_keys table có cột 'active' (BOOLEAN), không phải 'status'
             _log_debug(f"[APPROVE PAYMENT] Đồng bộ API keys expiration với subscription expires_at={expires_at}")
-            cursor.execute(
-                """
-                UPDATE api_keys
-                SET expires_at = %s
-                WHERE user_id = %s 
-                AND active = TRUE
-                """,
-                (expires_at, user_id),
-            )
+            if schema_registry.has_column("api_keys", "expired_at"):
+                # Key bị expiry sweeper tắt (expired_at) được gia hạn và bật lại; key bị vô hiệu hóa thủ công thì không
+                admin_stats.record_keys_restored(cursor, "user_id = %s AND expired_at IS NOT NULL", (user_id,))
+                cursor.execute(
+                    """
+                    UPDATE api_keys
+                    SET expires_at = %s, active = TRUE, expired_at = NULL
+                    WHERE user_id = %s
+                    AND (active = TRUE OR expired_at IS NOT NULL)
+                    """,
+                    (expires_at, user_id),
+                )
+            else:
+                cursor.execute(
+                    """
+                    UPDATE api_keys
+                    SET expires_at = %s
+                    WHERE user_id = %s 
+                    AND active = TRUE
+                    """,
+                    (expires_at, user_id),
+                )
             keys_updated = cursor.rowcount
+            if keys_updated:
+                # expires_at trong signed key không còn đúng → validate các key này qua DB
+                cursor.execute(
+                    "SELECT id FROM api_keys WHERE user_id = %s AND active = TRUE",
+                    (user_id,),
+                )
+                key_ids = [row["id"] for row in cursor.fetchall()]
+                signed_keys.record_revocations(cursor, key_ids, "expiry_changed")
+                change_log.publish(cursor, "api_key", key_ids)
+            change_log.publish(cursor, "subscription", [user_id])
             _log_debug(f"[APPROVE PAYMENT] Đã đồng bộ {keys_updated} API key(s) với subscription expiration")
             
             # Commit transaction - QUAN TRỌNG: Phải commit để lưu thay đổi
             _log_debug(f"[APPROVE PAYMENT] 🔄 COMMIT transaction...")
             conn.commit()
+            db_router.mark_write(f"user:{user_id}")
             _log_debug(f"[APPROVE PAYMENT] ✅ COMMIT thành công!")
             
             # Verify sau commit (trong connection mới để đảm bảo thấy được data đã commit)
@@ -517,7 +546,9 @@ def manually_change_user_tier(user_id: int, target_tier: str, notes: Optional[st
                     """,
                     (user_id, target_tier),
                 )
+                change_log.publish(cursor, "subscription", [user_id])
             conn.commit()
+            db_router.mark_write(f"user:{user_id}")
             return True, f"Đã đổi tier user sang {target_tier}"
         finally:
             conn.close()
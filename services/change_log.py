@@ -0,0 +1,167 @@
+"""
+Change Log - Bus invalidate cache giữa các worker/node qua bảng change-log trong MySQL
+
+- Write path ghi (scope, entity_id) vào cache_invalidations trong cùng transaction (publish)
+- Mỗi worker poll bảng theo id tăng dần mỗi CHANGE_LOG_POLL_SECONDS (1 query theo PK)
+  và gọi handler đã subscribe cho scope đó → cache cục bộ bị evict sau tối đa vài giây,
+  không cần message broker.
+- entity_id None = evict toàn bộ scope.
+
+Scopes:
+    api_key       key_id   key bị xóa/vô hiệu hóa/đổi hạn (api_key_service, key_snapshot)
+    subscription  user_id  subscription/tier của user thay đổi
+    province      version  dữ liệu tỉnh/thành (province_mapping._CACHE)
+
+Thiếu bảng → publish bỏ qua, worker không poll (cache cục bộ như trước):
+    CREATE TABLE cache_invalidations (
+        id BIGINT AUTO_INCREMENT PRIMARY KEY,
+        scope VARCHAR(32) NOT NULL,
+        entity_id VARCHAR(64) NULL,
+        created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        INDEX idx_created_at (created_at)
+    );
+"""
+from __future__ import annotations
+
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from typing import Callable, Iterable, Optional
+
+from services import schema_registry
+
+logger = logging.getLogger(__name__)
+
+_BATCH_SIZE = 1000
+
+# handler(entity_ids) - entity_ids chứa None nếu evict toàn bộ scope
+_subscribers: dict[str, list[Callable[[list[Optional[str]]], None]]] = defaultdict(list)
+_state = {
+    "last_id": None,
+    "polled_at": 0.0,
+    "thread_pid": None,
+}
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except ValueError:
+        return default
+
+
+def _get_db_connection():
+    from services.api_key_service import _get_db_connection as get_connection
+    return get_connection()
+
+
+def is_enabled() -> bool:
+    return schema_registry.has_table("cache_invalidations")
+
+
+def subscribe(scope: str, handler: Callable[[list[Optional[str]]], None]) -> None:
+    if handler not in _subscribers[scope]:
+        _subscribers[scope].append(handler)
+
+
+def publish(cursor, scope: str, entity_ids: Iterable[object] = (None,)) -> None:
+    """Ghi invalidation trong transaction của write path (bỏ qua nếu chưa có bảng)"""
+    if not is_enabled():
+        return
+    rows = [(scope, None if entity_id is None else str(entity_id)) for entity_id in entity_ids]
+    if rows:
+        cursor.executemany(
+            "INSERT INTO cache_invalidations (scope, entity_id) VALUES (%s, %s)",
+            rows,
+        )
+
+
+def dispatch(scope: str, entity_ids: list[Optional[str]]) -> None:
+    """Gọi handler của scope; lỗi một handler không chặn handler khác"""
+    for handler in list(_subscribers.get(scope, ())):
+        try:
+            handler(entity_ids)
+        except Exception as e:
+            logger.warning(f"change_log_handler_failed | scope={scope} | {type(e).__name__}: {e}")
+
+
+def poll() -> int:
+    """Đọc các thay đổi mới và dispatch theo scope; trả về số row đã xử lý"""
+    processed = 0
+    conn = _get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            if _state["last_id"] is None:
+                # Worker mới khởi động: cache đang rỗng, không cần replay lịch sử
+                cursor.execute("SELECT COALESCE(MAX(id), 0) AS max_id FROM cache_invalidations")
+                _state["last_id"] = int(cursor.fetchone()["max_id"])
+            while True:
+                cursor.execute(
+                    "SELECT id, scope, entity_id FROM cache_invalidations WHERE id > %s ORDER BY id LIMIT %s",
+                    (_state["last_id"], _BATCH_SIZE),
+                )
+                rows = cursor.fetchall()
+                grouped: dict[str, list[Optional[str]]] = defaultdict(list)
+                for row in rows:
+                    grouped[row["scope"]].append(row["entity_id"])
+                for scope, entity_ids in grouped.items():
+                    dispatch(scope, entity_ids)
+                if rows:
+                    _state["last_id"] = int(rows[-1]["id"])
+                processed += len(rows)
+                if len(rows) < _BATCH_SIZE:
+                    break
+    finally:
+        conn.close()
+    _state["polled_at"] = time.monotonic()
+    return processed
+
+
+def _poll_loop() -> None:
+    while True:
+        try:
+            if is_enabled():
+                poll()
+        except Exception as e:
+            logger.warning(f"change_log_poll_failed | {type(e).__name__}: {e}")
+        time.sleep(_env_float("CHANGE_LOG_POLL_SECONDS", 1.0))
+
+
+def start() -> None:
+    """Chạy thread poll (mỗi process một thread; gọi lại sau fork sẽ tạo thread mới)"""
+    if _state["thread_pid"] == os.getpid():
+        return
+    _state["thread_pid"] = os.getpid()
+    _state["last_id"] = None
+    threading.Thread(target=_poll_loop, name="change-log-poll", daemon=True).start()
+
+
+def prune(older_than_hours: float) -> int:
+    """Xóa các row cũ (mọi worker đã poll qua); trả về số row đã xóa"""
+    deleted = 0
+    conn = _get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            while True:
+                cursor.execute(
+                    "DELETE FROM cache_invalidations WHERE created_at < NOW() - INTERVAL %s HOUR LIMIT 10000",
+                    (older_than_hours,),
+                )
+                conn.commit()
+                deleted += cursor.rowcount
+                if cursor.rowcount < 10000:
+                    break
+    finally:
+        conn.close()
+    return deleted
+
+
+def get_status() -> dict:
+    return {
+        "enabled": is_enabled() if schema_registry.is_loaded() else None,
+        "last_id": _state["last_id"],
+        "seconds_since_poll": round(time.monotonic() - _state["polled_at"], 1) if _state["polled_at"] else None,
+        "scopes": sorted(_subscribers),
+    }
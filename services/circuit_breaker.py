@@ -0,0 +1,89 @@
+"""
+Circuit Breaker - Ngắt nhanh các lời gọi tới dependency đang lỗi (vd: MySQL treo)
+
+- CLOSED: gọi bình thường; failure_threshold lỗi liên tiếp → OPEN
+- OPEN: từ chối ngay (không gọi dependency) trong open_seconds
+- HALF_OPEN: sau open_seconds cho 1 request thử; thành công → CLOSED, lỗi → OPEN lại
+"""
+from __future__ import annotations
+
+import threading
+import time
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """Breaker đang mở, lời gọi bị từ chối mà không chạm tới dependency"""
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, failure_threshold: int = 5, open_seconds: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+                return HALF_OPEN
+            return self._state
+
+    def allow_request(self) -> bool:
+        """True nếu được phép gọi dependency (ở HALF_OPEN chỉ 1 request thử tại một thời điểm)"""
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+            if self._state == OPEN and time.monotonic() - self._opened_at < self.open_seconds:
+                return False
+            if self._probe_in_flight:
+                return False
+            self._state = HALF_OPEN
+            self._probe_in_flight = True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._state = CLOSED
+            self._failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            self._probe_in_flight = False
+            if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+
+    def record_ignored(self) -> None:
+        """Lời gọi kết thúc vì lý do không phải lỗi của dependency (vd: request hết deadline)"""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def call(self, fn, *args, **kwargs):
+        """Gọi fn qua breaker; raise CircuitOpenError nếu breaker đang mở"""
+        if not self.allow_request():
+            raise CircuitOpenError(f"circuit '{self.name}' is open")
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            self.record_failure()
+            raise
+        self.record_success()
+        return result
+
+    def get_status(self) -> dict:
+        return {
+            "name": self.name,
+            "state": self.state,
+            "consecutive_failures": self._failures,
+        }
@@ -0,0 +1,143 @@
+"""
+Concurrency Limiter - Giới hạn số request đang xử lý đồng thời (in-flight) cho mỗi API key
+
+- Counter in-flight nằm trong SharedMemoryTable → áp dụng chung cho mọi thread và mọi worker
+  (RATE_LIMIT_STORAGE_URI=shm://; ngược lại chỉ trong process, xem cost_limiter.get_limiter_table).
+- Hết slot → chờ trong hàng đợi có giới hạn (CONCURRENCY_QUEUE_SIZE waiter/key/worker,
+  tối đa CONCURRENCY_QUEUE_TIMEOUT_MS), hàng đợi đầy hoặc hết thời gian chờ → 429 ngay.
+- Mỗi slot là 1 entry riêng (inflight:<key>:<i>, i < limit) với lease của chính request giữ nó
+  (CONCURRENCY_LEASE_SECONDS, không ngắn hơn deadline còn lại). Worker chết giữa request → slot
+  của nó tự hết hạn sau lease, kể cả khi key vẫn liên tục có traffic.
+- Chờ slot: được notify ngay khi thread cùng process trả slot; slot do worker khác trả chỉ thấy
+  được bằng poll, chu kỳ poll tăng dần (backoff) thay vì quay vòng dày đặc.
+"""
+from __future__ import annotations
+
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable, Optional
+
+from services import deadline
+from services.cost_limiter import get_limiter_table
+
+_waiters: dict[str, int] = defaultdict(int)
+_conditions: dict[str, threading.Condition] = {}
+_local_lock = threading.Lock()
+
+# Chu kỳ poll khi chờ (slot có thể được trả bởi worker khác, không notify được qua process):
+# bắt đầu _POLL_INITIAL, nhân đôi mỗi lần đến tối đa _POLL_MAX
+_POLL_INITIAL = 0.005
+_POLL_MAX = 0.05
+
+
+class ConcurrencyLimitExceeded(Exception):
+    def __init__(self, limit: int):
+        super().__init__(f"{limit} request đồng thời")
+        self.limit = limit
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except ValueError:
+        return default
+
+
+def _condition(key: str) -> threading.Condition:
+    with _local_lock:
+        cond = _conditions.get(key)
+        if cond is None:
+            cond = _conditions[key] = threading.Condition(threading.Lock())
+        return cond
+
+
+def _slot_key(key: str, index: int) -> str:
+    return f"inflight:{key}:{index}"
+
+
+def _try_acquire(key: str, limit: int) -> Optional[int]:
+    """Chiếm 1 slot trống (hoặc đã hết lease) của key; trả về index slot, None nếu hết slot"""
+    lease = max(_env_float("CONCURRENCY_LEASE_SECONDS", 60.0), deadline.remaining() or 0.0)
+
+    def _claim(entry, now):
+        if entry is not None:
+            return entry, False
+        return (1.0, 0.0, now + lease), True
+
+    table = get_limiter_table()
+    for index in range(limit):
+        if table.update(_slot_key(key, index), _claim):
+            return index
+    return None
+
+
+def _release(key: str, index: int) -> None:
+    get_limiter_table().delete(_slot_key(key, index))
+    cond = _conditions.get(key)
+    if cond is not None:
+        with cond:
+            cond.notify()
+
+
+@contextmanager
+def concurrency_slot(key: str, limit: int):
+    """Giữ 1 slot in-flight của key trong suốt block; raise ConcurrencyLimitExceeded nếu không có slot"""
+    index = _try_acquire(key, limit)
+    if index is None:
+        queue_size = int(_env_float("CONCURRENCY_QUEUE_SIZE", float(limit)))
+        # Thời gian chờ không vượt quá deadline còn lại của request
+        wait_until = time.monotonic() + deadline.bounded(_env_float("CONCURRENCY_QUEUE_TIMEOUT_MS", 100.0) / 1000.0)
+
+        with _local_lock:
+            if _waiters[key] >= queue_size:
+                raise ConcurrencyLimitExceeded(limit)
+            _waiters[key] += 1
+        try:
+            cond = _condition(key)
+            poll = _POLL_INITIAL
+            while index is None:
+                remaining = wait_until - time.monotonic()
+                if remaining <= 0:
+                    raise ConcurrencyLimitExceeded(limit)
+                with cond:
+                    cond.wait(timeout=min(remaining, poll))
+                poll = min(poll * 2, _POLL_MAX)
+                index = _try_acquire(key, limit)
+        finally:
+            with _local_lock:
+                _waiters[key] -= 1
+                if _waiters[key] <= 0:
+                    del _waiters[key]
+                    _conditions.pop(key, None)
+
+    try:
+        yield
+    finally:
+        _release(key, index)
+
+
+def concurrency_limited(limit: Callable[[], int], key_func: Optional[Callable[[], str]] = None):
+    """Decorator cho route: vượt giới hạn in-flight → 429 (qua errorhandler 429 của app)"""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            from werkzeug.exceptions import TooManyRequests
+
+            if key_func is None:
+                from app import _rate_limit_key
+                identity = _rate_limit_key()
+            else:
+                identity = key_func()
+            try:
+                with concurrency_slot(identity, limit()):
+                    return fn(*args, **kwargs)
+            except ConcurrencyLimitExceeded as e:
+                raise TooManyRequests(description=str(e), retry_after=1)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,114 @@
+"""
+Cost Limiter - Rate limit theo chi phí request (GCRA) thay cho "mỗi HTTP request = 1"
+
+- Mỗi endpoint khai báo cost (cố định hoặc tính từ request, vd: số ngày của query thống kê).
+- Budget lấy từ limit string ("100 per minute" trong TIER_RATE_LIMITS): capacity = 100 đơn vị,
+  hồi lại đều 1 đơn vị mỗi period/100 giây.
+- GCRA (Generic Cell Rate Algorithm): mỗi key chỉ lưu một số TAT (theoretical arrival time),
+  mỗi request là MỘT update nguyên tử bất kể cost lớn hay nhỏ.
+- State nằm trong SharedMemoryTable: RATE_LIMIT_STORAGE_URI=shm:// → dùng chung giữa các worker,
+  ngược lại bảng riêng của process (giống memory:// của Flask-Limiter).
+"""
+from __future__ import annotations
+
+import math
+import os
+import threading
+import urllib.parse
+from dataclasses import dataclass
+from functools import wraps
+from typing import Callable, Optional, Union
+
+from limits import parse as parse_limit
+
+from services.shared_memory import create_private_table, get_table
+
+CostType = Union[float, Callable[[], float]]
+LimitType = Union[str, Callable[[], str]]
+
+
+@dataclass
+class LimitResult:
+    allowed: bool
+    limit: int  # capacity (đơn vị cost)
+    remaining: int
+    retry_after: float = 0.0  # giây, khi allowed=False
+
+
+_private_table = None
+_private_lock = threading.Lock()
+
+
+def get_limiter_table():
+    """Bảng state của limiter: shm dùng chung nếu RATE_LIMIT_STORAGE_URI=shm://, ngược lại riêng process"""
+    global _private_table
+    uri = os.getenv("RATE_LIMIT_STORAGE_URI", "memory://")
+    if uri.startswith("shm://"):
+        return get_table(urllib.parse.urlparse(uri).path or None)
+    if _private_table is None:
+        with _private_lock:
+            if _private_table is None:
+                _private_table = create_private_table(16384)
+    return _private_table
+
+
+def acquire(key: str, cost: float, limit: str) -> LimitResult:
+    """
+    Trừ cost đơn vị khỏi budget của key theo GCRA.
+    Cost lớn hơn capacity được tính bằng capacity (request đắt nhất dùng hết burst).
+    """
+    item = parse_limit(limit)
+    capacity = item.amount
+    period = float(item.get_expiry())
+    emission_interval = period / capacity
+    cost = min(max(float(cost), 0.0), float(capacity))
+    increment = cost * emission_interval
+
+    def _gcra(entry, now):
+        tat = max(entry[0], now) if entry else now
+        new_tat = tat + increment
+        allow_at = new_tat - period
+        if allow_at > now:
+            remaining = int((period - (tat - now)) / emission_interval)
+            return entry, LimitResult(False, capacity, max(0, remaining), allow_at - now)
+        remaining = int((period - (new_tat - now)) / emission_interval)
+        # Sau new_tat state tương đương key mới → dùng làm thời điểm hết hạn
+        return (new_tat, 0.0, new_tat), LimitResult(True, capacity, max(0, remaining))
+
+    return get_limiter_table().update(f"gcra:{key}", _gcra)
+
+
+def cost_limited(limit: LimitType, cost: CostType = 1, key_func: Optional[Callable[[], str]] = None,
+                 scope: Optional[str] = None):
+    """
+    Decorator cho route: limit/cost có thể là giá trị hoặc hàm (gọi trong request context).
+    Vượt budget → 429 (qua errorhandler 429 của app) kèm Retry-After.
+    """
+    def decorator(fn):
+        limit_scope = scope or fn.__name__
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            from flask import g
+            from werkzeug.exceptions import TooManyRequests
+
+            if key_func is None:
+                from app import _rate_limit_key
+                identity = _rate_limit_key()
+            else:
+                identity = key_func()
+            limit_value = limit() if callable(limit) else limit
+            cost_value = cost() if callable(cost) else cost
+
+            result = acquire(f"{limit_scope}:{identity}", cost_value, limit_value)
+            g.rate_limit = result
+            if not result.allowed:
+                raise TooManyRequests(
+                    description=f"{limit_value} (chi phí request: {cost_value:g})",
+                    retry_after=max(1, math.ceil(result.retry_after)),
+                )
+            return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
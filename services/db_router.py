@@ -0,0 +1,220 @@
+"""
+DB Router - Điều hướng các query chỉ đọc (dashboard, thống kê, danh sách) sang MySQL replica
+
+- Replica cấu hình qua MYSQL_REPLICA_HOST (+ PORT/USER/PASSWORD/DATABASE, mặc định giống primary).
+  Không cấu hình replica → mọi thứ chạy trên primary như cũ.
+- Replica lag awareness: định kỳ đọc Seconds_Behind_Source; lag vượt MYSQL_REPLICA_MAX_LAG_SECONDS,
+  replication dừng hoặc replica không kết nối được → đọc từ primary.
+- Read-your-writes: write path gọi mark_write(scope) (vd: "user:12" sau create_api_key);
+  các lần đọc cùng scope trong MYSQL_REPLICA_STICKY_SECONDS sẽ đọc từ primary.
+"""
+from __future__ import annotations
+
+import logging
+import os
+import threading
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+import pymysql
+
+from services import deadline
+
+logger = logging.getLogger(__name__)
+
+# Sau khi replica lỗi, bỏ qua replica trong khoảng này rồi mới thử lại
+_REPLICA_FAILURE_BACKOFF_SECONDS = 30.0
+# Giới hạn số scope được nhớ trong process (tránh tăng memory vô hạn)
+_MAX_TRACKED_SCOPES = 10000
+
+_lock = threading.Lock()
+_recent_writes: dict[str, float] = {}
+# db_last_write_at của session, gắn cho thread không có request context (vd: thread của fan_out)
+_bound_last_write: ContextVar[Optional[float]] = ContextVar("bound_last_write", default=None)
+_replica_state = {
+    "healthy": True,
+    "lag_seconds": None,
+    "checked_at": 0.0,
+    "skip_until": 0.0,
+}
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except ValueError:
+        return default
+
+
+def _connect(host: str, port: int, user: str, password: str, database: str):
+    return pymysql.connect(
+        host=host,
+        port=port,
+        user=user,
+        password=password,
+        database=database,
+        cursorclass=pymysql.cursors.DictCursor,
+        **deadline.db_timeouts(),
+    )
+
+
+def get_primary_connection():
+    """Tạo connection tới MySQL primary (dùng cho ghi và read-your-writes)"""
+    return _connect(
+        host=os.getenv("MYSQL_HOST", "localhost"),
+        port=int(os.getenv("MYSQL_PORT", "3306")),
+        user=os.getenv("MYSQL_USER", "root"),
+        password=os.getenv("MYSQL_PASSWORD", ""),
+        database=os.getenv("MYSQL_DATABASE", "cccd_api"),
+    )
+
+
+def _replica_configured() -> bool:
+    return bool(os.getenv("MYSQL_REPLICA_HOST"))
+
+
+def _get_replica_connection():
+    return _connect(
+        host=os.getenv("MYSQL_REPLICA_HOST", ""),
+        port=int(os.getenv("MYSQL_REPLICA_PORT", os.getenv("MYSQL_PORT", "3306"))),
+        user=os.getenv("MYSQL_REPLICA_USER", os.getenv("MYSQL_USER", "root")),
+        password=os.getenv("MYSQL_REPLICA_PASSWORD", os.getenv("MYSQL_PASSWORD", "")),
+        database=os.getenv("MYSQL_REPLICA_DATABASE", os.getenv("MYSQL_DATABASE", "cccd_api")),
+    )
+
+
+def _read_replica_lag(conn) -> Optional[float]:
+    """Đọc lag của replica (giây). None nếu replication không chạy"""
+    with conn.cursor() as cursor:
+        try:
+            cursor.execute("SHOW REPLICA STATUS")  # MySQL 8.0.22+
+        except pymysql.err.ProgrammingError:
+            cursor.execute("SHOW SLAVE STATUS")
+        status = cursor.fetchone()
+    if not status:
+        return None
+    lag = status.get("Seconds_Behind_Source", status.get("Seconds_Behind_Master"))
+    return float(lag) if lag is not None else None
+
+
+def _mark_replica_failed(reason: str) -> None:
+    logger.warning(f"db_router | replica unavailable, using primary | reason={reason}")
+    with _lock:
+        _replica_state["healthy"] = False
+        _replica_state["skip_until"] = time.monotonic() + _REPLICA_FAILURE_BACKOFF_SECONDS
+
+
+def _replica_usable(conn) -> bool:
+    """Kiểm tra lag (cache MYSQL_REPLICA_LAG_CHECK_SECONDS) trên connection replica vừa mở"""
+    now = time.monotonic()
+    check_interval = _env_float("MYSQL_REPLICA_LAG_CHECK_SECONDS", 5.0)
+    max_lag = _env_float("MYSQL_REPLICA_MAX_LAG_SECONDS", 5.0)
+
+    if now - _replica_state["checked_at"] >= check_interval:
+        lag = _read_replica_lag(conn)
+        with _lock:
+            _replica_state["lag_seconds"] = lag
+            _replica_state["checked_at"] = now
+            _replica_state["healthy"] = lag is not None and lag <= max_lag
+
+    return _replica_state["healthy"]
+
+
+def _sticky_seconds() -> float:
+    return _env_float("MYSQL_REPLICA_STICKY_SECONDS", 10.0)
+
+
+def mark_write(scope: Optional[str]) -> None:
+    """
+    Ghi nhận vừa ghi dữ liệu cho scope (vd: "user:12") để các lần đọc tiếp theo
+    của scope này đi primary cho đến khi replica chắc chắn đã bắt kịp.
+
+    - Trong process: nhớ theo scope (mọi request đọc scope này trên worker hiện tại).
+    - Giữa các worker: chỉ khi scope là của chính user đang login (session["user_id"]) thì lưu
+      db_last_write_at vào Flask session. Admin ghi hộ user khác (duyệt thanh toán, tắt key)
+      không đánh dấu session của admin; user bị ảnh hưởng chỉ được sticky trên worker đã ghi.
+    """
+    if not scope:
+        return
+    now = time.time()
+    with _lock:
+        if len(_recent_writes) >= _MAX_TRACKED_SCOPES:
+            cutoff = now - _sticky_seconds()
+            for key in [k for k, ts in _recent_writes.items() if ts < cutoff]:
+                del _recent_writes[key]
+            if len(_recent_writes) >= _MAX_TRACKED_SCOPES:
+                _recent_writes.clear()
+        _recent_writes[scope] = now
+
+    try:
+        from flask import has_request_context, session
+        if has_request_context() and scope == f"user:{session.get('user_id')}":
+            session["db_last_write_at"] = now
+    except Exception:
+        pass
+
+
+def session_last_write() -> Optional[float]:
+    """Thời điểm ghi gần nhất của session hiện tại (db_last_write_at); None nếu không có"""
+    bound = _bound_last_write.get()
+    if bound is not None:
+        return bound
+    try:
+        from flask import has_request_context, session
+        if has_request_context():
+            return session.get("db_last_write_at")
+    except Exception:
+        pass
+    return None
+
+
+def bind_session_write(value: Optional[float]):
+    """Gắn db_last_write_at của request cho thread hiện tại; trả về token cho unbind_session_write()"""
+    return _bound_last_write.set(value)
+
+
+def unbind_session_write(token) -> None:
+    _bound_last_write.reset(token)
+
+
+def _recently_written(scope: Optional[str]) -> bool:
+    cutoff = time.time() - _sticky_seconds()
+    if scope and _recent_writes.get(scope, 0.0) >= cutoff:
+        return True
+    return (session_last_write() or 0.0) >= cutoff
+
+
+def get_read_connection(scope: Optional[str] = None):
+    """
+    Connection cho query chỉ đọc: replica nếu được cấu hình, khỏe và không lag quá ngưỡng,
+    ngược lại là primary.
+    """
+    if not _replica_configured() or _recently_written(scope):
+        return get_primary_connection()
+
+    if time.monotonic() < _replica_state["skip_until"]:
+        return get_primary_connection()
+
+    try:
+        conn = _get_replica_connection()
+    except Exception as e:
+        _mark_replica_failed(str(e))
+        return get_primary_connection()
+
+    try:
+        if _replica_usable(conn):
+            return conn
+    except Exception as e:
+        _mark_replica_failed(str(e))
+    conn.close()
+    return get_primary_connection()
+
+
+def get_replica_status() -> dict:
+    """Trạng thái replica (cho admin monitoring)"""
+    return {
+        "configured": _replica_configured(),
+        "healthy": _replica_state["healthy"],
+        "lag_seconds": _replica_state["lag_seconds"],
+    }
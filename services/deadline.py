@@ -0,0 +1,146 @@
+"""
+Request Deadline - Ngân sách thời gian cho mỗi request, truyền xuống DB/SMTP/hàng đợi
+
+- Mỗi request có deadline = min(timeout của endpoint, X-Request-Timeout của client).
+  Client chỉ có thể rút ngắn, không kéo dài quá timeout của endpoint.
+- Timeout theo endpoint: ENDPOINT_TIMEOUTS (giây), endpoint khác dùng REQUEST_TIMEOUT_SECONDS.
+- db_timeouts()/smtp_timeout()/remaining() lấy phần thời gian còn lại để đặt timeout cho
+  pymysql/smtplib/hàng đợi; hết deadline → raise DeadlineExceeded (app trả 504) thay vì làm tiếp
+  một việc mà client đã bỏ đi. DeadlineExceeded là BaseException nên service không cần bắt riêng.
+- Ngoài request context (CLI job, thread nền) không có deadline: dùng timeout mặc định DB_*_TIMEOUT.
+  Việc chạy hộ request trong thread khác (services/fan_out.py) mang deadline theo bằng bind().
+"""
+from __future__ import annotations
+
+import os
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+# Timeout (giây) theo Flask endpoint
+ENDPOINT_TIMEOUTS = {
+    "cccd.cccd_parse": 5.0,
+    "portal.usage": 15.0,
+    "portal.usage_api": 15.0,
+    "portal.key_usage": 15.0,
+}
+
+# Giới hạn dưới cho timeout truyền vào driver (pymysql/smtplib không nhận 0)
+_MIN_TIMEOUT = 0.05
+
+
+# Deadline gắn vào thread không có request context (bind/unbind)
+_bound_deadline: ContextVar[Optional[float]] = ContextVar("bound_deadline", default=None)
+
+
+class DeadlineExceeded(BaseException):
+    """
+    Request đã hết ngân sách thời gian
+
+    Kế thừa BaseException như KeyboardInterrupt: các khối `except Exception` (fallback, trả lỗi 500,
+    redirect) không nuốt mất nó, request dừng ngay và app trả 504 (app._App).
+    """
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except ValueError:
+        return default
+
+
+def _parse_timeout_header(value: Optional[str]) -> Optional[float]:
+    """X-Request-Timeout: số giây (vd "2.5") hoặc mili giây với hậu tố ms (vd "2500ms")"""
+    if not value:
+        return None
+    value = value.strip().lower()
+    try:
+        if value.endswith("ms"):
+            seconds = float(value[:-2]) / 1000.0
+        else:
+            seconds = float(value.rstrip("s"))
+    except ValueError:
+        return None
+    return seconds if seconds > 0 else None
+
+
+def start(endpoint: Optional[str], header_value: Optional[str] = None) -> float:
+    """Đặt deadline cho request hiện tại (gọi trong before_request). Trả về budget (giây)"""
+    from flask import g
+
+    budget = ENDPOINT_TIMEOUTS.get(endpoint or "", _env_float("REQUEST_TIMEOUT_SECONDS", 30.0))
+    requested = _parse_timeout_header(header_value)
+    if requested is not None:
+        budget = min(budget, requested)
+    g.deadline = time.monotonic() + budget
+    return budget
+
+
+def bind(value: Optional[float]):
+    """Gắn deadline (monotonic) của request cho thread hiện tại; trả về token cho unbind()"""
+    return _bound_deadline.set(value)
+
+
+def unbind(token) -> None:
+    _bound_deadline.reset(token)
+
+
+def _current_deadline() -> Optional[float]:
+    bound = _bound_deadline.get()
+    if bound is not None:
+        return bound
+    try:
+        from flask import g, has_request_context
+        if has_request_context():
+            return g.get("deadline")
+    except Exception:
+        pass
+    return None
+
+
+def current() -> Optional[float]:
+    """Deadline (monotonic) của request hiện tại; None nếu không có"""
+    return _current_deadline()
+
+
+def remaining() -> Optional[float]:
+    """Số giây còn lại của request hiện tại; None nếu không có deadline"""
+    deadline = _current_deadline()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def expired() -> bool:
+    left = remaining()
+    return left is not None and left <= 0
+
+
+def check() -> None:
+    """Raise DeadlineExceeded nếu request đã hết thời gian"""
+    if expired():
+        raise DeadlineExceeded("request deadline exceeded")
+
+
+def bounded(default: float) -> float:
+    """min(default, thời gian còn lại); raise DeadlineExceeded nếu đã hết"""
+    left = remaining()
+    if left is None:
+        return default
+    if left <= 0:
+        raise DeadlineExceeded("request deadline exceeded")
+    return max(_MIN_TIMEOUT, min(default, left))
+
+
+def db_timeouts() -> dict:
+    """kwargs timeout cho pymysql.connect theo deadline của request"""
+    return {
+        "connect_timeout": bounded(_env_float("DB_CONNECT_TIMEOUT", 5.0)),
+        "read_timeout": bounded(_env_float("DB_READ_TIMEOUT", 30.0)),
+        "write_timeout": bounded(_env_float("DB_WRITE_TIMEOUT", 30.0)),
+    }
+
+
+def smtp_timeout() -> float:
+    """Timeout cho smtplib theo deadline của request"""
+    return bounded(_env_float("SMTP_TIMEOUT", 10.0))
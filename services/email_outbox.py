@@ -0,0 +1,271 @@
+"""
+Email Outbox - Hàng đợi email bền vững (bảng MySQL), gửi bởi worker nền
+
+Register/forgot-password/resend-verification trước đây mở SMTP, STARTTLS, login, gửi rồi quit
+ngay trong HTTP request (vài trăm ms tới vài giây, SMTP chậm → request chậm theo).
+- enqueue() chỉ INSERT 1 row rồi trả về; email không mất khi process restart.
+- Worker nền (mỗi process 1 thread) claim tối đa EMAIL_OUTBOX_BATCH_SIZE row bằng claim token
+  (UPDATE ... LIMIT rồi SELECT theo token) nên nhiều worker/node không gửi trùng,
+  gửi cả batch qua 1 SMTPSession giữ mở, đóng session khi idle EMAIL_OUTBOX_SMTP_IDLE_SECONDS.
+- Lỗi → thử lại với backoff mũ (EMAIL_OUTBOX_RETRY_BASE_SECONDS * 2^attempts, tối đa 1 giờ);
+  quá EMAIL_OUTBOX_MAX_ATTEMPTS lần → status 'failed'.
+- Row 'sending' của worker chết giữa chừng được claim lại sau EMAIL_OUTBOX_CLAIM_SECONDS.
+- Worker xóa row 'sent' cũ hơn EMAIL_OUTBOX_RETENTION_DAYS mỗi giờ (0 = không tự xóa).
+
+Thiếu bảng → email_service.send_email gửi trực tiếp như trước:
+    CREATE TABLE email_outbox (
+        id BIGINT AUTO_INCREMENT PRIMARY KEY,
+        to_email VARCHAR(255) NOT NULL,
+        to_name VARCHAR(255) NULL,
+        subject VARCHAR(255) NOT NULL,
+        html_content MEDIUMTEXT NOT NULL,
+        text_content MEDIUMTEXT NULL,
+        status ENUM('pending', 'sending', 'sent', 'failed') NOT NULL DEFAULT 'pending',
+        attempts INT NOT NULL DEFAULT 0,
+        next_attempt_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        claim_token CHAR(32) NULL,
+        last_error VARCHAR(255) NULL,
+        created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        sent_at DATETIME NULL,
+        INDEX idx_status_next_attempt (status, next_attempt_at),
+        INDEX idx_claim_token (claim_token)
+    );
+"""
+from __future__ import annotations
+
+import logging
+import os
+import secrets
+import threading
+import time
+from typing import Optional
+
+from services import db_router, schema_registry
+
+logger = logging.getLogger(__name__)
+
+_MAX_BACKOFF_SECONDS = 3600
+
+_PRUNE_INTERVAL_SECONDS = 3600
+
+_wake = threading.Event()
+_start_lock = threading.Lock()
+_state = {
+    "thread_pid": None,
+    "drained_at": 0.0,
+    "pruned_at": None,
+    "sent": 0,
+    "failed": 0,
+}
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except ValueError:
+        return default
+
+
+def is_enabled() -> bool:
+    return schema_registry.has_table("email_outbox")
+
+
+def enqueue(
+    to_email: str,
+    subject: str,
+    html_content: str,
+    text_content: Optional[str] = None,
+    to_name: Optional[str] = None,
+    cursor=None,
+) -> bool:
+    """
+    Ghi email vào outbox (trong transaction của caller nếu truyền cursor)
+    Returns: True nếu đã ghi
+    """
+    params = (to_email, to_name, subject, html_content, text_content)
+    sql = """
+        INSERT INTO email_outbox (to_email, to_name, subject, html_content, text_content)
+        VALUES (%s, %s, %s, %s, %s)
+    """
+    if cursor is not None:
+        cursor.execute(sql, params)
+    else:
+        try:
+            conn = db_router.get_primary_connection()
+            try:
+                with conn.cursor() as own_cursor:
+                    own_cursor.execute(sql, params)
+                conn.commit()
+            finally:
+                conn.close()
+        except Exception as e:
+            logger.error(f"Error queueing email: {str(e)}", exc_info=True)
+            return False
+    start()
+    _wake.set()
+    return True
+
+
+def _claim(cursor, batch_size: int) -> list[dict]:
+    token = secrets.token_hex(16)
+    cursor.execute(
+        """
+        UPDATE email_outbox
+        SET status = 'sending', claim_token = %s, next_attempt_at = NOW() + INTERVAL %s SECOND
+        WHERE status IN ('pending', 'sending') AND next_attempt_at <= NOW()
+        ORDER BY next_attempt_at
+        LIMIT %s
+        """,
+        (token, int(_env_float("EMAIL_OUTBOX_CLAIM_SECONDS", 300)), batch_size),
+    )
+    if not cursor.rowcount:
+        return []
+    cursor.execute(
+        """
+        SELECT id, to_email, subject, html_content, text_content, attempts
+        FROM email_outbox
+        WHERE claim_token = %s AND status = 'sending'
+        ORDER BY id
+        """,
+        (token,),
+    )
+    return cursor.fetchall()
+
+
+def drain(session) -> int:
+    """
+    Gửi các email đến hạn theo batch qua `session` (SMTPSession) tới khi hết
+    Returns: số email đã gửi
+    """
+    batch_size = max(1, int(_env_float("EMAIL_OUTBOX_BATCH_SIZE", 50)))
+    max_attempts = int(_env_float("EMAIL_OUTBOX_MAX_ATTEMPTS", 8))
+    retry_base = _env_float("EMAIL_OUTBOX_RETRY_BASE_SECONDS", 30)
+    sent_total = 0
+    conn = db_router.get_primary_connection()
+    try:
+        with conn.cursor() as cursor:
+            while True:
+                rows = _claim(cursor, batch_size)
+                conn.commit()
+                if not rows:
+                    break
+                sent_ids = []
+                for row in rows:
+                    try:
+                        session.send(row["to_email"], row["subject"], row["html_content"], row["text_content"])
+                        sent_ids.append(row["id"])
+                    except Exception as e:
+                        session.close()
+                        attempts = row["attempts"] + 1
+                        failed = attempts >= max_attempts
+                        cursor.execute(
+                            """
+                            UPDATE email_outbox
+                            SET status = %s, attempts = %s, claim_token = NULL, last_error = %s,
+                                next_attempt_at = NOW() + INTERVAL %s SECOND
+                            WHERE id = %s
+                            """,
+                            (
+                                "failed" if failed else "pending",
+                                attempts,
+                                f"{type(e).__name__}: {e}"[:255],
+                                int(min(retry_base * (2 ** (attempts - 1)), _MAX_BACKOFF_SECONDS)),
+                                row["id"],
+                            ),
+                        )
+                        conn.commit()
+                        _state["failed"] += int(failed)
+                        logger.warning(f"email_outbox_send_failed | id={row['id']} | attempts={attempts} | {type(e).__name__}: {e}")
+                if sent_ids:
+                    placeholders = ",".join(["%s"] * len(sent_ids))
+                    cursor.execute(
+                        f"""
+                        UPDATE email_outbox
+                        SET status = 'sent', sent_at = NOW(), attempts = attempts + 1, claim_token = NULL
+                        WHERE id IN ({placeholders})
+                        """,
+                        sent_ids,
+                    )
+                    conn.commit()
+                    sent_total += len(sent_ids)
+                    _state["sent"] += len(sent_ids)
+                if len(rows) < batch_size:
+                    break
+    finally:
+        conn.close()
+    _state["drained_at"] = time.monotonic()
+    return sent_total
+
+
+def _worker_loop() -> None:
+    from services.email_service import SMTPSession
+
+    session = SMTPSession()
+    while True:
+        _wake.wait(_env_float("EMAIL_OUTBOX_POLL_SECONDS", 5))
+        _wake.clear()
+        try:
+            if is_enabled():
+                drain(session)
+        except Exception as e:
+            logger.warning(f"email_outbox_drain_failed | {type(e).__name__}: {e}")
+        _prune_if_due()
+        if session.last_used_at and time.monotonic() - session.last_used_at > _env_float("EMAIL_OUTBOX_SMTP_IDLE_SECONDS", 30):
+            session.close()
+            session.last_used_at = 0.0
+
+
+def _prune_if_due() -> None:
+    """Xóa email đã gửi quá EMAIL_OUTBOX_RETENTION_DAYS, tối đa mỗi giờ một lần"""
+    retention_days = _env_float("EMAIL_OUTBOX_RETENTION_DAYS", 30)
+    if retention_days <= 0:
+        return
+    if _state["pruned_at"] is not None and time.monotonic() - _state["pruned_at"] < _PRUNE_INTERVAL_SECONDS:
+        return
+    _state["pruned_at"] = time.monotonic()
+    try:
+        if is_enabled():
+            prune(retention_days)
+    except Exception as e:
+        logger.warning(f"email_outbox_prune_failed | {type(e).__name__}: {e}")
+
+
+def start() -> None:
+    """Chạy worker nền (mỗi process một thread; gọi lại sau fork sẽ tạo thread mới)"""
+    if _state["thread_pid"] == os.getpid():
+        return
+    with _start_lock:
+        if _state["thread_pid"] == os.getpid():
+            return
+        _state["thread_pid"] = os.getpid()
+    threading.Thread(target=_worker_loop, name="email-outbox", daemon=True).start()
+
+
+def prune(older_than_days: float) -> int:
+    """Xóa email đã gửi cũ hơn N ngày; trả về số row đã xóa"""
+    deleted = 0
+    conn = db_router.get_primary_connection()
+    try:
+        with conn.cursor() as cursor:
+            while True:
+                cursor.execute(
+                    "DELETE FROM email_outbox WHERE status = 'sent' AND sent_at < NOW() - INTERVAL %s DAY LIMIT 10000",
+                    (older_than_days,),
+                )
+                conn.commit()
+                deleted += cursor.rowcount
+                if cursor.rowcount < 10000:
+                    break
+    finally:
+        conn.close()
+    return deleted
+
+
+def get_status() -> dict:
+    return {
+        "enabled": is_enabled() if schema_registry.is_loaded() else None,
+        "worker_running": _state["thread_pid"] == os.getpid(),
+        "seconds_since_drain": round(time.monotonic() - _state["drained_at"], 1) if _state["drained_at"] else None,
+        "sent": _state["sent"],
+        "failed": _state["failed"],
+    }
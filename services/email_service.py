@@ -1,6 +1,9 @@
 """
 Email Service - Send emails using SMTP
 Simple SMTP-based email service
+
+Có bảng email_outbox → send_email chỉ ghi vào outbox rồi trả về ngay,
+worker nền gửi qua SMTP session dùng lại (services/email_outbox.py).
 """
 from __future__ import annotations
 
@@ -8,10 +11,13 @@ import logging
 import os
 import re
 import smtplib
+import time
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from typing import Optional
 
+from services import deadline
+
 logger = logging.getLogger(__name__)
 
 
@@ -33,6 +39,45 @@ class EmailService:
         else:
             logger.info(f"SMTP email service initialized: {self.smtp_host}:{self.smtp_port}")
     
+    def is_configured(self) -> bool:
+        return bool(self.smtp_username and self.smtp_password)
+    
+    def build_message(
+        self,
+        to_email: str,
+        subject: str,
+        html_content: str,
+        text_content: Optional[str] = None,
+    ) -> MIMEMultipart:
+        """Tạo MIME message (text + HTML)"""
+        msg = MIMEMultipart("alternative")
+        msg["Subject"] = subject
+        msg["From"] = f"{self.from_name} <{self.from_email}>"
+        msg["To"] = to_email
+        
+        # Create text content (auto-generate from HTML if not provided)
+        if not text_content:
+            # Simple HTML to text conversion (remove tags)
+            text_content = re.sub(r"<[^>]+>", "", html_content)
+            text_content = re.sub(r"\s+", " ", text_content).strip()
+        
+        # Add both text and HTML parts
+        msg.attach(MIMEText(text_content, "plain", "utf-8"))
+        msg.attach(MIMEText(html_content, "html", "utf-8"))
+        return msg
+    
+    def connect(self) -> smtplib.SMTP:
+        """Mở SMTP connection đã STARTTLS/SSL và login"""
+        # Timeout theo deadline của request (nếu gửi trong request) để không giữ thread quá lâu
+        timeout = deadline.smtp_timeout()
+        if self.smtp_use_tls:
+            server = smtplib.SMTP(self.smtp_host, self.smtp_port, timeout=timeout)
+            server.starttls()
+        else:
+            server = smtplib.SMTP_SSL(self.smtp_host, self.smtp_port, timeout=timeout)
+        server.login(self.smtp_username, self.smtp_password)
+        return server
+    
     def send_email(
         self,
         to_email: str,
@@ -42,7 +87,7 @@ class EmailService:
         to_name: Optional[str] = None,
     ) -> bool:
         """
-        Send email via SMTP
+        Send email via SMTP (1 connection riêng cho email này)
         
         Args:
             to_email: Recipient email address
@@ -54,39 +99,13 @@ class EmailService:
         Returns:
             True if sent successfully, False otherwise
         """
-        if not self.smtp_username or not self.smtp_password:
+        if not self.is_configured():
             logger.error("SMTP credentials not configured")
             return False
         
         try:
-            # Create message
-            msg = MIMEMultipart("alternative")
-            msg["Subject"] = subject
-            msg["From"] = f"{self.from_name} <{self.from_email}>"
-            msg["To"] = to_email
-            
-            # Create text content (auto-generate from HTML if not provided)
-            if not text_content:
-                # Simple HTML to text conversion (remove tags)
-                text_content = re.sub(r"<[^>]+>", "", html_content)
-                text_content = re.sub(r"\s+", " ", text_content).strip()
-            
-            # Add both text and HTML parts
-            text_part = MIMEText(text_content, "plain", "utf-8")
-            html_part = MIMEText(html_content, "html", "utf-8")
-            
-            msg.attach(text_part)
-            msg.attach(html_part)
-            
-            # Connect to SMTP server
-            if self.smtp_use_tls:
-                server = smtplib.SMTP(self.smtp_host, self.smtp_port)
-                server.starttls()
-            else:
-                server = smtplib.SMTP_SSL(self.smtp_host, self.smtp_port)
-            
-            # Login and send
-            server.login(self.smtp_username, self.smtp_password)
+            msg = self.build_message(to_email, subject, html_content, text_content)
+            server = self.connect()
             server.send_message(msg)
             server.quit()
             
@@ -98,6 +117,53 @@ class EmailService:
             return False
 
 
+class SMTPSession:
+    """
+    SMTP connection đã login, giữ mở để gửi nhiều email (outbox worker, job gửi hàng loạt)
+    - Mở lazily ở lần send đầu tiên; server đóng connection → mở lại và gửi lại 1 lần
+    - close() khi xong batch hoặc khi idle quá lâu (do caller quyết định)
+    """
+    
+    def __init__(self, service: Optional[EmailService] = None):
+        self.service = service or get_email_service()
+        self._server: Optional[smtplib.SMTP] = None
+        self.last_used_at = 0.0
+    
+    def send(
+        self,
+        to_email: str,
+        subject: str,
+        html_content: str,
+        text_content: Optional[str] = None,
+    ) -> None:
+        """Gửi 1 email; raise exception nếu lỗi (caller quyết định retry)"""
+        if not self.service.is_configured():
+            raise RuntimeError("SMTP credentials not configured")
+        msg = self.service.build_message(to_email, subject, html_content, text_content)
+        if self._server is None:
+            self._server = self.service.connect()
+        try:
+            self._server.send_message(msg)
+        except smtplib.SMTPServerDisconnected:
+            self._server = self.service.connect()
+            self._server.send_message(msg)
+        self.last_used_at = time.monotonic()
+    
+    def close(self) -> None:
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except Exception:
+                pass
+            self._server = None
+    
+    def __enter__(self) -> "SMTPSession":
+        return self
+    
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
 # Global email service instance
 _email_service: Optional[EmailService] = None
 
@@ -128,8 +194,12 @@ def send_email(
         to_name: Recipient name (optional)
     
     Returns:
-        True if sent successfully, False otherwise
+        True if sent (or queued in outbox) successfully, False otherwise
     """
+    from services import email_outbox
+    if email_outbox.is_enabled():
+        # Request không chờ SMTP: ghi outbox, worker nền gửi
+        return email_outbox.enqueue(to_email, subject, html_content, text_content, to_name)
     service = get_email_service()
     return service.send_email(to_email, subject, html_content, text_content, to_name)
 
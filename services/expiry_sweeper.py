@@ -0,0 +1,178 @@
+"""
+Expiry Sweeper - Chuyển subscription/key đã hết hạn sang trạng thái hết hạn bằng UPDATE theo lô
+
+Trước đây hết hạn chỉ được tính lười: get_key_info so sánh expires_at mỗi request,
+subscription không bao giờ thành 'expired' trừ khi có thanh toán mới.
+- Mỗi EXPIRY_SWEEPER_INTERVAL_SECONDS, một process (bầu bằng GET_LOCK, nhiều worker/node không
+  quét trùng) lấy tối đa EXPIRY_SWEEPER_CHUNK_SIZE row đã hết hạn theo index (status/active, expires_at),
+  UPDATE theo id rồi commit từng lô (không khóa cả bảng):
+    subscriptions: status 'active' → 'expired'        (change_log "subscription")
+    api_keys:      active → FALSE, expired_at = NOW()  (change_log "api_key", counter admin_stats)
+- expired_at đánh dấu key do sweeper tắt: duyệt thanh toán bật lại các key này
+  (key bị vô hiệu hóa thủ công thì không).
+- Có cột api_keys.expired_at → hot path (get_key_info) tin cờ active, không so sánh expires_at nữa;
+  key có thể còn dùng được tối đa 1 chu kỳ quét sau khi hết hạn.
+
+    ALTER TABLE api_keys ADD COLUMN expired_at DATETIME NULL;
+    ALTER TABLE api_keys ADD INDEX idx_active_expires_at (active, expires_at);
+    ALTER TABLE subscriptions ADD INDEX idx_status_expires_at (status, expires_at);
+"""
+from __future__ import annotations
+
+import logging
+import os
+import threading
+import time
+
+from services import admin_stats, change_log, db_router, schema_registry
+
+logger = logging.getLogger(__name__)
+
+_LOCK_NAME = "cccd_expiry_sweeper"
+
+_state = {
+    "thread_pid": None,
+    "swept_at": 0.0,
+    "subscriptions": 0,
+    "keys": 0,
+}
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except ValueError:
+        return default
+
+
+def _enabled_by_config() -> bool:
+    return os.getenv("EXPIRY_SWEEPER_ENABLED", "true").lower() == "true"
+
+
+def keys_enabled() -> bool:
+    """Sweeper quản lý hết hạn của key (cần cột api_keys.expired_at)"""
+    return _enabled_by_config() and schema_registry.has_column("api_keys", "expired_at")
+
+
+def trust_active_flag() -> bool:
+    """True → hot path chỉ cần cờ active, không so sánh expires_at"""
+    return keys_enabled()
+
+
+def _sweep_subscriptions(conn, cursor, chunk_size: int) -> int:
+    swept = 0
+    while True:
+        cursor.execute(
+            """
+            SELECT id, user_id FROM subscriptions
+            WHERE status = 'active' AND expires_at IS NOT NULL AND expires_at <= NOW()
+            ORDER BY expires_at
+            LIMIT %s
+            """,
+            (chunk_size,),
+        )
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        placeholders = ",".join(["%s"] * len(rows))
+        cursor.execute(
+            f"UPDATE subscriptions SET status = 'expired' WHERE id IN ({placeholders}) AND status = 'active'",
+            [row["id"] for row in rows],
+        )
+        swept += cursor.rowcount
+        change_log.publish(cursor, "subscription", sorted({row["user_id"] for row in rows}))
+        conn.commit()
+        if len(rows) < chunk_size:
+            break
+    return swept
+
+
+def _sweep_keys(conn, cursor, chunk_size: int) -> int:
+    swept = 0
+    while True:
+        cursor.execute(
+            """
+            SELECT id, user_id FROM api_keys
+            WHERE active = TRUE AND expires_at IS NOT NULL AND expires_at <= NOW()
+            ORDER BY expires_at
+            LIMIT %s
+            """,
+            (chunk_size,),
+        )
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        key_ids = [row["id"] for row in rows]
+        placeholders = ",".join(["%s"] * len(key_ids))
+        admin_stats.record_keys_removed(cursor, f"id IN ({placeholders})", tuple(key_ids), deleting=False)
+        cursor.execute(
+            f"UPDATE api_keys SET active = FALSE, expired_at = NOW() WHERE id IN ({placeholders}) AND active = TRUE",
+            key_ids,
+        )
+        swept += cursor.rowcount
+        change_log.publish(cursor, "api_key", key_ids)
+        conn.commit()
+        for user_id in {row["user_id"] for row in rows if row["user_id"]}:
+            db_router.mark_write(f"user:{user_id}")
+        if len(rows) < chunk_size:
+            break
+    return swept
+
+
+def run_once() -> dict | None:
+    """
+    Quét 1 lượt; None nếu process khác đang giữ lock (đang quét)
+
+    Returns:
+        {"subscriptions": số subscription đã expire, "keys": số key đã tắt}
+    """
+    chunk_size = max(1, int(_env_float("EXPIRY_SWEEPER_CHUNK_SIZE", 500)))
+    conn = db_router.get_primary_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT GET_LOCK(%s, 0) AS locked", (_LOCK_NAME,))
+            if not cursor.fetchone()["locked"]:
+                return None
+            try:
+                result = {
+                    "subscriptions": _sweep_subscriptions(conn, cursor, chunk_size),
+                    "keys": _sweep_keys(conn, cursor, chunk_size) if keys_enabled() else 0,
+                }
+            finally:
+                cursor.execute("SELECT RELEASE_LOCK(%s)", (_LOCK_NAME,))
+    finally:
+        conn.close()
+    _state["swept_at"] = time.monotonic()
+    _state["subscriptions"] += result["subscriptions"]
+    _state["keys"] += result["keys"]
+    if result["subscriptions"] or result["keys"]:
+        logger.info(f"expiry_sweep | subscriptions={result['subscriptions']} | keys={result['keys']}")
+    return result
+
+
+def _sweep_loop() -> None:
+    while True:
+        time.sleep(_env_float("EXPIRY_SWEEPER_INTERVAL_SECONDS", 60))
+        try:
+            if _enabled_by_config():
+                run_once()
+        except Exception as e:
+            logger.warning(f"expiry_sweep_failed | {type(e).__name__}: {e}")
+
+
+def start() -> None:
+    """Chạy thread quét (mỗi process một thread; chỉ process giữ GET_LOCK thực sự quét)"""
+    if _state["thread_pid"] == os.getpid():
+        return
+    _state["thread_pid"] = os.getpid()
+    threading.Thread(target=_sweep_loop, name="expiry-sweeper", daemon=True).start()
+
+
+def get_status() -> dict:
+    return {
+        "enabled": _enabled_by_config(),
+        "keys_enabled": keys_enabled() if schema_registry.is_loaded() else None,
+        "seconds_since_sweep": round(time.monotonic() - _state["swept_at"], 1) if _state["swept_at"] else None,
+        "subscriptions_expired": _state["subscriptions"],
+        "keys_expired": _state["keys"],
+    }
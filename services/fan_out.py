@@ -0,0 +1,102 @@
+"""
+Fan-out - Chạy các query độc lập của một trang đồng thời
+
+Trang /portal/usage (tổng + theo từng key) và /portal/keys (user context + danh sách key)
+trước đây chạy các query nối tiếp nhau → latency = tổng các round trip.
+gather() chạy chúng song song trên thread pool dùng chung của process, latency ≈ query chậm nhất:
+- Call đầu tiên chạy ngay trong request thread (nó có thể dùng session/g), các call còn lại vào pool
+  và không được đụng tới request context. Mỗi call tự mở connection như các service vẫn làm.
+- Deadline của request được mang sang thread của pool (deadline.bind) nên timeout DB vẫn bị rút ngắn.
+- Mốc ghi gần nhất của session (db_last_write_at) cũng được mang sang (db_router.bind_session_write)
+  nên read-your-writes vẫn đọc từ primary ngay sau khi user vừa ghi.
+- Tối đa FAN_OUT_QUEUE_SIZE việc (đang chạy + chờ) mỗi worker; pool đầy hoặc FAN_OUT_WORKERS=0
+  → call chạy nối tiếp trong request thread như trước thay vì xếp hàng.
+"""
+from __future__ import annotations
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Any, Callable, Optional
+
+from services import db_router, deadline
+
+_lock = threading.Lock()
+_pool: Optional[ThreadPoolExecutor] = None
+_pool_pid: Optional[int] = None
+_slots: Optional[threading.BoundedSemaphore] = None
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except ValueError:
+        return default
+
+
+def _get_pool() -> Optional[ThreadPoolExecutor]:
+    """Pool của process hiện tại (tạo lại sau fork); None nếu FAN_OUT_WORKERS=0"""
+    global _pool, _pool_pid, _slots
+    if _pool_pid != os.getpid():
+        with _lock:
+            if _pool_pid != os.getpid():
+                workers = _env_int("FAN_OUT_WORKERS", 8)
+                _slots = threading.BoundedSemaphore(max(1, _env_int("FAN_OUT_QUEUE_SIZE", 32)))
+                _pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fan-out") if workers > 0 else None
+                _pool_pid = os.getpid()
+    return _pool
+
+
+def _run_bound(call: Callable[[], Any], request_deadline: Optional[float], last_write: Optional[float]) -> Any:
+    token = deadline.bind(request_deadline)
+    write_token = db_router.bind_session_write(last_write)
+    try:
+        return call()
+    finally:
+        db_router.unbind_session_write(write_token)
+        deadline.unbind(token)
+        _slots.release()
+
+
+def gather(*calls: Callable[[], Any]) -> list:
+    """
+    Chạy các call (không tham số, dùng functools.partial) đồng thời, trả về kết quả theo thứ tự
+
+    Exception của một call được raise lại sau khi các call khác xong.
+    Raise DeadlineExceeded nếu chờ quá deadline của request.
+    """
+    pool = _get_pool()
+    request_deadline = deadline.current()
+    last_write = db_router.session_last_write()
+    futures = []
+    for call in calls[1:]:
+        if pool is not None and _slots.acquire(blocking=False):
+            try:
+                futures.append(pool.submit(_run_bound, call, request_deadline, last_write))
+            except RuntimeError:
+                # Pool đã shutdown (process đang tắt)
+                _slots.release()
+                futures.append(call)
+        else:
+            futures.append(call)
+
+    results = []
+    error: Optional[BaseException] = None
+    for item in ([calls[0]] if calls else []) + futures:
+        try:
+            if callable(item):
+                results.append(item())
+            else:
+                results.append(item.result(timeout=deadline.bounded(float(os.getenv("FAN_OUT_TIMEOUT_SECONDS", "30")))))
+        except FutureTimeoutError as e:
+            item.cancel()
+            error = error or deadline.DeadlineExceeded("fan-out timed out")
+            error.__cause__ = e
+            results.append(None)
+        except (Exception, deadline.DeadlineExceeded) as e:
+            error = error or e
+            results.append(None)
+    if error is not None:
+        raise error
+    return results
@@ -0,0 +1,167 @@
+"""
+Key Expiry Warnings - Job gửi cảnh báo key sắp hết hạn theo lô
+
+Chạy định kỳ (cron), ví dụ mỗi giờ:
+    flask --app run send-key-expiry-warnings
+
+- 1 range query trên api_keys.expires_at (cần index) lấy mọi key active hết hạn trong
+  KEY_EXPIRY_WARNING_DAYS ngày tới (mặc định các mốc 7,3,1 ngày).
+- Mỗi key thuộc mốc nhỏ nhất còn >= số ngày còn lại; key đã được báo ở mốc đó (hoặc mốc nhỏ hơn)
+  thì bỏ qua → chạy lại nhiều lần không gửi trùng và chỉ tốn 1 query.
+- Marker gắn với expires_at đã cảnh báo: key được gia hạn (expires_at đổi) bắt đầu lại từ mốc lớn nhất.
+- Gom key theo người nhận (email của user, hoặc owner_email), render template 1 lần/người nhận,
+  gửi tất cả qua 1 SMTPSession; marker ghi ngay sau khi email của người nhận đó gửi thành công.
+
+    ALTER TABLE api_keys ADD INDEX idx_active_expires_at (active, expires_at);
+    CREATE TABLE key_expiry_notifications (
+        key_id INT NOT NULL,
+        expires_at DATETIME NOT NULL,
+        window_days INT NOT NULL,
+        sent_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (key_id, expires_at, window_days),
+        FOREIGN KEY (key_id) REFERENCES api_keys(id) ON DELETE CASCADE
+    );
+"""
+from __future__ import annotations
+
+import logging
+import math
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Optional
+
+from services import db_router, schema_registry
+
+logger = logging.getLogger(__name__)
+
+
+def get_windows() -> list[int]:
+    """Các mốc cảnh báo (ngày), tăng dần"""
+    windows = set()
+    for part in os.getenv("KEY_EXPIRY_WARNING_DAYS", "7,3,1").split(","):
+        part = part.strip()
+        if part.isdigit() and int(part) > 0:
+            windows.add(int(part))
+    return sorted(windows) or [7]
+
+
+def is_enabled() -> bool:
+    return schema_registry.has_table("key_expiry_notifications")
+
+
+def _window_for(days_remaining: int, windows: list[int]) -> Optional[int]:
+    for window in windows:
+        if days_remaining <= window:
+            return window
+    return None
+
+
+def find_due_warnings(cursor, now: Optional[datetime] = None) -> dict[str, dict]:
+    """
+    Key cần cảnh báo, gom theo người nhận
+
+    Returns:
+        {email: {"name", "keys": [{"id", "key_prefix", "tier", "expires_at", "days_remaining", "expiration_date", "window"}]}}
+    """
+    now = now or datetime.now()
+    windows = get_windows()
+    cursor.execute(
+        """
+        SELECT k.id, k.key_prefix, k.tier, k.expires_at, k.owner_email,
+            u.email AS user_email, u.full_name,
+            (
+                SELECT MIN(n.window_days) FROM key_expiry_notifications n
+                WHERE n.key_id = k.id AND n.expires_at = k.expires_at
+            ) AS notified_window
+        FROM api_keys k
+        LEFT JOIN users u ON u.id = k.user_id
+        WHERE k.active = TRUE AND k.expires_at > %s AND k.expires_at <= %s
+        """,
+        (now, now + timedelta(days=windows[-1])),
+    )
+    recipients: dict[str, dict] = defaultdict(lambda: {"name": None, "keys": []})
+    for row in cursor.fetchall():
+        days_remaining = max(1, math.ceil((row["expires_at"] - now).total_seconds() / 86400))
+        window = _window_for(days_remaining, windows)
+        if window is None:
+            continue
+        if row["notified_window"] is not None and row["notified_window"] <= window:
+            continue
+        email = row["user_email"] or row["owner_email"]
+        if not email or "@" not in email:
+            continue  # Key test của admin ("admin_test") không có người nhận
+        recipient = recipients[email]
+        recipient["name"] = recipient["name"] or row["full_name"] or email
+        recipient["keys"].append({
+            "id": row["id"],
+            "key_prefix": row["key_prefix"],
+            "tier": row["tier"],
+            "expires_at": row["expires_at"],
+            "days_remaining": days_remaining,
+            "expiration_date": row["expires_at"].strftime("%d/%m/%Y"),
+            "window": window,
+        })
+    return dict(recipients)
+
+
+def _render(name: str, keys: list[dict], keys_url: str) -> tuple[str, str]:
+    from flask import render_template
+
+    soonest = min(key["days_remaining"] for key in keys)
+    first = keys[0]
+    subject = f"⚠️ Cảnh báo: {len(keys)} API Key sắp hết hạn - CCCD API" if len(keys) > 1 else (
+        f"⚠️ Cảnh báo: API Key sắp hết hạn sau {soonest} ngày - CCCD API"
+    )
+    html_content = render_template(
+        "emails/key_expiration_warning.html",
+        to_name=name,
+        keys=keys if len(keys) > 1 else None,
+        key_prefix=first["key_prefix"],
+        tier=first["tier"],
+        days_remaining=first["days_remaining"],
+        expiration_date=first["expiration_date"],
+        keys_url=keys_url,
+    )
+    return subject, html_content
+
+
+def run(session=None, now: Optional[datetime] = None) -> dict:
+    """
+    Gửi cảnh báo cho mọi key đến mốc (cần app context để render template)
+
+    Returns:
+        {"recipients", "keys", "failed"}
+    """
+    from services.email_service import SMTPSession
+
+    keys_url = f"{os.getenv('BASE_URL', 'http://localhost:8000')}/portal/keys"
+    result = {"recipients": 0, "keys": 0, "failed": 0}
+    own_session = session is None
+    session = session or SMTPSession()
+    conn = db_router.get_primary_connection()
+    try:
+        with conn.cursor() as cursor:
+            recipients = find_due_warnings(cursor, now)
+            for email, recipient in recipients.items():
+                subject, html_content = _render(recipient["name"], recipient["keys"], keys_url)
+                try:
+                    session.send(email, subject, html_content)
+                except Exception as e:
+                    # Không ghi marker → lần chạy sau gửi lại
+                    session.close()
+                    result["failed"] += 1
+                    logger.warning(f"key_expiry_warning_failed | to={email} | {type(e).__name__}: {e}")
+                    continue
+                cursor.executemany(
+                    "INSERT IGNORE INTO key_expiry_notifications (key_id, expires_at, window_days) VALUES (%s, %s, %s)",
+                    [(key["id"], key["expires_at"], key["window"]) for key in recipient["keys"]],
+                )
+                conn.commit()
+                result["recipients"] += 1
+                result["keys"] += len(recipient["keys"])
+    finally:
+        conn.close()
+        if own_session:
+            session.close()
+    return result
@@ -0,0 +1,380 @@
+"""
+Key Snapshot - Bản sao in-memory của toàn bộ API key active cho mỗi worker
+
+- Load toàn bộ key active khi khởi động (thread nền), sau đó delta sync theo api_keys.updated_at
+  mỗi KEY_SNAPSHOT_SYNC_SECONDS: chỉ fetch các row thay đổi kể từ lần sync trước.
+- Key bị xóa (row biến mất) được phát hiện qua change log "api_key" (tra lại các id được publish,
+  id không còn row → loại ngay), api_key_revocations (nếu có bảng) và full reload định kỳ
+  (KEY_SNAPSHOT_FULL_RELOAD_SECONDS). Worker xóa key tự loại khỏi snapshot của nó sau commit.
+- Biểu diễn gọn bằng parallel arrays sắp xếp theo hash (~25 bytes/key → 1M key ≈ 25MB):
+    hi, lo  : 128 bit đầu của SHA256(key) (array 'Q')
+    ids     : key id (array 'i')
+    expires : expires_at epoch, 0 = vĩnh viễn (array 'I')
+    tiers   : index trong _TIERS (array 'b')
+  Lookup = binary search trên hi.
+- Snapshot sẵn sàng → key có trong snapshot được validate không cần DB; miss vẫn tra DB
+  (key vừa tạo ở worker khác chưa kịp sync). KEY_SNAPSHOT_AUTHORITATIVE=true → miss = không hợp lệ,
+  key mới tạo ở worker khác trả 401 tới tối đa KEY_SNAPSHOT_SYNC_SECONDS.
+- Delta sync áp dụng cả trang thay đổi trong 1 lần rebuild (copy theo slice) thay vì insert/xóa
+  từng phần tử (mỗi lần O(n)).
+
+Cần cột updated_at (thiếu cột → snapshot tắt, validate qua DB như cũ):
+    ALTER TABLE api_keys
+        ADD COLUMN updated_at TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6)
+            ON UPDATE CURRENT_TIMESTAMP(6),
+        ADD INDEX idx_api_keys_updated_at (updated_at);
+"""
+from __future__ import annotations
+
+import logging
+import os
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from datetime import datetime, timedelta
+from typing import Iterable, Optional
+
+from services import change_log, schema_registry
+
+logger = logging.getLogger(__name__)
+
+_TIERS = ("free", "premium", "ultra")
+_PAGE_SIZE = 50000
+_DELTA_PAGE_SIZE = 5000
+
+
+class _Arrays:
+    __slots__ = ("hi", "lo", "ids", "expires", "tiers")
+
+    def __init__(self):
+        self.hi = array("Q")
+        self.lo = array("Q")
+        self.ids = array("i")
+        self.expires = array("I")
+        self.tiers = array("b")
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def find(self, hi: int, lo: int) -> int:
+        """Vị trí của (hi, lo); -1 nếu không có"""
+        pos = bisect_left(self.hi, hi)
+        while pos < len(self.hi) and self.hi[pos] == hi:
+            if self.lo[pos] == lo:
+                return pos
+            pos += 1
+        return -1
+
+    def _append(self, values: tuple[int, int, int, int, int]) -> None:
+        for name, value in zip(self.__slots__, values):
+            getattr(self, name).append(value)
+
+    def _extend_from(self, other: "_Arrays", start: int, end: int) -> None:
+        if start < end:
+            for name in self.__slots__:
+                getattr(self, name).extend(getattr(other, name)[start:end])
+
+    def rebuilt(self, drop: set[int], inserts: list[tuple[int, int, int, int, int]]) -> "_Arrays":
+        """Bản mới bỏ các vị trí `drop` và chèn `inserts` (đã sort) - 1 lần copy cho cả batch"""
+        cuts = sorted(
+            [(bisect_left(self.hi, values[0]), 0, values) for values in inserts]
+            + [(pos, 1, ()) for pos in drop]
+        )
+        fresh = _Arrays()
+        start = 0
+        for pos, is_drop, values in cuts:
+            fresh._extend_from(self, start, pos)
+            if is_drop:
+                start = pos + 1
+            else:
+                fresh._append(values)
+                start = pos
+        fresh._extend_from(self, start, len(self))
+        return fresh
+
+
+_lock = threading.Lock()
+_wake = threading.Event()
+_snapshot: Optional[_Arrays] = None
+_state = {
+    "watermark": None,  # (updated_at, id) của row mới nhất đã áp dụng
+    "revocation_id": 0,
+    "loaded_at": 0.0,
+    "synced_at": 0.0,
+    "thread_pid": None,
+}
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except ValueError:
+        return default
+
+
+def _enabled_by_config() -> bool:
+    return os.getenv("KEY_SNAPSHOT_ENABLED", "true").lower() == "true"
+
+
+def is_enabled() -> bool:
+    return _enabled_by_config() and schema_registry.has_column("api_keys", "updated_at")
+
+
+def is_authoritative() -> bool:
+    return os.getenv("KEY_SNAPSHOT_AUTHORITATIVE", "false").lower() == "true"
+
+
+def _split_hash(key_hash: str) -> tuple[int, int]:
+    raw = bytes.fromhex(key_hash[:32])
+    return int.from_bytes(raw[:8], "big"), int.from_bytes(raw[8:16], "big")
+
+
+def _row_values(row) -> tuple[int, int, int, int, int]:
+    hi, lo = _split_hash(row["key_hash"])
+    expires = int(row["expires_at"].timestamp()) if row["expires_at"] else 0
+    tier = _TIERS.index(row["tier"]) if row["tier"] in _TIERS else 0
+    return hi, lo, int(row["id"]), expires, tier
+
+
+def _advance_watermark(row) -> None:
+    mark = (row["updated_at"], int(row["id"]))
+    if _state["watermark"] is None or mark > _state["watermark"]:
+        _state["watermark"] = mark
+
+
+def _get_db_connection():
+    from services.api_key_service import _get_db_connection as get_connection
+    return get_connection()
+
+
+def load_full() -> int:
+    """Load lại toàn bộ key active; trả về số key"""
+    fresh = _Arrays()
+    values = []
+    watermark = None
+    conn = _get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            if schema_registry.has_table("api_key_revocations"):
+                cursor.execute("SELECT COALESCE(MAX(id), 0) AS max_id FROM api_key_revocations")
+                revocation_id = int(cursor.fetchone()["max_id"])
+            else:
+                revocation_id = 0
+            last_id = 0
+            while True:
+                cursor.execute(
+                    """
+                    SELECT id, key_hash, tier, expires_at, updated_at
+                    FROM api_keys
+                    WHERE active = TRUE AND id > %s
+                    ORDER BY id
+                    LIMIT %s
+                    """,
+                    (last_id, _PAGE_SIZE),
+                )
+                rows = cursor.fetchall()
+                for row in rows:
+                    values.append(_row_values(row))
+                    mark = (row["updated_at"], int(row["id"]))
+                    if watermark is None or mark > watermark:
+                        watermark = mark
+                if len(rows) < _PAGE_SIZE:
+                    break
+                last_id = int(rows[-1]["id"])
+    finally:
+        conn.close()
+
+    values.sort()
+    for hi, lo, key_id, expires, tier in values:
+        fresh.hi.append(hi)
+        fresh.lo.append(lo)
+        fresh.ids.append(key_id)
+        fresh.expires.append(expires)
+        fresh.tiers.append(tier)
+
+    global _snapshot
+    with _lock:
+        _snapshot = fresh
+        _state["watermark"] = watermark
+        _state["revocation_id"] = revocation_id
+        _state["loaded_at"] = _state["synced_at"] = time.monotonic()
+    logger.info(f"key_snapshot_loaded | keys={len(fresh)}")
+    return len(fresh)
+
+
+def _apply_rows(rows: Iterable[dict]) -> None:
+    """Upsert các row (đang giữ _lock) trong 1 lần rebuild: active → có trong snapshot, ngược lại → bị loại"""
+    global _snapshot
+    latest = {}
+    for row in rows:
+        values = _row_values(row)
+        latest[values[:2]] = values if row["active"] else None  # Row sau cùng của cùng key thắng
+        if row.get("updated_at") is not None:
+            _advance_watermark(row)
+    if not latest:
+        return
+    drop = {pos for pos in (_snapshot.find(hi, lo) for hi, lo in latest) if pos >= 0}
+    _snapshot = _snapshot.rebuilt(drop, sorted(values for values in latest.values() if values is not None))
+
+
+def remove_ids(key_ids: Iterable[int]) -> None:
+    """Loại key theo id (key đã bị xóa khỏi DB, không còn hash để tra)"""
+    global _snapshot
+    key_ids = set(key_ids)
+    with _lock:
+        if _snapshot is None or not key_ids:
+            return
+        drop = {pos for pos, key_id in enumerate(_snapshot.ids) if key_id in key_ids}
+        if drop:
+            _snapshot = _snapshot.rebuilt(drop, [])
+
+
+def sync_delta() -> int:
+    """Fetch các row thay đổi từ watermark (có overlap để không sót transaction commit muộn)"""
+    if _snapshot is None or _state["watermark"] is None:
+        return load_full()
+
+    overlap = timedelta(seconds=_env_float("KEY_SNAPSHOT_SYNC_OVERLAP_SECONDS", 5.0))
+    since_at, since_id = _state["watermark"][0] - overlap, 0
+    changed = 0
+    conn = _get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            while True:
+                cursor.execute(
+                    """
+                    SELECT id, key_hash, tier, active, expires_at, updated_at
+                    FROM api_keys
+                    WHERE updated_at > %s OR (updated_at = %s AND id > %s)
+                    ORDER BY updated_at, id
+                    LIMIT %s
+                    """,
+                    (since_at, since_at, since_id, _DELTA_PAGE_SIZE),
+                )
+                rows = cursor.fetchall()
+                with _lock:
+                    _apply_rows(rows)
+                changed += len(rows)
+                if len(rows) < _DELTA_PAGE_SIZE:
+                    break
+                since_at, since_id = rows[-1]["updated_at"], int(rows[-1]["id"])
+
+            # Key bị xóa: row không còn → dựa vào revocation log của signed_keys (api_key_revocations)
+            if schema_registry.has_table("api_key_revocations"):
+                cursor.execute(
+                    "SELECT id, key_id FROM api_key_revocations WHERE id > %s ORDER BY id LIMIT 10000",
+                    (_state["revocation_id"],),
+                )
+                revocations = cursor.fetchall()
+                if revocations:
+                    key_ids = sorted({int(r["key_id"]) for r in revocations})
+                    placeholders = ", ".join(["%s"] * len(key_ids))
+                    cursor.execute(
+                        f"SELECT id, key_hash, tier, active, expires_at, updated_at FROM api_keys WHERE id IN ({placeholders})",
+                        key_ids,
+                    )
+                    existing = cursor.fetchall()
+                    remove_ids(set(key_ids) - {int(r["id"]) for r in existing})
+                    with _lock:
+                        _apply_rows(existing)
+                        _state["revocation_id"] = int(revocations[-1]["id"])
+    finally:
+        conn.close()
+
+    _state["synced_at"] = time.monotonic()
+    return changed
+
+
+def _sync_loop() -> None:
+    while True:
+        try:
+            # Kiểm tra schema trong thread (DB chưa sẵn sàng lúc khởi động → thử lại ở vòng sau)
+            if not is_enabled():
+                _wake.wait(_env_float("KEY_SNAPSHOT_SYNC_SECONDS", 2.0))
+                _wake.clear()
+                continue
+            full_reload_every = _env_float("KEY_SNAPSHOT_FULL_RELOAD_SECONDS", 3600.0)
+            if _snapshot is None or time.monotonic() - _state["loaded_at"] >= full_reload_every:
+                load_full()
+            else:
+                sync_delta()
+        except Exception as e:
+            logger.warning(f"key_snapshot_sync_failed | {type(e).__name__}: {e}")
+        _wake.wait(_env_float("KEY_SNAPSHOT_SYNC_SECONDS", 2.0))
+        _wake.clear()
+
+
+def _on_keys_changed(entity_ids: list[Optional[str]]) -> None:
+    """
+    Change-log scope api_key: key đổi ở worker/node khác → delta sync ngay thay vì chờ hết chu kỳ.
+    Delta theo updated_at không thấy row đã bị DELETE → tra lại các id, id không còn row thì loại ngay.
+    """
+    if None in entity_ids:
+        _state["loaded_at"] = 0.0  # Không rõ key nào → full reload ở vòng sync kế tiếp
+    elif _snapshot is not None:
+        key_ids = sorted({int(entity_id) for entity_id in entity_ids})
+        conn = _get_db_connection()
+        try:
+            with conn.cursor() as cursor:
+                placeholders = ", ".join(["%s"] * len(key_ids))
+                cursor.execute(f"SELECT id FROM api_keys WHERE id IN ({placeholders})", key_ids)
+                existing = {int(row["id"]) for row in cursor.fetchall()}
+        finally:
+            conn.close()
+        remove_ids(set(key_ids) - existing)
+    _wake.set()
+
+
+change_log.subscribe("api_key", _on_keys_changed)
+
+
+def start() -> None:
+    """Chạy thread load + delta sync (mỗi process một thread; gọi lại sau fork sẽ tạo thread mới)"""
+    if not _enabled_by_config() or _state["thread_pid"] == os.getpid():
+        return
+    _state["thread_pid"] = os.getpid()
+    threading.Thread(target=_sync_loop, name="key-snapshot-sync", daemon=True).start()
+
+
+def is_ready() -> bool:
+    """Snapshot đã load và được sync gần đây (KEY_SNAPSHOT_MAX_STALENESS_SECONDS)"""
+    if _state["thread_pid"] != os.getpid():
+        # Process con sau fork (gunicorn --preload) không có thread sync của process cha
+        if _state["thread_pid"] is not None:
+            start()
+        return False
+    if _snapshot is None:
+        return False
+    return time.monotonic() - _state["synced_at"] <= _env_float("KEY_SNAPSHOT_MAX_STALENESS_SECONDS", 30.0)
+
+
+def upsert(key_hash: str, key_id: int, tier: str, expires_at: Optional[datetime]) -> None:
+    """Thêm key vừa tạo vào snapshot của worker hiện tại (worker khác thấy sau lần delta sync kế tiếp)"""
+    with _lock:
+        if _snapshot is None:
+            return
+        _apply_rows([{"id": key_id, "key_hash": key_hash, "tier": tier, "active": True, "expires_at": expires_at}])
+
+
+def lookup(key_hash: str) -> Optional[tuple[int, str, Optional[datetime]]]:
+    """(key_id, tier, expires_at) nếu key active có trong snapshot, ngược lại None"""
+    hi, lo = _split_hash(key_hash)
+    with _lock:
+        snapshot = _snapshot
+        if snapshot is None:
+            return None
+        pos = snapshot.find(hi, lo)
+        if pos < 0:
+            return None
+        key_id, expires, tier = snapshot.ids[pos], snapshot.expires[pos], snapshot.tiers[pos]
+    return key_id, _TIERS[tier], datetime.fromtimestamp(expires) if expires else None
+
+
+def get_status() -> dict:
+    return {
+        "enabled": is_enabled() if schema_registry.is_loaded() else None,
+        "ready": is_ready(),
+        "keys": len(_snapshot) if _snapshot is not None else 0,
+        "seconds_since_sync": round(time.monotonic() - _state["synced_at"], 1) if _state["synced_at"] else None,
+    }
@@ -0,0 +1,270 @@
+"""
+Log Archive Service - Chuyển request_logs cũ sang file nén (cold archive)
+
+Layout trên disk (append-only):
+    {LOG_ARCHIVE_DIR}/{YYYY-MM-DD}/key_{api_key_id}.ndjson.gz   (key NULL -> key_none)
+    {LOG_ARCHIVE_DIR}/{YYYY-MM-DD}/index.json                   (sidecar index)
+
+Mỗi lần archive sẽ append thêm 1 gzip member vào segment (gzip cho phép nối nhiều member),
+nên không cần rewrite file cũ. Index lưu sẵn aggregate theo key/ngày để trả lời
+thống kê mà không cần giải nén.
+"""
+from __future__ import annotations
+
+import gzip
+import json
+import os
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from typing import Optional
+
+import pymysql
+
+from services import deadline
+
+# Số ngày giữ log trong bảng request_logs (hot), cũ hơn sẽ được archive
+DEFAULT_ARCHIVE_AFTER_DAYS = 90
+# Số rows đọc/xóa mỗi batch (giữ transaction nhỏ để không lock bảng lâu)
+DEFAULT_BATCH_SIZE = 5000
+
+_ARCHIVE_COLUMNS = (
+    "id", "request_id", "api_key_id", "api_key_prefix", "ip_address",
+    "method", "endpoint", "status_code", "response_time_ms",
+    "cccd_masked", "province_code", "province_version",
+    "is_valid_format", "is_plausible", "error_message", "created_at",
+)
+
+
+def _get_db_connection():
+    """Tạo connection MySQL từ environment variables"""
+    return pymysql.connect(
+        host=os.getenv("MYSQL_HOST", "localhost"),
+        port=int(os.getenv("MYSQL_PORT", "3306")),
+        user=os.getenv("MYSQL_USER", "root"),
+        password=os.getenv("MYSQL_PASSWORD", ""),
+        database=os.getenv("MYSQL_DATABASE", "cccd_api"),
+        cursorclass=pymysql.cursors.DictCursor,
+        **deadline.db_timeouts(),
+    )
+
+
+def get_archive_dir() -> Path:
+    """Thư mục chứa archive (LOG_ARCHIVE_DIR, mặc định: <repo>/archive/request_logs)"""
+    configured = os.getenv("LOG_ARCHIVE_DIR")
+    if configured:
+        return Path(configured)
+    repo_root = Path(__file__).resolve().parents[1]
+    return repo_root / "archive" / "request_logs"
+
+
+def _key_token(api_key_id: Optional[int]) -> str:
+    return "none" if api_key_id is None else str(int(api_key_id))
+
+
+def _segment_name(api_key_id: Optional[int]) -> str:
+    return f"key_{_key_token(api_key_id)}.ndjson.gz"
+
+
+def _day_dir(day: date) -> Path:
+    return get_archive_dir() / day.isoformat()
+
+
+def _load_index(day: date) -> dict:
+    path = _day_dir(day) / "index.json"
+    if not path.exists():
+        return {"date": day.isoformat(), "keys": {}}
+    return json.loads(path.read_text(encoding="utf-8"))
+
+
+def _write_index(day: date, index: dict) -> None:
+    """Ghi index atomically (temp file + rename) để không bao giờ đọc phải index dở dang"""
+    path = _day_dir(day) / "index.json"
+    tmp_path = path.with_suffix(".json.tmp")
+    tmp_path.write_text(json.dumps(index, ensure_ascii=False, sort_keys=True), encoding="utf-8")
+    os.replace(tmp_path, path)
+
+
+def _serialize_row(row: dict) -> dict:
+    result = {}
+    for column in _ARCHIVE_COLUMNS:
+        value = row.get(column)
+        if isinstance(value, datetime):
+            value = value.isoformat(sep=" ")
+        elif isinstance(value, date):
+            value = value.isoformat()
+        elif value is not None and column in ("is_valid_format", "is_plausible"):
+            value = bool(value)
+        result[column] = value
+    return result
+
+
+def _append_segment(day: date, api_key_id: Optional[int], rows: list[dict], index: dict) -> None:
+    """Append rows (đã sort theo id) vào segment của key/ngày và cập nhật aggregate trong index"""
+    entry = index["keys"].setdefault(
+        _key_token(api_key_id),
+        {
+            "file": _segment_name(api_key_id),
+            "rows": 0,
+            "success": 0,
+            "error": 0,
+            "response_time_sum_ms": 0,
+            "response_time_rows": 0,
+            "min_id": None,
+            "max_id": None,
+            "members": 0,
+        },
+    )
+
+    # Bỏ qua rows đã archive (trường hợp lần chạy trước crash sau khi append nhưng trước khi DELETE)
+    last_archived_id = entry["max_id"] or 0
+    rows = [r for r in rows if r["id"] > last_archived_id]
+    if not rows:
+        return
+
+    payload = "".join(json.dumps(_serialize_row(r), ensure_ascii=False) + "\n" for r in rows)
+    segment_path = _day_dir(day) / entry["file"]
+    with open(segment_path, "ab") as f:
+        f.write(gzip.compress(payload.encode("utf-8")))
+        f.flush()
+        os.fsync(f.fileno())
+
+    for r in rows:
+        status_code = r.get("status_code") or 0
+        if status_code == 200:
+            entry["success"] += 1
+        elif status_code >= 400:
+            entry["error"] += 1
+        if r.get("response_time_ms") is not None:
+            entry["response_time_sum_ms"] += int(r["response_time_ms"])
+            entry["response_time_rows"] += 1
+    entry["rows"] += len(rows)
+    entry["min_id"] = rows[0]["id"] if entry["min_id"] is None else entry["min_id"]
+    entry["max_id"] = rows[-1]["id"]
+    entry["members"] += 1
+
+
+def archive_request_logs(
+    older_than_days: Optional[int] = None,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    max_batches: Optional[int] = None,
+) -> dict:
+    """
+    Chuyển request_logs cũ hơn N ngày sang archive rồi xóa khỏi bảng hot.
+
+    Rows chỉ bị DELETE sau khi đã được ghi (fsync) vào segment và index đã cập nhật,
+    nên chạy lại sau khi bị gián đoạn không làm mất log (rows lỡ append 2 lần sẽ bị
+    bỏ qua khi đọc vì id trong segment luôn tăng dần).
+
+    Returns:
+        {"archived_rows": int, "batches": int, "days": [str, ...]}
+    """
+    if older_than_days is None:
+        older_than_days = int(os.getenv("LOG_ARCHIVE_AFTER_DAYS", str(DEFAULT_ARCHIVE_AFTER_DAYS)))
+    cutoff = datetime.combine(date.today() - timedelta(days=older_than_days), datetime.min.time())
+
+    archived_rows = 0
+    batches = 0
+    touched_days: set[str] = set()
+
+    conn = _get_db_connection()
+    try:
+        while max_batches is None or batches < max_batches:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    f"""
+                    SELECT {", ".join(_ARCHIVE_COLUMNS)}
+                    FROM request_logs
+                    WHERE created_at < %s
+                    ORDER BY id
+                    LIMIT %s
+                    """,
+                    (cutoff, batch_size),
+                )
+                rows = cursor.fetchall()
+            if not rows:
+                break
+
+            # Group theo (ngày, key)
+            grouped: dict[date, dict[Optional[int], list[dict]]] = {}
+            for row in rows:
+                day = row["created_at"].date()
+                grouped.setdefault(day, {}).setdefault(row["api_key_id"], []).append(row)
+
+            for day, by_key in grouped.items():
+                _day_dir(day).mkdir(parents=True, exist_ok=True)
+                index = _load_index(day)
+                for api_key_id, key_rows in by_key.items():
+                    _append_segment(day, api_key_id, key_rows, index)
+                _write_index(day, index)
+                touched_days.add(day.isoformat())
+
+            ids = [row["id"] for row in rows]
+            placeholders = ",".join(["%s"] * len(ids))
+            with conn.cursor() as cursor:
+                cursor.execute(f"DELETE FROM request_logs WHERE id IN ({placeholders})", ids)
+            conn.commit()
+
+            archived_rows += len(rows)
+            batches += 1
+            if len(rows) < batch_size:
+                break
+    finally:
+        conn.close()
+
+    return {
+        "archived_rows": archived_rows,
+        "batches": batches,
+        "days": sorted(touched_days),
+    }
+
+
+def get_archived_logs(api_key_id: Optional[int], day: date, limit: Optional[int] = None) -> list[dict]:
+    """Đọc log đã archive của 1 key trong 1 ngày (giải nén segment tương ứng)"""
+    entry = _load_index(day)["keys"].get(_key_token(api_key_id))
+    if not entry:
+        return []
+
+    segment_path = _day_dir(day) / entry["file"]
+    if not segment_path.exists():
+        return []
+
+    result = []
+    last_id = 0
+    with gzip.open(segment_path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            if row["id"] <= last_id:
+                continue  # Bản ghi trùng từ lần archive bị gián đoạn
+            last_id = row["id"]
+            result.append(row)
+            if limit is not None and len(result) >= limit:
+                break
+    return result
+
+
+def get_archived_daily_stats(api_key_id: Optional[int], start: date, end: date) -> list[dict]:
+    """
+    Thống kê theo ngày của 1 key từ archive (chỉ đọc index, không giải nén)
+    Format giống daily_stats trong usage_service.
+    """
+    result = []
+    day = end
+    while day >= start:
+        if (_day_dir(day) / "index.json").exists():
+            entry = _load_index(day)["keys"].get(_key_token(api_key_id))
+            if entry and entry["rows"]:
+                avg_response_time = (
+                    entry["response_time_sum_ms"] / entry["response_time_rows"]
+                    if entry["response_time_rows"] else 0
+                )
+                result.append({
+                    "date": day.isoformat(),
+                    "count": entry["rows"],
+                    "success": entry["success"],
+                    "error": entry["error"],
+                    "avg_response_time": float(avg_response_time),
+                })
+        day -= timedelta(days=1)
+    return result
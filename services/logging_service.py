@@ -8,6 +8,8 @@ from typing import Optional
 
 import pymysql
 
+from services import deadline
+
 
 def _get_db_connection():
     """Tạo connection MySQL từ environment variables"""
@@ -19,6 +21,7 @@ def _get_db_connection():
         password=os.getenv("MYSQL_PASSWORD", ""),
         database=os.getenv("MYSQL_DATABASE", "cccd_api"),
         cursorclass=pymysql.cursors.DictCursor,
+        **deadline.db_timeouts(),
     )
 
 
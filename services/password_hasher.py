@@ -0,0 +1,197 @@
+"""
+Password Hasher - Chạy bcrypt trong process pool riêng, có giới hạn hàng đợi
+
+bcrypt tốn hàng trăm ms CPU mỗi lần; chạy trong request thread thì một đợt login/register
+dồn dập chiếm hết thread + CPU của worker, kéo chậm cả traffic /v1/cccd/parse.
+- PASSWORD_HASH_WORKERS process (mặc định 2) làm bcrypt; 0 → chạy ngay trong request thread.
+- Tối đa PASSWORD_HASH_QUEUE_SIZE việc (đang chạy + đang chờ) mỗi worker;
+  đầy → raise PasswordHasherBusy ngay thay vì xếp hàng vô hạn.
+- Chờ kết quả tối đa PASSWORD_HASH_TIMEOUT_SECONDS (bị rút ngắn theo deadline của request).
+
+Cost (work factor) chỉnh theo deployment qua BCRYPT_ROUNDS (mặc định 12, như bcrypt.gensalt()).
+Hash cũ có cost khác được rehash khi user/admin đăng nhập thành công (needs_rehash).
+Chọn cost cho phần cứng hiện tại: flask --app run calibrate-bcrypt --target-ms 250
+"""
+from __future__ import annotations
+
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional
+
+import bcrypt
+
+from services import deadline
+
+_lock = threading.Lock()
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_pid: Optional[int] = None
+_slots: Optional[threading.BoundedSemaphore] = None
+
+
+BUSY_MESSAGE = "Hệ thống đang bận, vui lòng thử lại sau ít giây"
+
+
+class PasswordHasherBusy(Exception):
+    """Hàng đợi hash password đã đầy (hoặc hash quá lâu) - client nên thử lại sau"""
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except ValueError:
+        return default
+
+
+# bcrypt chấp nhận cost 4..31
+MIN_ROUNDS = 4
+MAX_ROUNDS = 31
+
+
+def get_rounds() -> int:
+    """Cost hiện tại cho hash mới (BCRYPT_ROUNDS)"""
+    return min(MAX_ROUNDS, max(MIN_ROUNDS, _env_int("BCRYPT_ROUNDS", 12)))
+
+
+def hash_rounds(password_hash: str) -> Optional[int]:
+    """Cost của một bcrypt hash ("$2b$12$..." → 12); None nếu không đọc được"""
+    parts = password_hash.split("$")
+    if len(parts) < 4 or not parts[2].isdigit():
+        return None
+    return int(parts[2])
+
+
+def needs_rehash(password_hash: str) -> bool:
+    """True nếu hash được tạo với cost khác cost hiện tại"""
+    return hash_rounds(password_hash) != get_rounds()
+
+
+# ===== Chạy trong process của pool =====
+
+def _hash(password: bytes, rounds: int) -> bytes:
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds=rounds))
+
+
+def _check(password: bytes, password_hash: bytes) -> bool:
+    try:
+        return bcrypt.checkpw(password, password_hash)
+    except ValueError:
+        # Hash hỏng/không phải bcrypt
+        return False
+
+
+# ===== Phía request =====
+
+def _start_method() -> str:
+    """
+    PASSWORD_HASH_START_METHOD; mặc định forkserver (process con không thừa hưởng
+    thread/connection của worker), spawn trên nền tảng không có forkserver (Windows/macOS cũ)
+    """
+    available = multiprocessing.get_all_start_methods()
+    method = os.getenv("PASSWORD_HASH_START_METHOD", "forkserver")
+    if method not in available:
+        method = "forkserver" if "forkserver" in available else "spawn"
+    return method
+
+
+def _reset_pool(broken: ProcessPoolExecutor) -> None:
+    """Bỏ pool bị hỏng (process con chết) để lần gọi sau tạo pool mới"""
+    global _pool, _pool_pid
+    with _lock:
+        if _pool is broken:
+            _pool = None
+            _pool_pid = None
+    broken.shutdown(wait=False, cancel_futures=True)
+
+
+def _get_pool() -> Optional[ProcessPoolExecutor]:
+    """Pool của process hiện tại (tạo lại sau fork); None nếu PASSWORD_HASH_WORKERS=0"""
+    global _pool, _pool_pid, _slots
+    if _pool_pid != os.getpid():
+        with _lock:
+            if _pool_pid != os.getpid():
+                workers = _env_int("PASSWORD_HASH_WORKERS", 2)
+                _slots = threading.BoundedSemaphore(max(1, _env_int("PASSWORD_HASH_QUEUE_SIZE", 16)))
+                context = multiprocessing.get_context(_start_method())
+                _pool = ProcessPoolExecutor(max_workers=workers, mp_context=context) if workers > 0 else None
+                _pool_pid = os.getpid()
+    return _pool
+
+
+def _run(fn, *args):
+    pool = _get_pool()
+    slots = _slots
+    if not slots.acquire(blocking=False):
+        raise PasswordHasherBusy("password hash queue is full")
+    if pool is None:
+        try:
+            return fn(*args)
+        finally:
+            slots.release()
+    try:
+        future = pool.submit(fn, *args)
+    except BrokenProcessPool as e:
+        slots.release()
+        _reset_pool(pool)
+        raise PasswordHasherBusy("password hash pool is broken") from e
+    except BaseException:
+        slots.release()
+        raise
+    # Trả slot khi việc thật sự xong (kể cả sau timeout) - việc còn chạy trong pool vẫn chiếm chỗ
+    future.add_done_callback(lambda _: slots.release())
+    try:
+        return future.result(timeout=deadline.bounded(float(os.getenv("PASSWORD_HASH_TIMEOUT_SECONDS", "5"))))
+    except FutureTimeoutError as e:
+        future.cancel()
+        raise PasswordHasherBusy("password hash timed out") from e
+    except BrokenProcessPool as e:
+        _reset_pool(pool)
+        raise PasswordHasherBusy("password hash pool is broken") from e
+
+
+def hash_password(password: str, rounds: Optional[int] = None) -> str:
+    """Hash password bằng bcrypt (trong pool), mặc định với cost BCRYPT_ROUNDS"""
+    return _run(_hash, password.encode("utf-8"), rounds or get_rounds()).decode("utf-8")
+
+
+def verify_password(password: str, password_hash: str) -> bool:
+    """Verify password với hash (trong pool)"""
+    return _run(_check, password.encode("utf-8"), password_hash.encode("utf-8"))
+
+
+def rehash_if_needed(password: str, password_hash: str) -> Optional[str]:
+    """
+    Hash mới với cost hiện tại nếu password_hash dùng cost khác (gọi sau khi verify thành công).
+    None nếu không cần rehash hoặc pool đang bận (để lần đăng nhập sau).
+    """
+    if not needs_rehash(password_hash):
+        return None
+    try:
+        return hash_password(password)
+    except PasswordHasherBusy:
+        return None
+
+
+def calibrate(target_ms: float = 250.0, max_rounds: int = 16, samples: int = 3) -> dict:
+    """
+    Đo thời gian verify trên máy hiện tại, chọn cost lớn nhất mà verify <= target_ms.
+    Chạy trực tiếp (không qua pool) để đo đúng CPU của một lần verify.
+    """
+    password = b"calibration-password"
+    timings = {}
+    chosen = MIN_ROUNDS
+    for rounds in range(MIN_ROUNDS, min(max_rounds, MAX_ROUNDS) + 1):
+        hashed = _hash(password, rounds)
+        started = time.perf_counter()
+        for _ in range(samples):
+            _check(password, hashed)
+        elapsed_ms = (time.perf_counter() - started) * 1000.0 / samples
+        timings[rounds] = round(elapsed_ms, 1)
+        if elapsed_ms > target_ms:
+            break
+        chosen = rounds
+    return {"rounds": chosen, "target_ms": target_ms, "timings_ms": timings}
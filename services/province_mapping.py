@@ -39,6 +39,14 @@ def load_province_map(version: ProvinceVersion) -> dict[str, str]:
     return mapping
 
 
+def clear_cache(version: ProvinceVersion | None = None) -> None:
+    """Bỏ mapping đã cache để lần sau đọc lại file JSON"""
+    if version is None:
+        _CACHE.clear()
+    else:
+        _CACHE.pop(version, None)
+
+
 def map_province_name(province_code: str | None, version: ProvinceVersion) -> str | None:
     if not province_code:
         return None
@@ -0,0 +1,114 @@
+"""
+Quota Service - Giới hạn số request/ngày theo tier (rate_limit_per_day trong get_tier_pricing)
+
+- Counter theo (key_id, ngày) giữ trong SharedMemoryTable → dùng chung giữa các worker,
+  mỗi request chỉ là một thao tác nguyên tử trên bộ nhớ, không query DB.
+- Lần đầu gặp key trong ngày: seed counter từ api_usage (request_count hôm nay).
+- Reconcile định kỳ (QUOTA_RECONCILE_SECONDS) với api_usage để bắt kịp request từ node khác:
+  counter = max(counter local, giá trị trong DB).
+- Request bị từ chối (vượt quota) không được tính vào counter.
+"""
+from __future__ import annotations
+
+import logging
+import os
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Optional
+
+from services.shared_memory import get_table
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class QuotaResult:
+    allowed: bool
+    limit: Optional[int]  # None = không giới hạn
+    remaining: Optional[int]
+    reset_at: Optional[float] = None  # epoch seconds (nửa đêm hôm sau)
+
+
+def _reconcile_interval() -> float:
+    try:
+        return float(os.getenv("QUOTA_RECONCILE_SECONDS", "60"))
+    except ValueError:
+        return 60.0
+
+
+def get_daily_limit(tier: str) -> Optional[int]:
+    """Quota/ngày của tier (None = không giới hạn)"""
+    from services.billing_service import get_tier_pricing
+    return get_tier_pricing().get(tier, {}).get("rate_limit_per_day")
+
+
+def _load_usage_today(key_id: int) -> int:
+    """request_count hôm nay của key trong api_usage"""
+    from services.api_key_service import _get_db_connection
+
+    conn = _get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT request_count FROM api_usage WHERE key_id = %s AND request_date = CURDATE()",
+                (key_id,),
+            )
+            row = cursor.fetchone()
+    finally:
+        conn.close()
+    return int(row["request_count"]) if row else 0
+
+
+def _counter_key(key_id: int, day: str) -> str:
+    return f"quota:{key_id}:{day}"
+
+
+def _sync_from_db(counter_key: str, key_id: int, expires_at: float) -> None:
+    """Seed/reconcile counter từ api_usage. Lỗi DB → giữ counter local (fail open)"""
+    try:
+        db_count = _load_usage_today(key_id)
+    except Exception as e:
+        logger.warning(f"quota_sync_failed | key_id={key_id} | {type(e).__name__}: {e}")
+        db_count = 0
+
+    def _merge(entry, now):
+        # aux = thời điểm reconcile gần nhất
+        value = max(entry[0], float(db_count)) if entry else float(db_count)
+        return (value, now, expires_at), None
+
+    get_table().update(counter_key, _merge)
+
+
+def consume(key_id: int, tier: str) -> QuotaResult:
+    """
+    Tính 1 request vào quota ngày của key.
+    Trả về allowed=False (không tính) nếu đã hết quota.
+    """
+    limit = get_daily_limit(tier)
+    if limit is None:
+        return QuotaResult(allowed=True, limit=None, remaining=None)
+
+    today = datetime.now().date()
+    reset_at = datetime.combine(today + timedelta(days=1), datetime.min.time()).timestamp()
+    counter_key = _counter_key(key_id, today.isoformat())
+    table = get_table()
+
+    entry = table.get(counter_key)
+    if entry is None or time.time() - entry[1] >= _reconcile_interval():
+        # DB I/O nằm ngoài lock của bảng; chỉ merge kết quả là thao tác nguyên tử
+        _sync_from_db(counter_key, key_id, reset_at)
+
+    def _consume(entry, now):
+        value, synced_at, _ = entry if entry else (0.0, now, reset_at)
+        if value + 1 > limit:
+            return (value, synced_at, reset_at), (False, value)
+        return (value + 1, synced_at, reset_at), (True, value + 1)
+
+    allowed, used = table.update(counter_key, _consume)
+    return QuotaResult(
+        allowed=allowed,
+        limit=limit,
+        remaining=max(0, limit - int(used)),
+        reset_at=reset_at,
+    )
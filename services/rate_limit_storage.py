@@ -0,0 +1,61 @@
+"""
+Rate Limit Storage - Backend cho Flask-Limiter dùng chung counter giữa các worker trên một node
+
+Dùng: RATE_LIMIT_STORAGE_URI=shm://                     (path mặc định, xem services.shared_memory)
+      RATE_LIMIT_STORAGE_URI=shm:///dev/shm/cccd_rl     (path tùy chọn)
+
+Với "memory://" mỗi gunicorn worker giữ counter riêng → limit thực tế nhân theo số worker.
+Backend này lưu counter trong SharedMemoryTable (mmap) nên mọi worker thấy cùng một giá trị,
+mỗi lần hit chỉ là một read-modify-write dưới lock của một stripe.
+Hỗ trợ strategy fixed-window (mặc định của Flask-Limiter).
+Không có mmap/fcntl (Windows) → scheme shm:// không được đăng ký, app dùng memory://.
+"""
+from __future__ import annotations
+
+import time
+import urllib.parse
+
+from limits.storage import Storage
+
+from services.shared_memory import IS_SUPPORTED, get_table
+
+# Import module này để đăng ký scheme "shm://" với limits
+STORAGE_SCHEME = "shm"
+
+
+class SharedMemoryStorage(Storage):
+    # Danh sách rỗng → limits không đăng ký scheme
+    STORAGE_SCHEME = [STORAGE_SCHEME] if IS_SUPPORTED else []
+
+    def __init__(self, uri: str | None = None, wrap_exceptions: bool = False, **options):
+        path = urllib.parse.urlparse(uri).path if uri else ""
+        self.table = get_table(path or None)
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+
+    @property
+    def base_exceptions(self):
+        return (OSError, ValueError)
+
+    @staticmethod
+    def _key(key: str) -> str:
+        return f"rl:{key}"
+
+    def incr(self, key: str, expiry: int, amount: int = 1) -> int:
+        return int(self.table.incr(self._key(key), amount, expiry))
+
+    def get(self, key: str) -> int:
+        entry = self.table.get(self._key(key))
+        return int(entry[0]) if entry else 0
+
+    def get_expiry(self, key: str) -> float:
+        entry = self.table.get(self._key(key))
+        return entry[2] if entry else time.time()
+
+    def check(self) -> bool:
+        return True
+
+    def reset(self) -> int | None:
+        return self.table.clear_all()
+
+    def clear(self, key: str) -> None:
+        self.table.delete(self._key(key))
@@ -0,0 +1,161 @@
+"""
+Schema Registry - Cache thông tin schema (bảng/cột optional) cho các service
+
+Nhiều tính năng (label, api_key_history, email verification, password reset...) được thêm
+bằng migration riêng nên code phải kiểm tra bảng/cột có tồn tại hay không. Thay vì query
+INFORMATION_SCHEMA (hoặc thử query rồi fallback) trong mỗi request, registry probe 1 lần
+khi khởi động và refresh định kỳ (SCHEMA_REGISTRY_REFRESH_SECONDS, mặc định 300s).
+Cùng lần probe lấy luôn các cột có FULLTEXT index (search dùng MATCH thay vì LIKE nếu có).
+
+Chưa probe thành công lần nào (DB chưa sẵn sàng lúc khởi động) → has_* probe đồng bộ, lỗi thì raise
+SchemaUnavailable thay vì trả False (không được coi bảng/cột là không tồn tại chỉ vì chưa biết).
+"""
+from __future__ import annotations
+
+import logging
+import os
+import threading
+import time
+
+import pymysql
+
+from services import deadline
+
+logger = logging.getLogger(__name__)
+
+# Nếu probe lỗi (DB chưa sẵn sàng), thử lại sau khoảng này thay vì chờ hết refresh interval
+_RETRY_AFTER_FAILURE_SECONDS = 5.0
+
+_lock = threading.Lock()
+_probe_lock = threading.Lock()
+_columns: dict[str, frozenset[str]] = {}
+_fulltext: frozenset[tuple[str, str]] = frozenset()
+_loaded = False
+_next_refresh_at = 0.0
+
+
+class SchemaUnavailable(pymysql.err.OperationalError):
+    """Chưa probe được schema lần nào → không biết bảng/cột có tồn tại hay không"""
+
+
+def _get_db_connection():
+    """Tạo connection MySQL từ environment variables"""
+    return pymysql.connect(
+        host=os.getenv("MYSQL_HOST", "localhost"),
+        port=int(os.getenv("MYSQL_PORT", "3306")),
+        user=os.getenv("MYSQL_USER", "root"),
+        password=os.getenv("MYSQL_PASSWORD", ""),
+        database=os.getenv("MYSQL_DATABASE", "cccd_api"),
+        cursorclass=pymysql.cursors.DictCursor,
+        **deadline.db_timeouts(),
+    )
+
+
+def _refresh_interval() -> float:
+    try:
+        return float(os.getenv("SCHEMA_REGISTRY_REFRESH_SECONDS", "300"))
+    except ValueError:
+        return 300.0
+
+
+def refresh() -> bool:
+    """
+    Probe toàn bộ bảng/cột (và FULLTEXT index) của database hiện tại
+    Returns: True nếu probe thành công
+    """
+    global _columns, _fulltext, _loaded, _next_refresh_at
+
+    try:
+        conn = _get_db_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    """
+                    SELECT TABLE_NAME, COLUMN_NAME
+                    FROM INFORMATION_SCHEMA.COLUMNS
+                    WHERE TABLE_SCHEMA = DATABASE()
+                    """
+                )
+                rows = cursor.fetchall()
+                cursor.execute(
+                    """
+                    SELECT TABLE_NAME, COLUMN_NAME
+                    FROM INFORMATION_SCHEMA.STATISTICS
+                    WHERE TABLE_SCHEMA = DATABASE() AND INDEX_TYPE = 'FULLTEXT'
+                    """
+                )
+                fulltext_rows = cursor.fetchall()
+        finally:
+            conn.close()
+    except Exception as e:
+        logger.warning(f"Schema registry probe failed: {e}")
+        with _lock:
+            _next_refresh_at = time.monotonic() + _RETRY_AFTER_FAILURE_SECONDS
+        return False
+
+    tables: dict[str, set[str]] = {}
+    for row in rows:
+        tables.setdefault(row["TABLE_NAME"].lower(), set()).add(row["COLUMN_NAME"].lower())
+
+    with _lock:
+        _columns = {name: frozenset(cols) for name, cols in tables.items()}
+        _fulltext = frozenset((row["TABLE_NAME"].lower(), row["COLUMN_NAME"].lower()) for row in fulltext_rows)
+        _loaded = True
+        _next_refresh_at = time.monotonic() + _refresh_interval()
+    return True
+
+
+def invalidate() -> None:
+    """Bắt buộc probe lại ở lần truy cập kế tiếp (vd: sau khi chạy migration)"""
+    global _next_refresh_at
+    with _lock:
+        _next_refresh_at = 0.0
+
+
+def _ensure_loaded() -> None:
+    """Probe đồng bộ nếu chưa có dữ liệu; raise SchemaUnavailable nếu DB vẫn lỗi"""
+    with _probe_lock:
+        # Thread khác vừa probe lỗi → không probe lại ngay (tránh mỗi request chờ connect timeout)
+        if not _loaded and time.monotonic() >= _next_refresh_at:
+            refresh()
+    if not _loaded:
+        raise SchemaUnavailable("Schema registry chưa probe được database")
+
+
+def _ensure_fresh() -> None:
+    global _next_refresh_at
+    if not _loaded:
+        _ensure_loaded()
+        return
+    now = time.monotonic()
+    if now < _next_refresh_at:
+        return
+    with _lock:
+        if now < _next_refresh_at:
+            return
+        # Đẩy deadline lên trước để chỉ 1 thread probe, các thread khác dùng dữ liệu hiện có
+        _next_refresh_at = now + _RETRY_AFTER_FAILURE_SECONDS
+    refresh()
+
+
+def has_table(table: str) -> bool:
+    """Kiểm tra bảng có tồn tại (theo lần probe gần nhất); raise SchemaUnavailable nếu chưa probe được"""
+    _ensure_fresh()
+    return table.lower() in _columns
+
+
+def has_column(table: str, column: str) -> bool:
+    """Kiểm tra cột có tồn tại trong bảng (theo lần probe gần nhất)"""
+    _ensure_fresh()
+    return column.lower() in _columns.get(table.lower(), ())
+
+
+def has_fulltext_index(table: str, column: str) -> bool:
+    """Kiểm tra cột có FULLTEXT index (theo lần probe gần nhất)"""
+    _ensure_fresh()
+    return (table.lower(), column.lower()) in _fulltext
+
+
+def is_loaded() -> bool:
+    """True nếu đã probe thành công ít nhất 1 lần (has_* không raise SchemaUnavailable)"""
+    return _loaded
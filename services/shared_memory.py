@@ -0,0 +1,302 @@
+"""
+Shared Memory Table - Bảng key → counter dùng chung giữa các worker (gunicorn) trên cùng một node
+
+- Lưu trong một file mmap (mặc định /dev/shm/cccd_api_shared) → không cần round trip tới Redis.
+- Mỗi slot: digest(key) 16 bytes + expires_at + value + aux (float64).
+- Bảng chia thành nhiều stripe; mỗi stripe có một lock riêng:
+  fcntl.lockf trên 1 byte của stripe (loại trừ giữa các process) + threading.Lock (giữa các thread).
+  Mọi thao tác read-modify-write trên một key chỉ cần giữ lock của stripe chứa key đó.
+- Stripe đầy (toàn key còn hạn) → ghi đè slot sắp hết hạn nhất (best effort, giống cache).
+- Không có fcntl/mmap POSIX (Windows, waitress) → IS_SUPPORTED = False: get_table() trả về LocalTable
+  (dict riêng của process, cùng interface) và scheme shm:// không được đăng ký.
+
+Cấu hình:
+    SHARED_MEMORY_PATH   (mặc định /dev/shm/cccd_api_shared, hoặc thư mục temp nếu không có /dev/shm)
+    SHARED_MEMORY_SLOTS  (mặc định 65536 slot ≈ 2.5MB)
+"""
+from __future__ import annotations
+
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Callable, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# mmap dùng chung giữa các process cần fcntl.lockf + os.pread/pwrite + mmap.MAP_SHARED (POSIX)
+IS_SUPPORTED = fcntl is not None and hasattr(os, "pread") and hasattr(mmap, "MAP_SHARED")
+
+_MAGIC = b"CCCDSHM1"
+# magic, số stripe, số slot mỗi stripe
+_HEADER = struct.Struct("<8sII")
+_HEADER_SIZE = 64
+# digest, expires_at, value, aux
+_SLOT = struct.Struct("<16sddd")
+_EMPTY_DIGEST = b"\x00" * 16
+
+_DEFAULT_STRIPES = 256
+
+# (value, aux, expires_at) của một key; expires_at <= now nghĩa là key không tồn tại
+Entry = Tuple[float, float, float]
+
+
+def default_path() -> str:
+    path = os.getenv("SHARED_MEMORY_PATH")
+    if path:
+        return path
+    base = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(base, "cccd_api_shared")
+
+
+class _TableOps(ABC):
+    """Các thao tác dựng trên update() (dùng chung cho SharedMemoryTable và LocalTable)"""
+
+    @abstractmethod
+    def update(self, key: str, fn: Callable[[Optional[Entry], float], Tuple[Optional[Entry], object]]):
+        """Đọc-sửa-ghi nguyên tử: fn(entry hiện tại hoặc None, now) → (entry mới hoặc None để xóa, kết quả)"""
+
+    def get(self, key: str) -> Optional[Entry]:
+        return self.update(key, lambda entry, now: (entry, entry))
+
+    def incr(self, key: str, amount: float, expiry: float) -> float:
+        """Cộng amount vào counter; key mới/đã hết hạn bắt đầu window mới dài expiry giây"""
+        def _incr(entry, now):
+            if entry is None:
+                new_entry = (float(amount), 0.0, now + expiry)
+            else:
+                value, aux, expires_at = entry
+                new_entry = (value + amount, aux, expires_at)
+            return new_entry, new_entry[0]
+
+        return self.update(key, _incr)
+
+    def delete(self, key: str) -> None:
+        self.update(key, lambda entry, now: (None, None))
+
+
+class LocalTable(_TableOps):
+    """Bảng riêng của process trên dict (fallback khi không có mmap/fcntl), giới hạn `slots` key"""
+
+    def __init__(self, slots: int = 65536):
+        self.slots = slots
+        self._entries: dict[str, Entry] = {}
+        self._lock = threading.Lock()
+
+    def _evict(self, now: float) -> None:
+        """Đầy → bỏ key hết hạn; vẫn đầy → bỏ key sắp hết hạn nhất (giống stripe đầy của mmap)"""
+        expired = [key for key, entry in self._entries.items() if entry[2] <= now]
+        for key in expired:
+            del self._entries[key]
+        if len(self._entries) >= self.slots:
+            del self._entries[min(self._entries, key=lambda key: self._entries[key][2])]
+
+    def update(self, key: str, fn: Callable[[Optional[Entry], float], Tuple[Optional[Entry], object]]):
+        with self._lock:
+            now = time.time()
+            current = self._entries.get(key)
+            if current is not None and current[2] <= now:
+                current = None
+            new_entry, result = fn(current, now)
+            if new_entry is not None:
+                if key not in self._entries and len(self._entries) >= self.slots:
+                    self._evict(now)
+                self._entries[key] = tuple(new_entry)
+            else:
+                self._entries.pop(key, None)
+            return result
+
+    def clear_all(self) -> int:
+        with self._lock:
+            now = time.time()
+            cleared = sum(1 for entry in self._entries.values() if entry[2] > now)
+            self._entries.clear()
+        return cleared
+
+
+class SharedMemoryTable(_TableOps):
+    """Hash table kích thước cố định trên mmap, an toàn giữa các process và thread"""
+
+    def __init__(self, path: Optional[str], slots: int = 65536, stripes: int = _DEFAULT_STRIPES):
+        """path = None → bảng riêng của process (file tạm đã unlink), dùng khi không cần chia sẻ"""
+        self.path = path
+        self._requested_slots = max(slots, stripes)
+        self._requested_stripes = stripes
+        self._open()
+
+    # ------------------------------------------------------------------ setup
+
+    def _open(self) -> None:
+        self._pid = os.getpid()
+        if self.path is None:
+            fd, tmp_path = tempfile.mkstemp(prefix="cccd_api_shared_")
+            os.unlink(tmp_path)
+        else:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            # Lock byte đầu của header trong lúc khởi tạo để các worker không init chồng lên nhau
+            fcntl.lockf(fd, fcntl.LOCK_EX, 1, 0)
+            try:
+                header = os.pread(fd, _HEADER.size, 0)
+                if len(header) == _HEADER.size and header[:8] == _MAGIC:
+                    _, stripes, per_stripe = _HEADER.unpack(header)
+                else:
+                    stripes = self._requested_stripes
+                    per_stripe = self._requested_slots // stripes
+                    os.ftruncate(fd, 0)
+                    os.ftruncate(fd, self._data_offset(stripes) + stripes * per_stripe * _SLOT.size)
+                    os.pwrite(fd, _HEADER.pack(_MAGIC, stripes, per_stripe), 0)
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN, 1, 0)
+            size = os.fstat(fd).st_size
+            self._mm = mmap.mmap(fd, size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        except Exception:
+            os.close(fd)
+            raise
+        self._fd = fd
+        self.stripes = stripes
+        self.slots_per_stripe = per_stripe
+        self._data_start = self._data_offset(stripes)
+        self._thread_locks = [threading.Lock() for _ in range(stripes)]
+
+    @staticmethod
+    def _data_offset(stripes: int) -> int:
+        # Sau header là vùng lock: mỗi stripe 1 byte (chỉ dùng làm range cho fcntl.lockf)
+        return _HEADER_SIZE + stripes
+
+    def _check_fork(self) -> None:
+        # mmap MAP_SHARED vẫn dùng được sau fork, nhưng fcntl lock không được kế thừa và
+        # threading.Lock có thể đang bị giữ bởi thread của process cha → khởi tạo lại
+        if os.getpid() != self._pid:
+            self._pid = os.getpid()
+            self._thread_locks = [threading.Lock() for _ in range(self.stripes)]
+
+    @contextmanager
+    def _stripe_lock(self, stripe: int):
+        thread_lock = self._thread_locks[stripe]
+        with thread_lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, _HEADER_SIZE + stripe)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, _HEADER_SIZE + stripe)
+
+    # --------------------------------------------------------------- lookups
+
+    @staticmethod
+    def _digest(key: str) -> bytes:
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        return digest if digest != _EMPTY_DIGEST else b"\x01" + digest[1:]
+
+    def _locate(self, digest: bytes) -> Tuple[int, int]:
+        stripe = int.from_bytes(digest[:4], "little") % self.stripes
+        start = int.from_bytes(digest[4:8], "little") % self.slots_per_stripe
+        return stripe, start
+
+    def _slot_offset(self, stripe: int, index: int) -> int:
+        return self._data_start + (stripe * self.slots_per_stripe + index) * _SLOT.size
+
+    def _find_slot(self, stripe: int, start: int, digest: bytes, now: float) -> Tuple[int, bool]:
+        """
+        Linear probing trong stripe (phải giữ lock của stripe).
+        Trả về (offset, found): offset của slot chứa key, hoặc slot nên dùng để ghi key mới.
+        """
+        reusable = None
+        oldest_offset, oldest_expiry = None, None
+        mm = self._mm
+        for step in range(self.slots_per_stripe):
+            offset = self._slot_offset(stripe, (start + step) % self.slots_per_stripe)
+            slot_digest, expires_at, _, _ = _SLOT.unpack_from(mm, offset)
+            if slot_digest == _EMPTY_DIGEST:
+                # Slot chưa từng dùng → key chắc chắn không nằm xa hơn
+                return (reusable if reusable is not None else offset), False
+            if slot_digest == digest:
+                return offset, expires_at > now
+            if expires_at <= now:
+                if reusable is None:
+                    reusable = offset
+            elif oldest_expiry is None or expires_at < oldest_expiry:
+                oldest_offset, oldest_expiry = offset, expires_at
+        return (reusable if reusable is not None else oldest_offset), False
+
+    # ---------------------------------------------------------------- public
+
+    def update(self, key: str, fn: Callable[[Optional[Entry], float], Tuple[Optional[Entry], object]]):
+        """
+        Read-modify-write nguyên tử trên một key.
+
+        fn(entry, now) nhận (value, aux, expires_at) hiện tại (None nếu chưa có/đã hết hạn)
+        và trả về (entry_mới, kết_quả). entry_mới = None → xóa key. Trả về kết_quả.
+        """
+        self._check_fork()
+        digest = self._digest(key)
+        stripe, start = self._locate(digest)
+        with self._stripe_lock(stripe):
+            now = time.time()
+            offset, found = self._find_slot(stripe, start, digest, now)
+            current = None
+            if found:
+                _, expires_at, value, aux = _SLOT.unpack_from(self._mm, offset)
+                current = (value, aux, expires_at)
+            new_entry, result = fn(current, now)
+            if new_entry is not None:
+                value, aux, expires_at = new_entry
+                _SLOT.pack_into(self._mm, offset, digest, expires_at, value, aux)
+            elif found:
+                # Giữ digest làm tombstone để không cắt đứt chuỗi probing của key khác
+                _SLOT.pack_into(self._mm, offset, digest, 0.0, 0.0, 0.0)
+            return result
+
+    def clear_all(self) -> int:
+        """Xóa toàn bộ bảng, trả về số key còn hạn đã bị xóa"""
+        self._check_fork()
+        cleared = 0
+        empty = _SLOT.pack(_EMPTY_DIGEST, 0.0, 0.0, 0.0)
+        for stripe in range(self.stripes):
+            with self._stripe_lock(stripe):
+                now = time.time()
+                for index in range(self.slots_per_stripe):
+                    offset = self._slot_offset(stripe, index)
+                    _, expires_at, _, _ = _SLOT.unpack_from(self._mm, offset)
+                    if expires_at > now:
+                        cleared += 1
+                    self._mm[offset:offset + _SLOT.size] = empty
+        return cleared
+
+
+_tables: dict[str, _TableOps] = {}
+_tables_lock = threading.Lock()
+
+
+def _slots_from_env() -> int:
+    try:
+        return int(os.getenv("SHARED_MEMORY_SLOTS", "65536"))
+    except ValueError:
+        return 65536
+
+
+def create_private_table(slots: int) -> _TableOps:
+    """Bảng riêng của process (không chia sẻ giữa các worker)"""
+    return SharedMemoryTable(None, slots=slots) if IS_SUPPORTED else LocalTable(slots=slots)
+
+
+def get_table(path: Optional[str] = None) -> _TableOps:
+    """Bảng dùng chung của process (một instance cho mỗi path); không hỗ trợ mmap → LocalTable"""
+    path = path or default_path()
+    table = _tables.get(path)
+    if table is None:
+        with _tables_lock:
+            table = _tables.get(path)
+            if table is None:
+                slots = _slots_from_env()
+                table = SharedMemoryTable(path, slots=slots) if IS_SUPPORTED else LocalTable(slots=slots)
+                _tables[path] = table
+    return table
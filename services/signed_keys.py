@@ -0,0 +1,179 @@
+"""
+Signed API Keys - Key tự xác thực (HMAC) để /v1/cccd/parse không cần tra DB
+
+Format: {tier_prefix}_{nonce}.{key_id}.{expires_epoch}.{signature}
+    vd: prem_9f2c4e1ab3d05e77.1234.1767225600.Qm9vZ2xlLXNpZ25hdHVyZQ
+- tier_prefix (free/prem/ultr), key_id, expires (0 = vĩnh viễn) nằm trong chữ ký
+  HMAC-SHA256(API_KEY_SIGNING_SECRET) → verify bằng CPU, không cần storage.
+- key_prefix lưu trong DB (12 ký tự đầu) có dạng giống key cũ: "prem_9f2c4e1".
+- Key cũ free_/prem_/ultr_ (không có dấu ".") vẫn validate qua DB như trước.
+- Xoay secret: API_KEY_SIGNING_SECRET_PREVIOUS vẫn được chấp nhận khi verify.
+
+Revocation list: key_id trong api_key_revocations là key mà claims trong token không còn đáng tin
+(bị xóa, vô hiệu hóa, đổi hạn...) → validate các key này qua DB. Danh sách được poll tăng dần
+theo id mỗi API_KEY_REVOCATION_REFRESH_SECONDS; quá API_KEY_REVOCATION_MAX_STALENESS_SECONDS
+không refresh được (hoặc chưa có bảng) → tắt fast path, mọi key validate qua DB.
+
+    CREATE TABLE api_key_revocations (
+        id BIGINT AUTO_INCREMENT PRIMARY KEY,
+        key_id INT NOT NULL,
+        reason VARCHAR(32) NULL,
+        revoked_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        INDEX idx_key_id (key_id)
+    );
+"""
+from __future__ import annotations
+
+import base64
+import hashlib
+import hmac
+import logging
+import os
+import secrets
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Iterable, Optional
+
+from services import schema_registry
+
+logger = logging.getLogger(__name__)
+
+_TIER_BY_PREFIX = {"free": "free", "prem": "premium", "ultr": "ultra"}
+_SIGNATURE_BYTES = 16
+
+_revoked_ids: set[int] = set()
+_revocation_state = {
+    "last_id": 0,
+    "refreshed_at": 0.0,  # time.monotonic() của lần refresh thành công gần nhất
+    "next_refresh_at": 0.0,
+}
+_refresh_lock = threading.Lock()
+
+
+@dataclass(frozen=True)
+class SignedClaims:
+    key_id: int
+    tier: str
+    key_prefix: str
+    expires_at: Optional[datetime]
+
+    @property
+    def expired(self) -> bool:
+        return self.expires_at is not None and datetime.now() > self.expires_at
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except ValueError:
+        return default
+
+
+def _secrets() -> list[bytes]:
+    values = [os.getenv("API_KEY_SIGNING_SECRET"), os.getenv("API_KEY_SIGNING_SECRET_PREVIOUS")]
+    return [v.encode() for v in values if v]
+
+
+def is_enabled() -> bool:
+    """Signed key chỉ được phát hành khi có secret"""
+    return bool(os.getenv("API_KEY_SIGNING_SECRET"))
+
+
+def looks_signed(api_key: str) -> bool:
+    return "." in api_key
+
+
+def _sign(secret: bytes, message: str) -> str:
+    digest = hmac.new(secret, message.encode(), hashlib.sha256).digest()[:_SIGNATURE_BYTES]
+    return base64.urlsafe_b64encode(digest).rstrip(b"=").decode()
+
+
+def issue(tier_prefix: str, key_id: int, expires_at: Optional[datetime]) -> str:
+    """Tạo signed key cho key_id đã có trong DB"""
+    nonce = secrets.token_hex(8)
+    expires = int(expires_at.timestamp()) if expires_at else 0
+    message = f"{tier_prefix}_{nonce}.{key_id}.{expires}"
+    return f"{message}.{_sign(_secrets()[0], message)}"
+
+
+def verify(api_key: str) -> Optional[SignedClaims]:
+    """Verify chữ ký; None nếu không phải signed key hợp lệ (không tra DB)"""
+    try:
+        message, signature = api_key.rsplit(".", 1)
+        head, key_id, expires = message.split(".")
+        tier_prefix = head.split("_", 1)[0]
+        tier = _TIER_BY_PREFIX[tier_prefix]
+        key_id_int, expires_int = int(key_id), int(expires)
+    except (ValueError, KeyError):
+        return None
+    if not any(hmac.compare_digest(_sign(secret, message), signature) for secret in _secrets()):
+        return None
+    return SignedClaims(
+        key_id=key_id_int,
+        tier=tier,
+        key_prefix=api_key[:12],
+        expires_at=datetime.fromtimestamp(expires_int) if expires_int else None,
+    )
+
+
+# ===== Revocation list =====
+
+def _refresh_revocations() -> None:
+    from services.api_key_service import _get_auth_db_connection
+
+    conn = _get_auth_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            while True:
+                cursor.execute(
+                    "SELECT id, key_id FROM api_key_revocations WHERE id > %s ORDER BY id LIMIT 10000",
+                    (_revocation_state["last_id"],),
+                )
+                rows = cursor.fetchall()
+                for row in rows:
+                    _revoked_ids.add(int(row["key_id"]))
+                if rows:
+                    _revocation_state["last_id"] = int(rows[-1]["id"])
+                if len(rows) < 10000:
+                    break
+    finally:
+        conn.close()
+    _revocation_state["refreshed_at"] = time.monotonic()
+
+
+def revocation_list_fresh() -> bool:
+    """
+    Refresh revocation list nếu đến hạn (chỉ một thread refresh, các thread khác dùng bản hiện có).
+    True nếu danh sách đủ mới để tin claims trong signed key.
+    """
+    if not schema_registry.has_table("api_key_revocations"):
+        return False
+    now = time.monotonic()
+    if now >= _revocation_state["next_refresh_at"] and _refresh_lock.acquire(blocking=False):
+        try:
+            _revocation_state["next_refresh_at"] = now + _env_float("API_KEY_REVOCATION_REFRESH_SECONDS", 2.0)
+            _refresh_revocations()
+        except Exception as e:
+            logger.warning(f"revocation_refresh_failed | {type(e).__name__}: {e}")
+        finally:
+            _refresh_lock.release()
+    staleness = time.monotonic() - _revocation_state["refreshed_at"]
+    return staleness <= _env_float("API_KEY_REVOCATION_MAX_STALENESS_SECONDS", 30.0)
+
+
+def is_revoked(key_id: int) -> bool:
+    return key_id in _revoked_ids
+
+
+def record_revocations(cursor, key_ids: Iterable[int], reason: str) -> None:
+    """Ghi revocation trong transaction của write path (bỏ qua nếu chưa có bảng)"""
+    if not schema_registry.has_table("api_key_revocations"):
+        return
+    rows = [(int(key_id), reason) for key_id in key_ids]
+    if rows:
+        cursor.executemany(
+            "INSERT INTO api_key_revocations (key_id, reason) VALUES (%s, %s)",
+            rows,
+        )
@@ -6,20 +6,12 @@ from __future__ import annotations
 from datetime import datetime, timedelta
 from typing import Optional
 
-import pymysql
+from services import db_router, schema_registry
 
 
-def _get_db_connection():
-    """Tạo connection MySQL từ environment variables"""
-    import os
-    return pymysql.connect(
-        host=os.getenv("MYSQL_HOST", "localhost"),
-        port=int(os.getenv("MYSQL_PORT", "3306")),
-        user=os.getenv("MYSQL_USER", "root"),
-        password=os.getenv("MYSQL_PASSWORD", ""),
-        database=os.getenv("MYSQL_DATABASE", "cccd_api"),
-        cursorclass=pymysql.cursors.DictCursor,
-    )
+def _get_db_connection(user_id: Optional[int] = None):
+    """Connection chỉ đọc (replica nếu có) - service này chỉ chạy query thống kê"""
+    return db_router.get_read_connection(scope=f"user:{user_id}" if user_id else None)
 
 
 def get_user_usage_stats(user_id: int, days: int = 30) -> dict:
@@ -44,7 +36,7 @@ def get_user_usage_stats(user_id: int, days: int = 30) -> dict:
         }
     """
     try:
-        conn = _get_db_connection()
+        conn = _get_db_connection(user_id)
         try:
             with conn.cursor() as cursor:
                 # Get all API keys của user
@@ -180,17 +172,18 @@ def get_usage_stats_by_key(user_id: int, days: int = 30) -> list[dict]:
         ]
     """
     try:
-        conn = _get_db_connection()
+        conn = _get_db_connection(user_id)
         try:
             with conn.cursor() as cursor:
                 # Get all API keys của user với prefix và tier
+                label_column = "ak.label" if schema_registry.has_column("api_keys", "label") else "NULL AS label"
                 cursor.execute(
-                    """
+                    f"""
                     SELECT 
                         ak.id,
                         ak.key_prefix,
                         ak.tier,
-                        ak.label
+                        {label_column}
                     FROM api_keys ak
                     WHERE ak.user_id = %s AND ak.active = 1
                     ORDER BY ak.created_at DESC
@@ -0,0 +1,170 @@
+"""
+User Context - Thông tin user của request hiện tại cho các trang portal
+
+Mỗi trang portal (dashboard, keys, usage, billing, upgrade) trước đây gọi get_user_by_id
+và get_user_subscription riêng → 2 connection + 2 query mỗi request.
+load_user_context lấy user + subscription active + số key active trong 1 query trên 1 connection:
+- get_user_context() memoize kết quả trong flask.g (nhiều lần gọi trong 1 request = 1 query)
+- USER_CONTEXT_SESSION_TTL_SECONDS > 0: cache thêm trong session vài giây để các trang
+  liên tiếp không query lại; 0 (mặc định) = tắt. Session là cookie nên thay đổi từ admin
+  (đổi tier, khóa tài khoản) chỉ được thấy sau tối đa TTL giây - trừ các thay đổi có ghi change log
+  "subscription" (duyệt thanh toán, đổi tier, subscription hết hạn, xóa user): worker ghi nhận thời điểm
+  đổi theo user_id và bỏ qua context trong session được load trước thời điểm đó.
+- invalidate_user_context() sau các thay đổi của chính user (tạo/xóa key, nâng cấp, xác thực email).
+"""
+from __future__ import annotations
+
+import logging
+import os
+import time
+from datetime import datetime
+from typing import Optional
+
+from flask import g, session
+
+from services import change_log, schema_registry
+from services.user_service import _get_db_connection, _user_columns
+
+logger = logging.getLogger(__name__)
+
+_SESSION_KEY = "_user_ctx"
+_USER_COLUMNS = ("id", "email", "full_name", "status", "email_verified", "created_at", "last_login_at")
+_DATETIME_FIELDS = ("created_at", "last_login_at", "expires_at")
+
+# user_id → thời điểm (epoch) subscription đổi theo change log; None trong change log = mọi user
+_changed_at: dict[int, float] = {}
+_changed_state = {"all_at": 0.0}
+
+
+def _session_ttl() -> float:
+    try:
+        return float(os.getenv("USER_CONTEXT_SESSION_TTL_SECONDS", "0"))
+    except ValueError:
+        return 0.0
+
+
+def _on_subscriptions_changed(entity_ids: list[Optional[str]]) -> None:
+    """Change-log scope subscription: context trong session load trước thời điểm này không còn dùng được"""
+    now = time.time()
+    if None in entity_ids:
+        _changed_state["all_at"] = now
+        _changed_at.clear()
+        return
+    for entity_id in entity_ids:
+        _changed_at[int(entity_id)] = now
+    # Mốc cũ hơn TTL không cần giữ: context trong session cũ hơn TTL đã tự hết hạn
+    cutoff = now - _session_ttl()
+    for user_id in [user_id for user_id, changed_at in _changed_at.items() if changed_at < cutoff]:
+        del _changed_at[user_id]
+
+
+change_log.subscribe("subscription", _on_subscriptions_changed)
+
+
+def _subscription_subquery(column: str) -> str:
+    """Scalar subquery lấy 1 cột của subscription active mới nhất (như get_user_subscription)"""
+    order_by = "ORDER BY s.created_at DESC" if schema_registry.has_column("subscriptions", "created_at") else ""
+    return (
+        f"(SELECT s.{column} FROM subscriptions s WHERE s.user_id = u.id AND s.status = 'active' "
+        f"{order_by} LIMIT 1) AS sub_{column}"
+    )
+
+
+def _dump(context: dict) -> dict:
+    """Đổi datetime sang ISO string: session serializer của Flask biến datetime naive thành UTC aware"""
+    return {
+        part: {k: v.isoformat() if isinstance(v, datetime) else v for k, v in value.items()}
+        if isinstance(value, dict) else value
+        for part, value in context.items()
+    }
+
+
+def _load(data: dict) -> dict:
+    context = dict(data)
+    for part in ("user", "subscription"):
+        if context.get(part):
+            context[part] = {
+                k: datetime.fromisoformat(v) if k in _DATETIME_FIELDS and isinstance(v, str) else v
+                for k, v in context[part].items()
+            }
+    return context
+
+
+def load_user_context(user_id: int) -> Optional[dict]:
+    """
+    Lấy {"user", "subscription", "api_key_count"} trong 1 query
+
+    Returns:
+        None nếu user không tồn tại hoặc lỗi DB
+    """
+    sub_columns = ["tier", "expires_at"]
+    if schema_registry.has_column("subscriptions", "created_at"):
+        sub_columns.append("created_at")
+    user_columns = ", ".join(f"u.{c}" for c in _user_columns(*_USER_COLUMNS).split(", "))
+    try:
+        conn = _get_db_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    f"""
+                    SELECT {user_columns},
+                        {", ".join(_subscription_subquery(c) for c in sub_columns)},
+                        (SELECT COUNT(*) FROM api_keys k WHERE k.user_id = u.id AND k.active = TRUE) AS api_key_count
+                    FROM users u
+                    WHERE u.id = %s
+                    """,
+                    (user_id,),
+                )
+                row = cursor.fetchone()
+        finally:
+            conn.close()
+    except Exception as e:
+        logger.error(f"Error loading user context: {str(e)}", exc_info=True)
+        return None
+
+    if not row:
+        return None
+    user = {c: row[c] for c in _USER_COLUMNS if c in row}
+    user.setdefault("email_verified", False)  # Default to False if column doesn't exist
+    subscription = None
+    if row.get("sub_tier") is not None:
+        subscription = {c: row[f"sub_{c}"] for c in sub_columns}
+        subscription["status"] = "active"
+    return {
+        "user": user,
+        "subscription": subscription,
+        "api_key_count": int(row.get("api_key_count") or 0),
+    }
+
+
+def get_user_context() -> Optional[dict]:
+    """Context của user đang login (session["user_id"]), memoize trong g và (tùy chọn) session"""
+    user_id = session.get("user_id")
+    if not user_id:
+        return None
+    cached = g.get("user_context")
+    if cached is not None and cached["user"]["id"] == user_id:
+        return cached
+
+    ttl = _session_ttl()
+    context = None
+    if ttl > 0:
+        entry = session.get(_SESSION_KEY)
+        loaded_at = entry.get("loaded_at", 0) if entry else 0
+        changed_at = max(_changed_state["all_at"], _changed_at.get(user_id, 0.0))
+        if entry and entry.get("user_id") == user_id and time.time() - loaded_at < ttl and loaded_at >= changed_at:
+            context = _load(entry["context"])
+    if context is None:
+        context = load_user_context(user_id)
+        if context is not None and ttl > 0:
+            session[_SESSION_KEY] = {"user_id": user_id, "loaded_at": time.time(), "context": _dump(context)}
+
+    if context is not None:
+        g.user_context = context
+    return context
+
+
+def invalidate_user_context() -> None:
+    """Bỏ context đã cache (gọi sau khi user tự thay đổi key/subscription/email)"""
+    g.pop("user_context", None)
+    session.pop(_SESSION_KEY, None)
@@ -3,15 +3,20 @@ User Service - Quản lý users, authentication, registration
 """
 from __future__ import annotations
 
+import base64
 import hashlib
 import logging
+import os
 import secrets
+import time
 from datetime import datetime, timedelta
 from typing import Optional, Tuple
 
-import bcrypt
 import pymysql
 
+from services import admin_stats, change_log, db_router, deadline, key_snapshot, password_hasher, schema_registry, signed_keys
+from services.password_hasher import PasswordHasherBusy
+
 logger = logging.getLogger(__name__)
 
 
@@ -25,18 +30,34 @@ def _get_db_connection():
         password=os.getenv("MYSQL_PASSWORD", ""),
         database=os.getenv("MYSQL_DATABASE", "cccd_api"),
         cursorclass=pymysql.cursors.DictCursor,
+        **deadline.db_timeouts(),
     )
 
 
+def _user_columns(*columns: str) -> str:
+    """Build danh sách cột users, bỏ qua các cột optional chưa được migrate"""
+    optional = ("email_verified", "last_login_at")
+    return ", ".join(
+        c for c in columns
+        if c not in optional or schema_registry.has_column("users", c)
+    )
+
+
+def _subscription_order_by() -> str:
+    """ORDER BY subscription mới nhất (nếu bảng subscriptions có cột created_at)"""
+    if schema_registry.has_column("subscriptions", "created_at"):
+        return "ORDER BY created_at DESC"
+    return ""
+
+
 def hash_password(password: str) -> str:
-    """Hash password bằng bcrypt"""
-    salt = bcrypt.gensalt()
-    return bcrypt.hashpw(password.encode("utf-8"), salt).decode("utf-8")
+    """Hash password bằng bcrypt (process pool, raise PasswordHasherBusy khi quá tải)"""
+    return password_hasher.hash_password(password)
 
 
 def verify_password(password: str, password_hash: str) -> bool:
-    """Verify password với hash"""
-    return bcrypt.checkpw(password.encode("utf-8"), password_hash.encode("utf-8"))
+    """Verify password với hash (process pool, raise PasswordHasherBusy khi quá tải)"""
+    return password_hasher.verify_password(password, password_hash)
 
 
 def generate_verification_token() -> str:
@@ -67,8 +88,8 @@ def register_user(email: str, password: str, full_name: str) -> Tuple[bool, Opti
                 verification_token = generate_verification_token()
                 verification_expires = datetime.now() + timedelta(hours=24)
                 
-                # Insert user - try with email_verified columns first, fallback if columns don't exist
-                try:
+                # Insert user - with email_verified columns if they exist
+                if schema_registry.has_column("users", "email_verified"):
                     cursor.execute(
                         """
                         INSERT INTO users (email, password_hash, full_name, status, 
@@ -77,9 +98,8 @@ def register_user(email: str, password: str, full_name: str) -> Tuple[bool, Opti
                         """,
                         (email, password_hash, full_name, verification_token, verification_expires),
                     )
-                except Exception as e:
+                else:
                     # Columns don't exist yet, insert without email_verified columns
-                    logger.warning(f"Email verification columns not found, inserting without them: {str(e)}")
                     cursor.execute(
                         """
                         INSERT INTO users (email, password_hash, full_name, status)
@@ -103,6 +123,8 @@ def register_user(email: str, password: str, full_name: str) -> Tuple[bool, Opti
             return True, None, user_id, verification_token
         finally:
             conn.close()
+    except PasswordHasherBusy:
+        return False, password_hasher.BUSY_MESSAGE, None, None
     except Exception as e:
         logger.error(f"Error registering user: {str(e)}", exc_info=True)
         return False, f"Lỗi hệ thống: {str(e)}", None, None
@@ -119,26 +141,15 @@ def authenticate_user(email: str, password: str) -> Tuple[bool, Optional[dict],
         conn = _get_db_connection()
         try:
             with conn.cursor() as cursor:
-                # Try with email_verified first, fallback if column doesn't exist
-                try:
-                    cursor.execute(
-                        """
-                        SELECT id, email, password_hash, full_name, status, email_verified
-                        FROM users
-                        WHERE email = %s
-                        """,
-                        (email,),
-                    )
-                except Exception:
-                    # Column doesn't exist, query without email_verified
-                    cursor.execute(
-                        """
-                        SELECT id, email, password_hash, full_name, status
-                        FROM users
-                        WHERE email = %s
-                        """,
-                        (email,),
-                    )
+                columns = _user_columns("id", "email", "password_hash", "full_name", "status", "email_verified")
+                cursor.execute(
+                    f"""
+                    SELECT {columns}
+                    FROM users
+                    WHERE email = %s
+                    """,
+                    (email,),
+                )
                 user = cursor.fetchone()
                 
                 if not user:
@@ -151,8 +162,16 @@ def authenticate_user(email: str, password: str) -> Tuple[bool, Optional[dict],
                 if not verify_password(password, user["password_hash"]):
                     return False, None, "Email hoặc mật khẩu không đúng"
                 
+                # Hash cũ có cost khác BCRYPT_ROUNDS → rehash trong lúc còn password plaintext
+                new_hash = password_hasher.rehash_if_needed(password, user["password_hash"])
+                if new_hash:
+                    cursor.execute(
+                        "UPDATE users SET password_hash = %s WHERE id = %s",
+                        (new_hash, user["id"]),
+                    )
+                
                 # Update last_login_at if column exists
-                try:
+                if schema_registry.has_column("users", "last_login_at"):
                     cursor.execute(
                         """
                         UPDATE users
@@ -161,9 +180,6 @@ def authenticate_user(email: str, password: str) -> Tuple[bool, Optional[dict],
                         """,
                         (user["id"],),
                     )
-                except Exception:
-                    # Column doesn't exist, skip update
-                    pass
                 
                 conn.commit()
                 
@@ -180,70 +196,175 @@ def authenticate_user(email: str, password: str) -> Tuple[bool, Optional[dict],
                 return True, user_dict, None
         finally:
             conn.close()
+    except PasswordHasherBusy:
+        return False, None, password_hasher.BUSY_MESSAGE
     except Exception as e:
         logger.error(f"Error authenticating user: {str(e)}", exc_info=True)
         return False, None, f"Lỗi hệ thống: {str(e)}"
 
 
-def get_users_list(page: int = 1, per_page: int = 20, search: Optional[str] = None) -> tuple[list[dict], int]:
+# Danh sách user cho admin: keyset pagination theo id (không OFFSET), search theo prefix
+# (dùng index email UNIQUE / FULLTEXT trên full_name nếu có), total count cache + ước lượng.
+# Index nên có cho search theo tên:
+#     ALTER TABLE users ADD FULLTEXT INDEX ft_users_full_name (full_name);
+#     -- hoặc (prefix LIKE): ALTER TABLE users ADD INDEX idx_users_full_name (full_name);
+_USERS_COUNT_CACHE_MAX = 256
+_users_count_cache: dict[Optional[str], tuple[float, int, bool]] = {}
+
+
+class InvalidCursor(ValueError):
+    """Cursor phân trang không hợp lệ"""
+
+
+def encode_users_cursor(last_id: int) -> str:
+    """Cursor mờ (opaque) trỏ tới sau user cuối của trang hiện tại"""
+    return base64.urlsafe_b64encode(f"u1:{last_id}".encode()).decode().rstrip("=")
+
+
+def decode_users_cursor(cursor: str) -> int:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        version, last_id = raw.split(":", 1)
+        if version != "u1":
+            raise ValueError(version)
+        return int(last_id)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise InvalidCursor("cursor không hợp lệ") from e
+
+
+def _escape_like(term: str) -> str:
+    return term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _users_search_clause(search: str) -> tuple[str, list]:
+    """
+    WHERE cho search: prefix email (index range trên email) hoặc tên.
+    Tên: MATCH ... AGAINST (boolean mode, prefix từng từ) nếu có FULLTEXT index, ngược lại LIKE 'term%'.
     """
-    Lấy danh sách users với pagination (cho admin)
-    Returns: (users_list, total_count)
+    prefix = _escape_like(search) + "%"
+    if "@" in search:
+        return "email LIKE %s", [prefix]
+    if schema_registry.has_fulltext_index("users", "full_name"):
+        words = [w for w in "".join(c if c.isalnum() else " " for c in search).split() if w]
+        if words:
+            return (
+                "(email LIKE %s OR MATCH(full_name) AGAINST (%s IN BOOLEAN MODE))",
+                [prefix, " ".join(f"+{w}*" for w in words)],
+            )
+    return "(email LIKE %s OR full_name LIKE %s)", [prefix, prefix]
+
+
+def _count_users(cursor, where_clause: str, params: list, search: Optional[str]) -> tuple[int, bool]:
     """
+    Total count cho admin, cache ADMIN_USERS_COUNT_CACHE_SECONDS.
+    Không search: ước lượng từ INFORMATION_SCHEMA nếu bảng lớn hơn ADMIN_USERS_EXACT_COUNT_LIMIT, ngược lại COUNT(*).
+    Có search: đếm tối đa ADMIN_USERS_EXACT_COUNT_LIMIT match.
+    Returns: (total, is_estimate)
+    """
+    key = search.lower() if search else None
+    now = time.monotonic()
+    cached = _users_count_cache.get(key)
+    if cached and cached[0] > now:
+        return cached[1], cached[2]
+
+    limit = int(os.getenv("ADMIN_USERS_EXACT_COUNT_LIMIT", "100000"))
+    estimate = False
+    if search:
+        cursor.execute(
+            f"SELECT COUNT(*) AS total FROM (SELECT 1 FROM users WHERE {where_clause} LIMIT %s) t",
+            params + [limit + 1],
+        )
+        total = int(cursor.fetchone()["total"])
+        if total > limit:
+            total, estimate = limit, True
+    else:
+        cursor.execute(
+            """
+            SELECT TABLE_ROWS AS total FROM INFORMATION_SCHEMA.TABLES
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'users'
+            """
+        )
+        row = cursor.fetchone()
+        total = int(row["total"] or 0) if row else 0
+        estimate = total > limit
+        if not estimate:
+            cursor.execute("SELECT COUNT(*) AS total FROM users")
+            total = int(cursor.fetchone()["total"])
+
+    if len(_users_count_cache) >= _USERS_COUNT_CACHE_MAX:
+        _users_count_cache.clear()
+    _users_count_cache[key] = (now + float(os.getenv("ADMIN_USERS_COUNT_CACHE_SECONDS", "60")), total, estimate)
+    return total, estimate
+
+
+def get_users_list(
+    cursor: Optional[str] = None, per_page: int = 20, search: Optional[str] = None
+) -> dict:
+    """
+    Lấy danh sách users (cho admin), mới nhất trước, keyset pagination theo id
+
+    Args:
+        cursor: next_cursor của trang trước (None = trang đầu)
+        search: prefix của email hoặc tên
+
+    Returns:
+        {"users", "next_cursor" (None nếu hết), "total", "total_is_estimate"}
+
+    Raises:
+        InvalidCursor: cursor không decode được
+    """
+    after_id = decode_users_cursor(cursor) if cursor else None
     try:
-        conn = _get_db_connection()
+        conn = db_router.get_read_connection()
         try:
-            with conn.cursor() as cursor:
-                # Build WHERE clause for search
-                where_clause = ""
-                params = []
+            with conn.cursor() as db_cursor:
+                conditions = []
+                params: list = []
                 if search:
-                    where_clause = "WHERE email LIKE %s OR full_name LIKE %s"
-                    search_pattern = f"%{search}%"
-                    params = [search_pattern, search_pattern]
-                
-                # Get total count
-                count_query = f"SELECT COUNT(*) as total FROM users {where_clause}"
-                cursor.execute(count_query, params)
-                total_count = cursor.fetchone()["total"]
-                
-                # Get users with pagination
-                offset = (page - 1) * per_page
-                users_query = f"""
-                    SELECT id, email, full_name, status, created_at, last_login_at
+                    clause, search_params = _users_search_clause(search)
+                    conditions.append(clause)
+                    params.extend(search_params)
+                search_where = " AND ".join(conditions)
+                search_params = list(params)
+                if after_id is not None:
+                    conditions.append("id < %s")
+                    params.append(after_id)
+                where_clause = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+                
+                total_count, total_is_estimate = _count_users(db_cursor, search_where, search_params, search)
+                
+                # Lấy thêm 1 row để biết còn trang sau không
+                db_cursor.execute(
+                    f"""
+                    SELECT {_user_columns("id", "email", "full_name", "status", "created_at", "last_login_at")}
                     FROM users
                     {where_clause}
                     ORDER BY id DESC
-                    LIMIT %s OFFSET %s
-                """
-                cursor.execute(users_query, params + [per_page, offset])
-                users = cursor.fetchall()
+                    LIMIT %s
+                    """,
+                    params + [per_page + 1],
+                )
+                users = db_cursor.fetchall()
+                has_more = len(users) > per_page
+                users = users[:per_page]
                 
                 # Get subscriptions for each user
                 user_ids = [user["id"] for user in users]
                 if user_ids:
                     placeholders = ",".join(["%s"] * len(user_ids))
-                    try:
-                        cursor.execute(
-                            f"""
-                            SELECT user_id, tier, status, expires_at
-                            FROM subscriptions
-                            WHERE user_id IN ({placeholders}) AND status = 'active'
-                            ORDER BY created_at DESC
-                            """,
-                            user_ids,
-                        )
-                    except Exception:
-                        # Column created_at doesn't exist
-                        cursor.execute(
-                            f"""
-                            SELECT user_id, tier, status, expires_at
-                            FROM subscriptions
-                            WHERE user_id IN ({placeholders}) AND status = 'active'
-                            """,
-                            user_ids,
-                        )
-                    subscriptions = {sub["user_id"]: sub for sub in cursor.fetchall()}
+                    db_cursor.execute(
+                        f"""
+                        SELECT user_id, tier, status, expires_at
+                        FROM subscriptions
+                        WHERE user_id IN ({placeholders}) AND status = 'active'
+                        {_subscription_order_by()}
+                        """,
+                        user_ids,
+                    )
+                    subscriptions = {}
+                    for sub in db_cursor.fetchall():
+                        # Giữ subscription mới nhất (row đầu theo ORDER BY)
+                        subscriptions.setdefault(sub["user_id"], sub)
                 else:
                     subscriptions = {}
                 
@@ -264,12 +385,17 @@ def get_users_list(page: int = 1, per_page: int = 20, search: Optional[str] = No
                         "expires_at": subscription["expires_at"] if subscription else None,
                     })
                 
-                return result, total_count
+                return {
+                    "users": result,
+                    "next_cursor": encode_users_cursor(users[-1]["id"]) if has_more else None,
+                    "total": total_count,
+                    "total_is_estimate": total_is_estimate,
+                }
         finally:
             conn.close()
     except Exception as e:
         logger.error(f"Error getting users list: {str(e)}", exc_info=True)
-        return [], 0
+        return {"users": [], "next_cursor": None, "total": 0, "total_is_estimate": False}
 
 
 def get_user_by_email(email: str) -> Optional[dict]:
@@ -278,53 +404,32 @@ def get_user_by_email(email: str) -> Optional[dict]:
         conn = _get_db_connection()
         try:
             with conn.cursor() as cursor:
-                # Try with email_verified first, fallback if column doesn't exist
-                try:
-                    cursor.execute(
-                        """
-                        SELECT id, email, full_name, status, email_verified, created_at, last_login_at
-                        FROM users
-                        WHERE email = %s
-                        """,
-                        (email,),
-                    )
-                except Exception:
-                    # Column doesn't exist, query without email_verified
-                    cursor.execute(
-                        """
-                        SELECT id, email, full_name, status, created_at, last_login_at
-                        FROM users
-                        WHERE email = %s
-                        """,
-                        (email,),
-                    )
+                columns = _user_columns(
+                    "id", "email", "full_name", "status", "email_verified", "created_at", "last_login_at"
+                )
+                cursor.execute(
+                    f"""
+                    SELECT {columns}
+                    FROM users
+                    WHERE email = %s
+                    """,
+                    (email,),
+                )
                 user = cursor.fetchone()
                 if not user:
                     return None
                 
-                # Get current subscription (try with created_at, fallback without)
-                try:
-                    cursor.execute(
-                        """
-                        SELECT tier, status, expires_at
-                        FROM subscriptions
-                        WHERE user_id = %s AND status = 'active'
-                        ORDER BY created_at DESC
-                        LIMIT 1
-                        """,
-                        (user["id"],),
-                    )
-                except Exception:
-                    # Column created_at doesn't exist, query without ORDER BY
-                    cursor.execute(
-                        """
-                        SELECT tier, status, expires_at
-                        FROM subscriptions
-                        WHERE user_id = %s AND status = 'active'
-                        LIMIT 1
-                        """,
-                        (user["id"],),
-                    )
+                # Get current subscription
+                cursor.execute(
+                    f"""
+                    SELECT tier, status, expires_at
+                    FROM subscriptions
+                    WHERE user_id = %s AND status = 'active'
+                    {_subscription_order_by()}
+                    LIMIT 1
+                    """,
+                    (user["id"],),
+                )
                 subscription = cursor.fetchone()
                 
                 return {
@@ -351,32 +456,21 @@ def get_user_by_id(user_id: int) -> Optional[dict]:
         conn = _get_db_connection()
         try:
             with conn.cursor() as cursor:
-                # Check if email_verified column exists first
-                # If not, query without it (backward compatibility)
-                try:
-                    cursor.execute(
-                        """
-                        SELECT id, email, full_name, status, email_verified, created_at, last_login_at
-                        FROM users
-                        WHERE id = %s
-                        """,
-                        (user_id,),
-                    )
-                except Exception:
-                    # Column doesn't exist, query without email_verified
-                    cursor.execute(
-                        """
-                        SELECT id, email, full_name, status, created_at, last_login_at
-                        FROM users
-                        WHERE id = %s
-                        """,
-                        (user_id,),
-                    )
-                    user = cursor.fetchone()
-                    if user:
-                        user["email_verified"] = False  # Default to False if column doesn't exist
-                    return user
-                return cursor.fetchone()
+                columns = _user_columns(
+                    "id", "email", "full_name", "status", "email_verified", "created_at", "last_login_at"
+                )
+                cursor.execute(
+                    f"""
+                    SELECT {columns}
+                    FROM users
+                    WHERE id = %s
+                    """,
+                    (user_id,),
+                )
+                user = cursor.fetchone()
+                if user and "email_verified" not in user:
+                    user["email_verified"] = False  # Default to False if column doesn't exist
+                return user
         finally:
             conn.close()
     except Exception as e:
@@ -399,11 +493,20 @@ def delete_user(user_id: int) -> tuple[bool, Optional[str]]:
                 if not user:
                     return False, "User không tồn tại"
                 
+                # Signed key của user không còn hợp lệ dù token chưa hết hạn
+                cursor.execute("SELECT id FROM api_keys WHERE user_id = %s", (user_id,))
+                key_ids = [row["id"] for row in cursor.fetchall()]
+                signed_keys.record_revocations(cursor, key_ids, "user_deleted")
+                change_log.publish(cursor, "api_key", key_ids)
+                change_log.publish(cursor, "subscription", [user_id])
+                admin_stats.record_keys_removed(cursor, "user_id = %s", (user_id,), deleting=True)
+                
                 # Delete user (CASCADE will handle related records)
                 # Note: Foreign keys should be set to CASCADE or SET NULL
                 cursor.execute("DELETE FROM users WHERE id = %s", (user_id,))
                 
             conn.commit()
+            key_snapshot.remove_ids(key_ids)
             return True, f"Đã xóa user {user['email']} thành công"
         finally:
             conn.close()
@@ -435,18 +538,7 @@ def request_password_reset(email: str) -> Tuple[bool, Optional[str], Optional[st
                     return False, "Email không tồn tại", None
                 
                 # Check if password_reset columns exist
-                cursor.execute(
-                    """
-                    SELECT COLUMN_NAME
-                    FROM INFORMATION_SCHEMA.COLUMNS
-                    WHERE TABLE_SCHEMA = DATABASE()
-                    AND TABLE_NAME = 'users'
-                    AND COLUMN_NAME = 'password_reset_token'
-                    """
-                )
-                has_reset_columns = cursor.fetchone() is not None
-                
-                if not has_reset_columns:
+                if not schema_registry.has_column("users", "password_reset_token"):
                     return False, "Password reset feature chưa được kích hoạt. Vui lòng liên hệ hỗ trợ", None
                 
                 # Generate reset token
@@ -484,18 +576,7 @@ def reset_password(token: str, new_password: str) -> Tuple[bool, Optional[str],
         try:
             with conn.cursor() as cursor:
                 # Check if password_reset columns exist
-                cursor.execute(
-                    """
-                    SELECT COLUMN_NAME
-                    FROM INFORMATION_SCHEMA.COLUMNS
-                    WHERE TABLE_SCHEMA = DATABASE()
-                    AND TABLE_NAME = 'users'
-                    AND COLUMN_NAME = 'password_reset_token'
-                    """
-                )
-                has_reset_columns = cursor.fetchone() is not None
-                
-                if not has_reset_columns:
+                if not schema_registry.has_column("users", "password_reset_token"):
                     return False, "Password reset feature chưa được kích hoạt. Vui lòng liên hệ hỗ trợ", None
                 
                 # Find user with valid token
@@ -533,6 +614,8 @@ def reset_password(token: str, new_password: str) -> Tuple[bool, Optional[str],
             return True, None, user_id
         finally:
             conn.close()
+    except PasswordHasherBusy:
+        return False, password_hasher.BUSY_MESSAGE, None
     except Exception as e:
         logger.error(f"Error resetting password: {str(e)}", exc_info=True)
         return False, f"Lỗi hệ thống: {str(e)}", None
@@ -550,18 +633,7 @@ def verify_email(token: str) -> Tuple[bool, Optional[str]]:
         try:
             with conn.cursor() as cursor:
                 # Check if email_verified columns exist
-                cursor.execute(
-                    """
-                    SELECT COLUMN_NAME
-                    FROM INFORMATION_SCHEMA.COLUMNS
-                    WHERE TABLE_SCHEMA = DATABASE()
-                    AND TABLE_NAME = 'users'
-                    AND COLUMN_NAME = 'email_verified'
-                    """
-                )
-                has_email_columns = cursor.fetchone() is not None
-                
-                if not has_email_columns:
+                if not schema_registry.has_column("users", "email_verified"):
                     return False, "Email verification feature chưa được kích hoạt"
                 
                 # Find user with valid token
@@ -611,18 +683,7 @@ def resend_verification_email(user_id: int) -> Tuple[bool, Optional[str], Option
         try:
             with conn.cursor() as cursor:
                 # Check if email_verified columns exist
-                cursor.execute(
-                    """
-                    SELECT COLUMN_NAME
-                    FROM INFORMATION_SCHEMA.COLUMNS
-                    WHERE TABLE_SCHEMA = DATABASE()
-                    AND TABLE_NAME = 'users'
-                    AND COLUMN_NAME = 'email_verified'
-                    """
-                )
-                has_email_columns = cursor.fetchone() is not None
-                
-                if not has_email_columns:
+                if not schema_registry.has_column("users", "email_verified"):
                     return False, "Email verification feature chưa được kích hoạt", None
                 
                 # Get user info
@@ -671,28 +732,19 @@ def get_user_subscription(user_id: int) -> Optional[dict]:
         conn = _get_db_connection()
         try:
             with conn.cursor() as cursor:
-                try:
-                    cursor.execute(
-                        """
-                        SELECT tier, status, expires_at, created_at
-                        FROM subscriptions
-                        WHERE user_id = %s AND status = 'active'
-                        ORDER BY created_at DESC
-                        LIMIT 1
-                        """,
-                        (user_id,),
-                    )
-                except Exception:
-                    # Column created_at doesn't exist
-                    cursor.execute(
-                        """
-                        SELECT tier, status, expires_at
-                        FROM subscriptions
-                        WHERE user_id = %s AND status = 'active'
-                        LIMIT 1
-                        """,
-                        (user_id,),
-                    )
+                columns = "tier, status, expires_at"
+                if schema_registry.has_column("subscriptions", "created_at"):
+                    columns += ", created_at"
+                cursor.execute(
+                    f"""
+                    SELECT {columns}
+                    FROM subscriptions
+                    WHERE user_id = %s AND status = 'active'
+                    {_subscription_order_by()}
+                    LIMIT 1
+                    """,
+                    (user_id,),
+                )
                 subscription = cursor.fetchone()
                 return subscription
         finally:
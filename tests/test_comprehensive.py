@@ -20,6 +20,14 @@ from services.cccd_parser import parse_cccd, parse_gender_century
 from services.province_mapping import map_province_name
 
 
+def mock_db_connection():
+    """(conn, cursor) giả lập pymysql connection: `with conn.cursor() as cursor` trả về cursor"""
+    cursor = MagicMock()
+    conn = MagicMock()
+    conn.cursor.return_value.__enter__.return_value = cursor
+    return conn, cursor
+
+
 class TestComprehensiveCCCDAPI(unittest.TestCase):
     """Comprehensive test suite covering all test cases from test_cases.md"""
 
@@ -643,6 +651,9 @@ class TestComprehensiveCCCDAPI(unittest.TestCase):
 
     def test_admin_api_with_wrong_key(self):
         """TC-ADMIN-AUTH-003: Admin API with wrong key"""
+        from services import admin_security
+        # Key sai bắt IP test chờ (tarpit) → các test admin sau dùng cùng IP
+        self.addCleanup(admin_security._tarpitted_ips.clear)
         resp = self.client.get(
             "/admin/stats",
             headers={"X-Admin-Key": "wrong"},
@@ -662,6 +673,9 @@ class TestComprehensiveCCCDAPI(unittest.TestCase):
 
     def test_admin_key_case_sensitivity(self):
         """TC-ADMIN-AUTH-005: Admin key case sensitivity"""
+        from services import admin_security
+        # Key sai bắt IP test chờ (tarpit) → các test admin sau dùng cùng IP
+        self.addCleanup(admin_security._tarpitted_ips.clear)
         resp = self.client.get(
             "/admin/stats",
             headers={"X-Admin-Key": self.admin_key.upper()},
@@ -3438,6 +3452,1130 @@ class TestComprehensiveCCCDAPI(unittest.TestCase):
         # May return 200 with user data or 404 if endpoint doesn't exist
         self.assertIn(resp.status_code, [200, 404, 400])
 
+    # ========================================================================
+    # Performance & Infrastructure Tests (không cần MySQL)
+    # ========================================================================
+
+    def test_log_archive_segment_and_index(self):
+        """TC-PERF-001: Archive segment append-only + index aggregate"""
+        import tempfile
+        from datetime import date as date_cls
+        from services import log_archive_service
+
+        day = date_cls(2024, 1, 15)
+        created_at = datetime(2024, 1, 15, 10, 0, 0)
+        rows = [
+            {"id": 1, "api_key_id": 7, "status_code": 200, "response_time_ms": 10, "created_at": created_at},
+            {"id": 2, "api_key_id": 7, "status_code": 400, "response_time_ms": 30, "created_at": created_at},
+        ]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with patch.dict(os.environ, {"LOG_ARCHIVE_DIR": tmp_dir}):
+                log_archive_service._day_dir(day).mkdir(parents=True)
+                index = log_archive_service._load_index(day)
+                log_archive_service._append_segment(day, 7, rows, index)
+                # Chạy lại với cùng rows (giả lập crash trước DELETE) -> không bị trùng
+                log_archive_service._append_segment(day, 7, rows, index)
+                log_archive_service._write_index(day, index)
+
+                logs = log_archive_service.get_archived_logs(7, day)
+                self.assertEqual([r["id"] for r in logs], [1, 2])
+                self.assertEqual(logs[0]["created_at"], "2024-01-15 10:00:00")
+
+                stats = log_archive_service.get_archived_daily_stats(7, day, day)
+                self.assertEqual(stats[0]["count"], 2)
+                self.assertEqual(stats[0]["success"], 1)
+                self.assertEqual(stats[0]["error"], 1)
+                self.assertEqual(stats[0]["avg_response_time"], 20.0)
+                self.assertEqual(log_archive_service.get_archived_logs(8, day), [])
+
+    def test_schema_registry_probes_once(self):
+        """TC-PERF-002: Schema registry cache bảng/cột, không query lại mỗi lần"""
+        from services import schema_registry
+
+        conn, cursor = mock_db_connection()
+        cursor.fetchall.return_value = [
+            {"TABLE_NAME": "api_keys", "COLUMN_NAME": "label"},
+            {"TABLE_NAME": "users", "COLUMN_NAME": "email_verified"},
+        ]
+
+        with patch.object(schema_registry, "_get_db_connection", return_value=conn) as get_conn:
+            schema_registry.invalidate()
+            self.assertTrue(schema_registry.has_column("api_keys", "label"))
+            self.assertFalse(schema_registry.has_column("api_keys", "missing"))
+            self.assertFalse(schema_registry.has_table("api_key_history"))
+            self.assertTrue(schema_registry.has_table("users"))
+            self.assertEqual(get_conn.call_count, 1)
+        schema_registry.invalidate()
+
+    def test_schema_registry_unprobed_is_unknown(self):
+        """TC-PERF-027: Schema chưa probe được lần nào → SchemaUnavailable, không trả 'không có bảng'"""
+        from services import schema_registry
+
+        with patch.object(schema_registry, "_loaded", False), \
+                patch.object(schema_registry, "_columns", {}), \
+                patch.object(schema_registry, "_get_db_connection", side_effect=OSError("down")) as get_conn:
+            schema_registry.invalidate()
+            with self.assertRaises(schema_registry.SchemaUnavailable):
+                schema_registry.has_column("users", "email_verified")
+            with self.assertRaises(schema_registry.SchemaUnavailable):
+                schema_registry.has_table("users")
+            self.assertEqual(get_conn.call_count, 1)  # Lỗi vừa xảy ra → không probe lại ngay
+        schema_registry.invalidate()
+
+    def test_db_router_replica_lag_and_read_your_writes(self):
+        """TC-PERF-003: Read replica routing theo lag và read-your-writes"""
+        from services import db_router
+
+        primary, replica = MagicMock(name="primary"), MagicMock(name="replica")
+        with patch.dict(os.environ, {"MYSQL_REPLICA_HOST": "replica", "MYSQL_REPLICA_LAG_CHECK_SECONDS": "0"}), \
+                patch.object(db_router, "get_primary_connection", return_value=primary), \
+                patch.object(db_router, "_get_replica_connection", return_value=replica), \
+                patch.object(db_router, "_read_replica_lag", return_value=1.0) as read_lag:
+            self.assertIs(db_router.get_read_connection(scope="user:1"), replica)
+
+            # Vừa ghi → scope này đọc từ primary
+            db_router.mark_write("user:1")
+            self.assertIs(db_router.get_read_connection(scope="user:1"), primary)
+            self.assertIs(db_router.get_read_connection(scope="user:2"), replica)
+
+            # Lag vượt ngưỡng → primary
+            read_lag.return_value = 60.0
+            self.assertIs(db_router.get_read_connection(scope="user:2"), primary)
+            read_lag.return_value = None  # Replication dừng
+            self.assertIs(db_router.get_read_connection(scope="user:2"), primary)
+        db_router._recent_writes.clear()
+
+    def test_db_router_session_marked_only_for_own_scope(self):
+        """TC-PERF-042: mark_write chỉ đánh dấu session của chính user; admin ghi hộ user khác không làm session sticky"""
+        from flask import session
+        from services import db_router
+
+        with self.app.test_request_context("/admin/payments"):
+            session["user_id"] = 5
+            db_router.mark_write("user:9")  # Admin thao tác trên user khác
+            self.assertNotIn("db_last_write_at", session)
+            db_router.mark_write("user:5")
+            self.assertIn("db_last_write_at", session)
+        with self.app.test_request_context("/admin/payments"):
+            db_router.mark_write("user:9")  # Không login portal
+            self.assertNotIn("db_last_write_at", session)
+        db_router._recent_writes.clear()
+
+    def test_shared_memory_rate_limit_storage_across_processes(self):
+        """TC-PERF-004: Counter rate limit dùng chung giữa các process (shm://)"""
+        import tempfile
+        from limits.storage import storage_from_string
+        import services.rate_limit_storage  # noqa: F401
+
+        with tempfile.TemporaryDirectory() as tmp:
+            storage = storage_from_string(f"shm://{tmp}/rl")
+            pids = []
+            for _ in range(3):
+                pid = os.fork()
+                if pid == 0:
+                    worker_storage = storage_from_string(f"shm://{tmp}/rl")
+                    for _ in range(200):
+                        worker_storage.incr("api_key:abc/minute", 60)
+                    os._exit(0)
+                pids.append(pid)
+            for pid in pids:
+                os.waitpid(pid, 0)
+
+            self.assertEqual(storage.get("api_key:abc/minute"), 600)
+            self.assertGreater(storage.get_expiry("api_key:abc/minute"), time.time())
+            storage.clear("api_key:abc/minute")
+            self.assertEqual(storage.get("api_key:abc/minute"), 0)
+
+    def test_shared_memory_local_table_fallback(self):
+        """TC-PERF-028: Không có fcntl (Windows) → LocalTable riêng của process, cùng interface, giới hạn số key"""
+        from services.shared_memory import LocalTable
+
+        table = LocalTable(slots=2)
+        self.assertEqual(table.incr("a", 1, 10), 1)
+        self.assertEqual(table.incr("a", 2, 10), 3)
+        table.incr("b", 1, 20)
+        table.incr("c", 1, 20)  # đầy → bỏ key sắp hết hạn nhất
+        self.assertIsNone(table.get("a"))
+        self.assertEqual(table.get("c")[0], 1)
+        self.assertEqual(table.clear_all(), 2)
+
+    def test_shared_memory_table_ops_is_abstract(self):
+        """TC-PERF-040: _TableOps là ABC: bảng con phải cài update(), không tạo được bảng thiếu update()"""
+        from services import shared_memory
+
+        with self.assertRaises(TypeError):
+            shared_memory._TableOps()
+
+        class NoUpdate(shared_memory._TableOps):
+            pass
+
+        with self.assertRaises(TypeError):
+            NoUpdate()
+        self.assertEqual(shared_memory.LocalTable(slots=4).incr("k", 2, 60), 2.0)
+
+    def test_daily_quota_seeded_from_usage_and_enforced(self):
+        """TC-PERF-005: Quota/ngày seed từ api_usage, chặn khi hết quota"""
+        import tempfile
+        from services import quota_service
+
+        with tempfile.TemporaryDirectory() as tmp, \
+                patch.dict(os.environ, {"SHARED_MEMORY_PATH": f"{tmp}/shm"}), \
+                patch.object(quota_service, "_load_usage_today", return_value=998) as load_usage:
+            first = quota_service.consume(42, "free")
+            self.assertTrue(first.allowed)
+            self.assertEqual((first.limit, first.remaining), (1000, 1))
+            self.assertTrue(quota_service.consume(42, "free").allowed)
+
+            rejected = quota_service.consume(42, "free")
+            self.assertFalse(rejected.allowed)
+            self.assertEqual(rejected.remaining, 0)
+            # Seed 1 lần, các request sau chỉ dùng counter in-memory
+            self.assertEqual(load_usage.call_count, 1)
+
+            unlimited = quota_service.consume(43, "premium")
+            self.assertTrue(unlimited.allowed)
+            self.assertIsNone(unlimited.remaining)
+
+    def test_cost_weighted_gcra_limiter(self):
+        """TC-PERF-006: GCRA limiter trừ budget theo cost của request"""
+        from services.cost_limiter import acquire
+
+        key = f"tc_perf_006:{time.time()}"
+        first = acquire(key, 4, "10 per minute")
+        self.assertTrue(first.allowed)
+        self.assertEqual((first.limit, first.remaining), (10, 6))
+        self.assertTrue(acquire(key, 4, "10 per minute").allowed)
+
+        # Còn 2 đơn vị: request cost 4 bị chặn, phải chờ ~2 đơn vị hồi lại (2 * 6s)
+        rejected = acquire(key, 4, "10 per minute")
+        self.assertFalse(rejected.allowed)
+        self.assertAlmostEqual(rejected.retry_after, 12, delta=1)
+        self.assertTrue(acquire(key, 2, "10 per minute").allowed)
+        self.assertFalse(acquire(key, 1, "10 per minute").allowed)
+
+    def test_concurrency_limiter_bounded_queue(self):
+        """TC-PERF-007: Giới hạn in-flight per key, hàng đợi có giới hạn rồi 429"""
+        import threading
+        from services.concurrency_limiter import ConcurrencyLimitExceeded, concurrency_slot
+
+        key = f"tc_perf_007:{time.time()}"
+        release = threading.Event()
+        holding = threading.Barrier(3)
+
+        def hold_slot():
+            with concurrency_slot(key, 2):
+                holding.wait()
+                release.wait(5)
+
+        threads = [threading.Thread(target=hold_slot) for _ in range(2)]
+        for t in threads:
+            t.start()
+        holding.wait()
+
+        with patch.dict(os.environ, {"CONCURRENCY_QUEUE_TIMEOUT_MS": "20"}):
+            with self.assertRaises(ConcurrencyLimitExceeded):
+                with concurrency_slot(key, 2):
+                    pass
+        with patch.dict(os.environ, {"CONCURRENCY_QUEUE_SIZE": "0"}):
+            with self.assertRaises(ConcurrencyLimitExceeded):
+                with concurrency_slot(key, 2):
+                    pass
+
+        # Slot được trả trong lúc đang chờ → request trong hàng đợi được xử lý
+        with patch.dict(os.environ, {"CONCURRENCY_QUEUE_TIMEOUT_MS": "2000"}):
+            threading.Timer(0.05, release.set).start()
+            with concurrency_slot(key, 2):
+                pass
+        for t in threads:
+            t.join()
+
+    def test_concurrency_limiter_per_holder_lease_and_backoff(self):
+        """TC-PERF-041: Slot bị rò (worker chết) hết lease dù key vẫn có traffic; chờ slot poll có backoff"""
+        from services import concurrency_limiter
+        from services.concurrency_limiter import ConcurrencyLimitExceeded, concurrency_slot
+
+        key = f"tc_perf_041:{time.time()}"
+        with patch.dict(os.environ, {"CONCURRENCY_LEASE_SECONDS": "0.2", "CONCURRENCY_QUEUE_TIMEOUT_MS": "10"}):
+            self.assertEqual(concurrency_limiter._try_acquire(key, 1), 0)  # Không bao giờ release
+            started = time.monotonic()
+            while time.monotonic() - started < 0.15:
+                # Request khác của key bị từ chối nhưng không gia hạn lease của slot bị rò
+                with self.assertRaises(ConcurrencyLimitExceeded):
+                    with concurrency_slot(key, 1):
+                        pass
+            time.sleep(0.1)
+            with concurrency_slot(key, 1):
+                self.assertIsNone(concurrency_limiter._try_acquire(key, 1))
+            self.assertEqual(concurrency_limiter._try_acquire(key, 1), 0)
+            concurrency_limiter._release(key, 0)
+
+        cond = MagicMock()
+        with patch.object(concurrency_limiter, "_try_acquire", side_effect=[None] * 7 + [0]), \
+                patch.object(concurrency_limiter, "_condition", return_value=cond), \
+                patch.object(concurrency_limiter, "_release"), \
+                patch.dict(os.environ, {"CONCURRENCY_QUEUE_TIMEOUT_MS": "5000"}):
+            with concurrency_slot(key, 1):
+                pass
+        waits = [c.kwargs["timeout"] for c in cond.wait.call_args_list]
+        self.assertEqual(len(waits), 7)
+        self.assertEqual(waits[0], concurrency_limiter._POLL_INITIAL)
+        self.assertEqual(waits[-1], concurrency_limiter._POLL_MAX)
+        self.assertEqual(waits, sorted(waits))
+
+    def test_api_key_info_resolved_once_per_request(self):
+        """TC-PERF-026: Rate limit, concurrency limit, validate và log_request của 1 request chỉ tra key 1 lần"""
+        from services import api_key_service
+        from services.api_key_service import APIKeyInfo
+
+        info = APIKeyInfo(
+            id=1, key_prefix="ultr_abc", tier="ultra", owner_email="a@example.com",
+            active=True, expired=False, rate_limit="1000 per minute",
+        )
+        with patch.object(api_key_service, "_lookup_key_info", return_value=info) as lookup, \
+                self.app.app_context(), self.app.test_request_context("/v1/cccd/parse", method="POST"):
+            self.assertEqual(api_key_service.get_rate_limit_for_key("ultr_abc"), "1000 per minute")
+            self.assertEqual(api_key_service.get_concurrency_limit_for_key("ultr_abc"),
+                             api_key_service.TIER_CONCURRENCY_LIMITS["ultra"])
+            self.assertTrue(api_key_service.validate_api_key("ultr_abc")[0])
+            self.assertEqual(lookup.call_count, 1)
+
+    def test_admission_control_sheds_free_then_premium(self):
+        """TC-PERF-008: Load shedding theo tier (free → premium, ultra luôn được nhận)"""
+        from services import admission_control
+
+        now = 1700000001.0
+        self.assertAlmostEqual(admission_control.parse_request_start("t=1700000000.5", now=now), 500.0, places=3)
+        self.assertAlmostEqual(admission_control.parse_request_start("t=1700000000500", now=now), 500.0, places=3)
+        self.assertIsNone(admission_control.parse_request_start("garbage"))
+
+        admitted = 0
+        with patch.dict(os.environ, {"ADMISSION_MAX_IN_FLIGHT": "10"}):
+            try:
+                for _ in range(7):
+                    self.assertTrue(admission_control.admit("ultr_x").admitted)
+                    admitted += 1
+                shed = admission_control.admit("free_x")
+                self.assertFalse(shed.admitted)
+                self.assertGreater(shed.retry_after, 0)
+                self.assertTrue(admission_control.admit("prem_x").admitted)
+                admitted += 1
+                self.assertTrue(admission_control.admit("ultr_x").admitted)
+                admitted += 1
+                self.assertFalse(admission_control.admit("prem_x").admitted)
+                self.assertTrue(admission_control.admit("ultr_x").admitted)
+                admitted += 1
+                self.assertGreaterEqual(admission_control.get_metrics()["shed"]["premium"], 1)
+            finally:
+                for _ in range(admitted):
+                    admission_control.release()
+
+    def test_auth_circuit_breaker_serves_last_known_good(self):
+        """TC-PERF-009: MySQL lỗi → breaker mở, key đã biết dùng last-known-good, key lạ fail fast"""
+        import pymysql
+        from collections import OrderedDict
+        from services import api_key_service
+        from services.api_key_service import APIKeyInfo, AuthServiceUnavailable
+
+        info = APIKeyInfo(
+            id=1, key_prefix="free_abc", tier="free", owner_email="a@example.com",
+            active=True, expired=False, rate_limit="10 per minute",
+        )
+        with patch.object(api_key_service, "_auth_breaker", None), \
+                patch.object(api_key_service, "_last_known_good", OrderedDict()), \
+                patch.dict(os.environ, {"AUTH_BREAKER_FAILURE_THRESHOLD": "2"}), \
+                patch.object(api_key_service, "_query_key_info", return_value=info) as query:
+            self.assertEqual(api_key_service.get_key_info("free_known").id, 1)
+
+            query.side_effect = pymysql.err.OperationalError(2003, "Can't connect")
+            for _ in range(2):
+                self.assertEqual(api_key_service.get_key_info("free_known").id, 1)
+            self.assertEqual(api_key_service.get_auth_status()["state"], "open")
+
+            # Breaker mở: không chạm DB nữa
+            calls = query.call_count
+            self.assertTrue(api_key_service.validate_api_key("free_known")[0])
+            with self.assertRaises(AuthServiceUnavailable):
+                api_key_service.validate_api_key("free_unknown")
+            self.assertEqual(query.call_count, calls)
+
+    def test_request_deadline_bounds_db_timeouts(self):
+        """TC-PERF-010: Deadline của request giới hạn timeout DB, hết deadline → DeadlineExceeded"""
+        from services import deadline
+
+        self.assertIsNone(deadline.remaining())  # Ngoài request: không có deadline
+        self.assertEqual(deadline.db_timeouts()["connect_timeout"], 5.0)
+
+        with self.app.test_request_context("/v1/cccd/parse", method="POST"):
+            # Client chỉ được rút ngắn, không kéo dài timeout của endpoint
+            self.assertEqual(deadline.start("cccd.cccd_parse", "60"), 5.0)
+            self.assertEqual(deadline.start("cccd.cccd_parse", "50ms"), 0.05)
+            timeouts = deadline.db_timeouts()
+            self.assertLessEqual(timeouts["read_timeout"], 0.05)
+            time.sleep(0.06)
+            with self.assertRaises(deadline.DeadlineExceeded):
+                deadline.db_timeouts()
+
+    def test_deadline_exceeded_not_swallowed(self):
+        """TC-PERF-039: DeadlineExceeded (BaseException) đi qua except Exception của service/route, app trả 504"""
+        from services import deadline
+        from services import billing_service, user_service
+        with patch.object(user_service, "_get_db_connection", side_effect=deadline.DeadlineExceeded("late")):
+            with self.assertRaises(deadline.DeadlineExceeded):
+                user_service.authenticate_user("a@example.com", "secret")
+        with patch.object(billing_service, "_get_db_connection", side_effect=deadline.DeadlineExceeded("late")):
+            with self.assertRaises(deadline.DeadlineExceeded):
+                billing_service.reject_payment(1)
+
+        # Ghi log request trong routes/cccd.py không nuốt deadline
+        from types import SimpleNamespace
+        from routes import cccd
+        from services import logging_service
+        with self.app.test_request_context("/v1/cccd/parse", method="POST"), \
+                patch.dict(self.app.config, {"SETTINGS": SimpleNamespace(api_key_mode="tiered")}), \
+                patch.object(cccd.current_app.logger, "warning") as warning, \
+                patch("services.admin_stats.record_response"), \
+                patch.object(logging_service, "log_request_to_database", side_effect=deadline.DeadlineExceeded("late")):
+            with self.assertRaises(deadline.DeadlineExceeded):
+                cccd._log_to_database_if_enabled("req-1")
+            warning.assert_not_called()
+
+        # Route có except Exception → redirect vẫn trả 504
+        from routes import portal
+        client = self.app.test_client()
+        with client.session_transaction() as sess:
+            sess["user_id"] = 7
+        with patch.object(portal, "_current_user_and_subscription", side_effect=deadline.DeadlineExceeded("late")):
+            resp = client.get("/portal/dashboard")
+        self.assertEqual(resp.status_code, 504)
+        self.assertFalse(resp.get_json()["success"])
+        self.assertEqual(resp.headers["X-Content-Type-Options"], "nosniff")
+
+    def test_signed_api_key_verified_without_db(self):
+        """TC-PERF-011: Signed key verify bằng HMAC, key bị revoke quay về DB"""
+        from datetime import datetime, timedelta
+        from services import api_key_service, signed_keys
+
+        with patch.dict(os.environ, {"API_KEY_SIGNING_SECRET": "test-secret"}), \
+                patch.object(signed_keys, "_revoked_ids", set()), \
+                patch.dict(signed_keys._revocation_state, {"last_id": 0, "refreshed_at": 0.0, "next_refresh_at": 0.0}), \
+                patch.object(signed_keys.schema_registry, "has_table", return_value=True), \
+                patch.object(signed_keys, "_refresh_revocations",
+                             side_effect=lambda: signed_keys._revocation_state.update(refreshed_at=time.monotonic())), \
+                patch.object(api_key_service, "_auth_breaker", None), \
+                patch.object(api_key_service, "_query_key_info", return_value=None) as query:
+            api_key = signed_keys.issue("prem", 1234, datetime.now() + timedelta(days=30))
+            self.assertTrue(api_key.startswith("prem_"))
+
+            is_valid, _, info = api_key_service.validate_api_key(api_key)
+            self.assertTrue(is_valid)
+            self.assertEqual((info.id, info.tier, info.key_prefix), (1234, "premium", api_key[:12]))
+            query.assert_not_called()
+
+            # Chữ ký sai / token hết hạn → không dùng fast path
+            self.assertIsNone(signed_keys.verify(api_key.replace(".1234.", ".1235.")))
+            expired_key = signed_keys.issue("free", 7, datetime.now() - timedelta(days=1))
+            self.assertFalse(api_key_service.validate_api_key(expired_key)[0])
+
+            # Bị revoke → validate qua DB (DB: key không tồn tại)
+            signed_keys._revoked_ids.add(1234)
+            self.assertFalse(api_key_service.validate_api_key(api_key)[0])
+            self.assertEqual(query.call_count, 2)
+
+    def test_key_snapshot_delta_sync(self):
+        """TC-PERF-012: Key snapshot load toàn bộ key active, delta sync thêm/bỏ key theo updated_at"""
+        import hashlib
+        from datetime import datetime
+        from services import key_snapshot
+
+        def key_row(key_id, api_key, active=True, updated_at=datetime(2026, 1, 1)):
+            return {"id": key_id, "key_hash": hashlib.sha256(api_key.encode()).hexdigest(),
+                    "tier": "premium", "active": active, "expires_at": None, "updated_at": updated_at}
+
+        results = []
+        conn, cursor = mock_db_connection()
+        cursor.fetchall.side_effect = lambda: results.pop(0)
+
+        with patch.object(key_snapshot, "_snapshot", None), \
+                patch.dict(key_snapshot._state, {"watermark": None, "thread_pid": os.getpid()}), \
+                patch.object(key_snapshot.schema_registry, "has_table", return_value=False), \
+                patch.object(key_snapshot, "_get_db_connection", return_value=conn):
+            results.append([key_row(1, "prem_aaa"), key_row(2, "prem_bbb")])
+            self.assertEqual(key_snapshot.load_full(), 2)
+            self.assertTrue(key_snapshot.is_ready())
+            self.assertEqual(key_snapshot.lookup(hashlib.sha256(b"prem_aaa").hexdigest())[:2], (1, "premium"))
+
+            # Key 1 bị vô hiệu hóa, key 3 mới tạo
+            results.append([key_row(1, "prem_aaa", active=False, updated_at=datetime(2026, 1, 2)),
+                             key_row(3, "prem_ccc", updated_at=datetime(2026, 1, 2))])
+            self.assertEqual(key_snapshot.sync_delta(), 2)
+            self.assertIsNone(key_snapshot.lookup(hashlib.sha256(b"prem_aaa").hexdigest()))
+            self.assertEqual(key_snapshot.lookup(hashlib.sha256(b"prem_ccc").hexdigest())[0], 3)
+            self.assertEqual(key_snapshot._state["watermark"], (datetime(2026, 1, 2), 3))
+
+            # Cả trang delta áp dụng 1 lần: vẫn sắp xếp theo hash, không trùng key
+            results.append([key_row(i, f"prem_{i}", updated_at=datetime(2026, 1, 3)) for i in range(10, 60)]
+                           + [key_row(2, "prem_bbb", updated_at=datetime(2026, 1, 3))])
+            key_snapshot.sync_delta()
+            snapshot = key_snapshot._snapshot
+            self.assertEqual(len(snapshot), 52)
+            self.assertEqual(list(snapshot.hi), sorted(snapshot.hi))
+            self.assertEqual(key_snapshot.lookup(hashlib.sha256(b"prem_42").hexdigest())[0], 42)
+            key_snapshot.remove_ids([42, 3])
+            self.assertEqual(len(key_snapshot._snapshot), 50)
+            self.assertIsNone(key_snapshot.lookup(hashlib.sha256(b"prem_42").hexdigest()))
+
+    def test_change_log_evicts_worker_caches(self):
+        """TC-PERF-013: Worker poll change-log theo id và evict cache cục bộ (last-known-good, province)"""
+        from services import api_key_service, change_log, province_mapping
+
+        info = api_key_service.APIKeyInfo(
+            id=42, key_prefix="prem_abc", tier="premium", owner_email="", active=True, expired=False,
+            rate_limit="100 per minute",
+        )
+        results = [[{"id": 11, "scope": "api_key", "entity_id": "42"},
+                    {"id": 12, "scope": "province", "entity_id": None}]]
+        conn, cursor = mock_db_connection()
+        cursor.fetchall.side_effect = lambda: results.pop(0)
+        province_handler = MagicMock()
+
+        with patch.dict(change_log._state, {"last_id": 10}), \
+                patch.dict(change_log._subscribers, {"province": [province_handler]}), \
+                patch.object(change_log, "_get_db_connection", return_value=conn):
+            api_key_service._lkg_put("hash-42", info)
+            self.assertEqual(change_log.poll(), 2)
+            self.assertIsNone(api_key_service._lkg_get("hash-42"))
+            province_handler.assert_called_once_with([None])
+            self.assertEqual(change_log._state["last_id"], 12)
+
+    def test_change_log_evicts_deleted_keys_from_snapshot(self):
+        """TC-PERF-029: Key bị DELETE ở worker khác: delta sync không thấy → change-log handler tra lại id và loại khỏi snapshot"""
+        import hashlib
+        from services import change_log, key_snapshot
+
+        snapshot = key_snapshot._Arrays()
+        for key_id in (5, 6):
+            hi, lo = key_snapshot._split_hash(hashlib.sha256(f"prem_{key_id}".encode()).hexdigest())
+            snapshot = snapshot.rebuilt(set(), [(hi, lo, key_id, 0, 1)])
+        conn, cursor = mock_db_connection()
+        cursor.fetchall.return_value = [{"id": 6}]
+        with patch.object(key_snapshot, "_snapshot", snapshot), \
+                patch.object(key_snapshot, "_get_db_connection", return_value=conn):
+            change_log.dispatch("api_key", ["5", "6"])
+            self.assertEqual(list(key_snapshot._snapshot.ids), [6])
+
+    def test_change_log_subscription_invalidates_user_context(self):
+        """TC-PERF-030: Subscription đổi ở worker khác (change-log) → user context cache trong session bị bỏ qua"""
+        from services import change_log, user_context
+
+        context = {"user": {"id": 7}, "subscription": None, "api_key_count": 0}
+        with patch.dict(os.environ, {"USER_CONTEXT_SESSION_TTL_SECONDS": "60"}), \
+                patch.dict(user_context._changed_at, clear=True), \
+                patch.object(user_context, "load_user_context", return_value=context) as load, \
+                self.app.app_context(), self.app.test_request_context("/portal/dashboard"):
+            from flask import session
+            session["user_id"] = 7
+            session[user_context._SESSION_KEY] = {"user_id": 7, "loaded_at": time.time() - 5, "context": context}
+            change_log.dispatch("subscription", ["7"])
+            self.assertEqual(user_context.get_user_context(), context)
+            load.assert_called_once_with(7)
+
+    def test_admin_tarpit_does_not_sleep(self):
+        """TC-PERF-014: Admin key sai → tarpit bằng 429 + Retry-After trước khi so key, không sleep trong request thread"""
+        from services import admin_security
+
+        with patch.dict(admin_security._tracked_ips, clear=True), \
+                patch.dict(admin_security._blocked_ips, clear=True), \
+                patch.dict(admin_security._tarpitted_ips, clear=True), \
+                patch("time.sleep") as sleep:
+            first = self.client.get("/admin/stats", headers={"X-Admin-Key": "wrong"})
+            self.assertIn(first.status_code, [302, 403])
+            self.assertEqual(first.headers.get("Retry-After"), "1")
+            second = self.client.get("/admin/stats", headers={"X-Admin-Key": "wrong"})
+            self.assertEqual(second.status_code, 429)
+            self.assertEqual(second.headers.get("Retry-After"), "1")
+            # Trong thời gian tarpit key đúng cũng phải chờ (không dùng được để dò key nhanh hơn)
+            third = self.client.get("/admin/stats", headers={"X-Admin-Key": os.environ["ADMIN_SECRET"]})
+            self.assertEqual(third.status_code, 429)
+            sleep.assert_not_called()
+
+            # Trần số IP bị tarpit: đầy → bỏ IP thử sai lâu nhất; IP chưa từng thử sai không bao giờ phải chờ
+            admin_security._tarpitted_ips.clear()
+            with patch.object(admin_security, "MAX_TARPITTED_IPS", 3):
+                for i in range(5):
+                    admin_security.start_tarpit(f"10.0.0.{i}", 1)
+                self.assertEqual(list(admin_security._tarpitted_ips), ["10.0.0.2", "10.0.0.3", "10.0.0.4"])
+                self.assertEqual(admin_security.get_tarpit_remaining("10.9.9.9"), 0.0)
+                self.assertGreater(admin_security.get_tarpit_remaining("10.0.0.4"), 0)
+
+                # Tarpit đã hết hạn nằm sau tarpit dài hơn vẫn được dọn khi bảng đầy
+                admin_security._tarpitted_ips.clear()
+                admin_security._tarpitted_ips.update({"a": time.time() + 60, "b": time.time() - 1, "c": time.time() + 60})
+                admin_security.start_tarpit("d", 1)
+                self.assertEqual(list(admin_security._tarpitted_ips), ["a", "c", "d"])
+
+    def test_admin_security_tracking_is_bounded(self):
+        """TC-PERF-015: Scan từ nhiều IP không làm phình bộ nhớ; IP vượt limit vẫn bị block"""
+        from services import admin_security
+
+        with patch.object(admin_security, "_tracked_ips", admin_security.OrderedDict()), \
+                patch.object(admin_security, "_blocked_ips", admin_security.OrderedDict()), \
+                patch.object(admin_security, "_total_window", admin_security._SlidingWindow()), \
+                patch.object(admin_security, "MAX_TRACKED_IPS", 100):
+            for i in range(1000):
+                admin_security.record_failed_attempt(f"10.0.{i // 256}.{i % 256}", "admin.get_stats")
+            for _ in range(admin_security.MAX_FAILED_ATTEMPTS):
+                admin_security.record_failed_attempt("203.0.113.9", "admin.get_stats")
+
+            self.assertEqual(len(admin_security._tracked_ips), 100)
+            self.assertEqual(len(admin_security._tracked_ips["10.0.3.231"].window.counts), admin_security.WINDOW_BUCKETS)
+            self.assertTrue(admin_security.is_ip_blocked("203.0.113.9")[0])
+            self.assertFalse(admin_security.is_ip_blocked("10.0.3.231")[0])
+            stats = admin_security.get_security_stats()
+            self.assertEqual(stats["total_failed_attempts"], 1000 + admin_security.MAX_FAILED_ATTEMPTS)
+            self.assertEqual(stats["unique_ips_with_failures"], 100)
+
+    def test_admin_security_shared_storage(self):
+        """TC-PERF-016: Block ghi vào storage dùng chung được worker khác thấy; stats là góc nhìn toàn cục"""
+        from services import admin_security
+        from services.admin_security_storage import ShmSecurityStorage
+        from services.shared_memory import SharedMemoryTable
+
+        with patch("services.shared_memory.get_table", return_value=SharedMemoryTable(None, slots=1024, stripes=8)):
+            storage = ShmSecurityStorage(60, 12, 300, admin_security.MAX_FAILED_ATTEMPTS)
+
+        def fresh_worker():
+            return patch.multiple(
+                admin_security,
+                _tracked_ips=admin_security.OrderedDict(),
+                _blocked_ips=admin_security.OrderedDict(),
+                _total_window=admin_security._SlidingWindow(),
+                _storage=storage,
+                _storage_loaded=True,
+            )
+
+        # Mỗi "worker" chỉ thấy 1-2 lần thử sai cục bộ
+        for attempts in (2, 2, 1):
+            with fresh_worker():
+                for _ in range(attempts):
+                    admin_security.record_failed_attempt("198.51.100.7", "admin.get_stats")
+
+        with fresh_worker():
+            self.assertTrue(admin_security.is_ip_blocked("198.51.100.7")[0])
+            self.assertEqual(admin_security.get_failed_attempts_count("198.51.100.7"), 5)
+            stats = admin_security.get_security_stats()
+            self.assertEqual(
+                (stats["storage"], stats["blocked_ips_count"], stats["total_failed_attempts"]),
+                ("shm", 1, 5),
+            )
+
+    def test_admin_security_mysql_storage_batches(self):
+        """TC-PERF-031: MySQL storage: request không mở connection, flush merge count toàn cục, batch lỗi được giữ lại"""
+        from services import admin_security
+        from services.admin_security_storage import MySQLSecurityStorage
+
+        mysql_storage = MySQLSecurityStorage(60, 12, 300, admin_security.MAX_FAILED_ATTEMPTS)
+        conn, cursor = mock_db_connection()
+        cursor.fetchall.side_effect = [[{"ip": "203.0.113.1", "attempts": 3}], [{"ip": "203.0.113.2", "attempts": 2}]]
+        now = time.time()
+        for ip in ("203.0.113.1", "203.0.113.2"):
+            mysql_storage._pending_failures[(ip, mysql_storage._bucket_start(now))] += 1
+            mysql_storage._flush(conn, now)
+        self.assertEqual(mysql_storage.failure_count("203.0.113.1", now), 3)
+        self.assertEqual(mysql_storage.failure_count("203.0.113.2", now), 2)
+        self.assertEqual(mysql_storage.failure_count("203.0.113.1", now + 61), 0)  # hết window
+
+        # Request thử sai chỉ ghi vào batch, thread nền mới mở connection
+        with patch.object(MySQLSecurityStorage, "_ensure_worker") as ensure_worker, \
+                patch.object(MySQLSecurityStorage, "_get_db_connection") as get_conn:
+            mysql_storage.record_failure("203.0.113.3", now)
+            mysql_storage.block("203.0.113.3", now + 300)
+            self.assertIsNone(mysql_storage.blocked_until("203.0.113.4", now))
+            get_conn.assert_not_called()
+            ensure_worker.assert_called()
+
+        # INSERT lỗi → batch quay lại hàng chờ, không mất
+        cursor.executemany.side_effect = OSError("mysql down")
+        with self.assertRaises(OSError):
+            mysql_storage._flush(conn, now)
+        self.assertEqual(sum(mysql_storage._pending_failures.values()), 1)
+        self.assertEqual(mysql_storage._pending_blocks, {"203.0.113.3": now + 300})
+
+    def test_password_hashing_pool_bounded(self):
+        """TC-PERF-017: bcrypt chạy trong process pool; hàng đợi đầy → PasswordHasherBusy ngay"""
+        from services import password_hasher
+
+        with patch.dict(os.environ, {"PASSWORD_HASH_WORKERS": "1", "PASSWORD_HASH_QUEUE_SIZE": "1"}), \
+                patch.multiple(password_hasher, _pool=None, _pool_pid=None, _slots=None):
+            try:
+                hashed = password_hasher.hash_password("s3cret!", rounds=4)
+                self.assertTrue(password_hasher.verify_password("s3cret!", hashed))
+                self.assertFalse(password_hasher.verify_password("wrong", hashed))
+                self.assertFalse(password_hasher.verify_password("s3cret!", "not-a-bcrypt-hash"))
+
+                # Slot duy nhất đang bận → từ chối ngay, không xếp hàng
+                password_hasher._slots.acquire()
+                with self.assertRaises(password_hasher.PasswordHasherBusy):
+                    password_hasher.verify_password("s3cret!", hashed)
+                password_hasher._slots.release()
+            finally:
+                if password_hasher._pool is not None:
+                    password_hasher._pool.shutdown()
+
+    def test_password_hashing_pool_recovers(self):
+        """TC-PERF-032: Password hash pool: fallback spawn, slot trả khi việc thật sự xong, pool hỏng được tạo lại"""
+        from concurrent.futures import Future
+        from concurrent.futures.process import BrokenProcessPool
+        from services import password_hasher
+
+        # Nền tảng không có forkserver → spawn
+        with patch.object(password_hasher.multiprocessing, "get_all_start_methods", return_value=["spawn"]):
+            self.assertEqual(password_hasher._start_method(), "spawn")
+
+        # Timeout: slot chỉ được trả khi việc trong pool thật sự xong
+        pending = Future()
+        pool = MagicMock()
+        pool.submit.return_value = pending
+        slots = password_hasher.threading.BoundedSemaphore(1)
+        with patch.dict(os.environ, {"PASSWORD_HASH_TIMEOUT_SECONDS": "0.01"}), \
+                patch.multiple(password_hasher, _pool=pool, _pool_pid=os.getpid(), _slots=slots):
+            pending.set_running_or_notify_cancel()  # đang chạy → cancel() không có tác dụng
+            with self.assertRaises(password_hasher.PasswordHasherBusy):
+                password_hasher.verify_password("s3cret!", "x")
+            self.assertFalse(slots.acquire(blocking=False))
+            pending.set_result(True)
+            self.assertTrue(slots.acquire(blocking=False))
+            slots.release()
+
+            # Pool hỏng (process con chết) → báo bận, bỏ pool để lần sau tạo lại
+            pool.submit.side_effect = BrokenProcessPool("child died")
+            with self.assertRaises(password_hasher.PasswordHasherBusy):
+                password_hasher.verify_password("s3cret!", "x")
+            self.assertIsNone(password_hasher._pool_pid)
+            pool.shutdown.assert_called_once()
+            self.assertTrue(slots.acquire(blocking=False))
+
+    def test_bcrypt_cost_rehash_on_login(self):
+        """TC-PERF-018: BCRYPT_ROUNDS cấu hình được; hash cũ khác cost được rehash khi login thành công"""
+        import bcrypt
+        from services import password_hasher, user_service
+
+        old_hash = bcrypt.hashpw(b"s3cret!", bcrypt.gensalt(rounds=4)).decode()
+        user = {"id": 7, "email": "a@example.com", "password_hash": old_hash, "full_name": "A", "status": "active"}
+        conn, cursor = mock_db_connection()
+        cursor.fetchone.return_value = user
+
+        with patch.dict(os.environ, {"PASSWORD_HASH_WORKERS": "0", "BCRYPT_ROUNDS": "5"}), \
+                patch.multiple(password_hasher, _pool=None, _pool_pid=None, _slots=None), \
+                patch.object(user_service.schema_registry, "has_column", return_value=False), \
+                patch.object(user_service, "_get_db_connection", return_value=conn):
+            self.assertTrue(password_hasher.needs_rehash(old_hash))
+            success, _, _ = user_service.authenticate_user("a@example.com", "s3cret!")
+            self.assertTrue(success)
+
+            update = [c for c in cursor.execute.call_args_list if "SET password_hash" in c.args[0]]
+            self.assertEqual(len(update), 1)
+            new_hash = update[0].args[1][0]
+            self.assertEqual(password_hasher.hash_rounds(new_hash), 5)
+            self.assertTrue(bcrypt.checkpw(b"s3cret!", new_hash.encode()))
+            self.assertIn(password_hasher.calibrate(target_ms=5, max_rounds=6)["rounds"], range(4, 7))
+
+    def test_portal_user_context_single_query(self):
+        """TC-PERF-019: Trang portal load user + subscription + số key bằng 1 query, memoize trong request/session"""
+        from datetime import datetime
+        from flask import session
+        from services import user_context
+
+        expires = datetime(2030, 1, 2, 3, 4, 5)
+        row = {
+            "id": 7, "email": "a@example.com", "full_name": "A", "status": "active",
+            "created_at": datetime(2024, 1, 1), "sub_tier": "premium", "sub_expires_at": expires, "api_key_count": 3,
+        }
+        conn, cursor = mock_db_connection()
+        cursor.fetchone.return_value = row
+
+        with patch.object(user_context.schema_registry, "has_column", return_value=False), \
+                patch.object(user_context, "_get_db_connection", return_value=conn) as connect:
+            with patch.dict(os.environ, {"USER_CONTEXT_SESSION_TTL_SECONDS": "0"}), \
+                    self.app.app_context(), self.app.test_request_context("/portal/dashboard"):
+                session["user_id"] = 7
+                context = user_context.get_user_context()
+                self.assertIs(user_context.get_user_context(), context)
+                self.assertEqual(context["subscription"], {"tier": "premium", "expires_at": expires, "status": "active"})
+                self.assertEqual(context["api_key_count"], 3)
+                self.assertFalse(context["user"]["email_verified"])
+            self.assertEqual(connect.call_count, 1)
+            self.assertEqual(cursor.execute.call_count, 1)
+
+            with patch.dict(os.environ, {"USER_CONTEXT_SESSION_TTL_SECONDS": "30"}):
+                with self.app.app_context(), self.app.test_request_context("/portal/usage"):
+                    session["user_id"] = 7
+                    user_context.get_user_context()
+                    cached = dict(session)
+                with self.app.app_context(), self.app.test_request_context("/portal/billing"):
+                    session.update(cached)
+                    context = user_context.get_user_context()
+                    self.assertEqual(context["subscription"]["expires_at"], expires)
+                    user_context.invalidate_user_context()
+                    self.assertNotIn("_user_ctx", session)
+            self.assertEqual(connect.call_count, 2)
+
+    def test_dashboard_renders_api_key_count(self):
+        """TC-PERF-038: Dashboard hiển thị số API key đang hoạt động lấy từ user context"""
+        from datetime import datetime
+        from services import user_context
+
+        context = {
+            "user": {"id": 7, "email": "a@example.com", "full_name": "A", "status": "active",
+                     "created_at": datetime(2024, 1, 1), "email_verified": True},
+            "subscription": {"tier": "premium", "expires_at": None, "status": "active"},
+            "api_key_count": 3,
+        }
+        client = self.app.test_client()
+        with client.session_transaction() as sess:
+            sess["user_id"] = 7
+        with patch.object(user_context, "load_user_context", return_value=context), \
+                patch.dict(os.environ, {"USER_CONTEXT_SESSION_TTL_SECONDS": "0"}):
+            resp = client.get("/portal/dashboard")
+        self.assertEqual(resp.status_code, 200)
+        html = resp.get_data(as_text=True)
+        self.assertIn("API keys đang hoạt động", html)
+        self.assertRegex(html, r">\s*3\s*</p>")
+
+    def test_fan_out_runs_queries_concurrently(self):
+        """TC-PERF-020: fan_out.gather chạy query độc lập song song, giữ thứ tự kết quả và deadline của request"""
+        import time as _time
+        from flask import g
+        from services import deadline, fan_out
+
+        def slow(value):
+            _time.sleep(0.2)
+            return value, deadline.remaining() is not None
+
+        with patch.dict(os.environ, {"FAN_OUT_WORKERS": "4"}), \
+                patch.multiple(fan_out, _pool=None, _pool_pid=None, _slots=None):
+            with self.app.app_context(), self.app.test_request_context("/portal/usage"):
+                g.deadline = _time.monotonic() + 10
+                started = _time.monotonic()
+                results = fan_out.gather(lambda: slow("a"), lambda: slow("b"), lambda: slow("c"))
+                elapsed = _time.monotonic() - started
+            self.assertEqual(results, [("a", True), ("b", True), ("c", True)])
+            self.assertLess(elapsed, 0.5)
+
+            def fail():
+                raise ValueError("boom")
+            with self.assertRaises(ValueError):
+                fan_out.gather(lambda: 1, fail)
+            fan_out._pool.shutdown()
+
+    def test_fan_out_carries_session_last_write(self):
+        """TC-PERF-036: Thread của fan_out mang theo db_last_write_at của session → read-your-writes vẫn đi primary"""
+        import threading
+        import time as _time
+        from flask import session
+        from services import db_router, fan_out
+
+        with patch.dict(os.environ, {"FAN_OUT_WORKERS": "2"}), \
+                patch.multiple(fan_out, _pool=None, _pool_pid=None, _slots=None):
+            with self.app.app_context(), self.app.test_request_context("/portal/usage"):
+                self.assertEqual(fan_out.gather(lambda: 0, lambda: db_router._recently_written(None)), [0, False])
+                session["db_last_write_at"] = _time.time()
+                results = fan_out.gather(
+                    lambda: db_router._recently_written(None),
+                    lambda: (db_router._recently_written(None), threading.current_thread().name),
+                )
+            self.assertTrue(results[0])
+            self.assertEqual(results[1][0], True)
+            self.assertTrue(results[1][1].startswith("fan-out"))
+            fan_out._pool.shutdown()
+        self.assertIsNone(db_router.session_last_write())
+
+    def test_portal_usage_checks_user_before_aggregates(self):
+        """TC-PERF-037: /portal/usage kiểm tra user trước; session hết hạn → redirect, không chạy aggregate"""
+        from routes import portal
+        from services import usage_service
+
+        client = self.app.test_client()
+        with client.session_transaction() as sess:
+            sess["user_id"] = 999999
+        with patch.object(portal, "_current_user_and_subscription", return_value=(None, None)), \
+                patch.object(usage_service, "get_user_usage_stats") as stats, \
+                patch.object(usage_service, "get_usage_stats_by_key") as stats_by_key:
+            resp = client.get("/portal/usage", follow_redirects=False)
+        self.assertEqual(resp.status_code, 302)
+        stats.assert_not_called()
+        stats_by_key.assert_not_called()
+
+    def test_admin_status_separate_from_admission(self):
+        """TC-PERF-043: /admin/admission chỉ trả metrics load shedding; trạng thái thành phần nền ở /admin/status"""
+        from services import change_log, email_outbox, expiry_sweeper
+        from services import api_key_service
+
+        headers = {"X-Admin-Key": self.admin_key}
+        with patch.dict(os.environ, {"ADMIN_SECRET": self.admin_key}):
+            admission = self.client.get("/admin/admission", headers=headers)
+            with patch.object(api_key_service, "get_auth_status", return_value={"state": "closed"}), \
+                    patch.object(change_log, "get_status", return_value={"running": True}), \
+                    patch.object(email_outbox, "get_status", return_value={"running": True}), \
+                    patch.object(expiry_sweeper, "get_status", return_value={"running": False}):
+                status = self.client.get("/admin/status", headers=headers)
+        self.assertEqual(admission.status_code, 200)
+        self.assertEqual(set(admission.get_json()), {"success", "admission"})
+        self.assertEqual(status.status_code, 200)
+        self.assertEqual(status.get_json(), {
+            "success": True,
+            "auth_breaker": {"state": "closed"},
+            "change_log": {"running": True},
+            "email_outbox": {"running": True},
+            "expiry_sweeper": {"running": False},
+        })
+
+    def test_admin_users_keyset_pagination(self):
+        """TC-PERF-021: /admin/users phân trang keyset theo id (không OFFSET), search prefix, total count được cache"""
+        from services import user_service
+
+        users = [{"id": i, "email": f"u{i}@example.com", "full_name": f"U{i}", "status": "active"} for i in (9, 8, 7)]
+        conn, cursor = mock_db_connection()
+        cursor.fetchone.return_value = {"total": 3}
+        cursor.fetchall.side_effect = [users, [], users[2:], []]
+
+        with patch.object(user_service.db_router, "get_read_connection", return_value=conn), \
+                patch.object(user_service.schema_registry, "has_column", return_value=False), \
+                patch.object(user_service.schema_registry, "has_fulltext_index", return_value=False), \
+                patch.dict(user_service._users_count_cache, clear=True):
+            first = user_service.get_users_list(per_page=2, search="u_")
+            self.assertEqual([u["id"] for u in first["users"]], [9, 8])
+            self.assertEqual(user_service.decode_users_cursor(first["next_cursor"]), 8)
+            second = user_service.get_users_list(cursor=first["next_cursor"], per_page=2, search="u_")
+            self.assertEqual([u["id"] for u in second["users"]], [7])
+            self.assertIsNone(second["next_cursor"])
+
+            sql = [c.args for c in cursor.execute.call_args_list]
+            self.assertFalse(any("OFFSET" in q for q, *_ in sql))
+            self.assertFalse(any("LIKE %s" in q and "%u" in str(p) for q, *p in sql))
+            self.assertEqual(sum("COUNT(*)" in q for q, *_ in sql), 1)
+            page_query, params = sql[-2]
+            self.assertIn("id < %s", page_query)
+            self.assertEqual(params, ["u\\_%", "u\\_%", 8, 3])
+
+        with self.assertRaises(user_service.InvalidCursor):
+            user_service.decode_users_cursor("not-a-cursor")
+        resp = self.client.get("/admin/users?cursor=%%%", headers={"X-Admin-Key": self.admin_key})
+        self.assertEqual(resp.status_code, 400)
+
+    def test_admin_stats_materialized_counters(self):
+        """TC-PERF-022: /admin/stats đọc counter đã materialize, cache theo TTL; request/lỗi gom theo phút và flush theo batch"""
+        from services import admin_stats
+
+        cursor = MagicMock()
+        cursor.fetchall.return_value = [{"tier": "free", "total": 2, "active": 1}]
+        with patch.object(admin_stats.schema_registry, "has_table", return_value=True):
+            admin_stats.record_keys_removed(cursor, "user_id = %s", (7,), deleting=True)
+            admin_stats.record_key_created(cursor, "premium")
+        deltas = [c.args[1] for c in cursor.execute.call_args_list if "api_key_tier_counters" in c.args[0]]
+        self.assertEqual(deltas, [("free", -2, -1), ("premium", 1, 1)])
+
+        flush_conn, flush_cursor = mock_db_connection()
+        with patch.object(admin_stats.schema_registry, "has_table", return_value=True), \
+                patch.object(admin_stats.db_router, "get_primary_connection", return_value=flush_conn), \
+                patch.object(admin_stats, "start"), \
+                patch.dict(admin_stats._state, {"pruned_at": float("inf")}), \
+                patch.object(admin_stats, "_pending", admin_stats.Counter()):
+            for status in (200, 200, 400, 503):
+                admin_stats.record_response(status)
+            admin_stats.record_request()
+            self.assertEqual(admin_stats.flush(), 1)
+            rows = flush_cursor.executemany.call_args.args[1]
+            self.assertEqual([r[1:] for r in rows], [(1, 4, 2)])
+
+        read_conn, read_cursor = mock_db_connection()
+        read_cursor.fetchall.side_effect = [[{"tier": "free", "total_keys": 5, "active_keys": 4}], []]
+        read_cursor.fetchone.return_value = {"total": 42}
+        with patch.object(admin_stats.schema_registry, "has_table", return_value=True), \
+                patch.object(admin_stats.db_router, "get_read_connection", return_value=read_conn) as connect, \
+                patch.dict(admin_stats._cache, {"expires_at": 0.0, "value": None}), \
+                patch.dict(os.environ, {"ADMIN_STATS_SERIES_MINUTES": "5"}):
+            overview = admin_stats.get_overview()
+            self.assertIs(admin_stats.get_overview(), overview)
+            self.assertEqual(connect.call_count, 1)
+        self.assertEqual(overview["tiers"], {"free": {"total": 5, "active": 4}})
+        self.assertEqual(overview["requests_today"], 42)
+        self.assertEqual(len(overview["series"]), 5)
+        self.assertEqual(overview["error_rate"], 0.0)
+
+    def test_email_outbox_queue_and_batch_drain(self):
+        """TC-PERF-023: Email vào outbox thay vì gửi SMTP trong request; worker gửi batch qua 1 session, lỗi thì retry có backoff"""
+        from services import email_outbox, email_service
+
+        conn, cursor = mock_db_connection()
+        with patch.object(email_outbox.schema_registry, "has_table", return_value=True), \
+                patch.object(email_outbox.db_router, "get_primary_connection", return_value=conn), \
+                patch.object(email_outbox, "start"), \
+                patch("smtplib.SMTP") as smtp:
+            self.assertTrue(email_service.send_email("a@example.com", "Hi", "<b>hello</b>"))
+            smtp.assert_not_called()
+        self.assertIn("INSERT INTO email_outbox", cursor.execute.call_args.args[0])
+
+        rows = [
+            {"id": 1, "to_email": "a@example.com", "subject": "s", "html_content": "h", "text_content": None, "attempts": 0},
+            {"id": 2, "to_email": "b@example.com", "subject": "s", "html_content": "h", "text_content": None, "attempts": 2},
+            {"id": 3, "to_email": "c@example.com", "subject": "s", "html_content": "h", "text_content": None, "attempts": 0},
+        ]
+        conn, cursor = mock_db_connection()
+        cursor.rowcount = 3
+        cursor.fetchall.return_value = rows
+        session = MagicMock()
+        session.send.side_effect = [None, OSError("smtp down"), None]
+        with patch.object(email_outbox.db_router, "get_primary_connection", return_value=conn), \
+                patch.dict(os.environ, {"EMAIL_OUTBOX_BATCH_SIZE": "10", "EMAIL_OUTBOX_RETRY_BASE_SECONDS": "30"}):
+            self.assertEqual(email_outbox.drain(session), 2)
+        self.assertEqual(session.send.call_count, 3)
+        retry = next(c.args[1] for c in cursor.execute.call_args_list if "last_error" in c.args[0])
+        self.assertEqual((retry[0], retry[1], retry[3], retry[4]), ("pending", 3, 120, 2))
+        sent = next(c.args[1] for c in cursor.execute.call_args_list if "status = 'sent'" in c.args[0])
+        self.assertEqual(list(sent), [1, 3])
+
+    def test_email_outbox_prunes_sent_rows(self):
+        """TC-PERF-033: Worker outbox tự xóa email đã gửi quá EMAIL_OUTBOX_RETENTION_DAYS, tối đa mỗi giờ một lần"""
+        from services import email_outbox
+
+        with patch.object(email_outbox, "prune", return_value=0) as prune, \
+                patch.object(email_outbox.schema_registry, "has_table", return_value=True), \
+                patch.dict(email_outbox._state, {"pruned_at": None}), \
+                patch.dict(os.environ, {"EMAIL_OUTBOX_RETENTION_DAYS": "14"}):
+            email_outbox._prune_if_due()
+            email_outbox._prune_if_due()
+        prune.assert_called_once_with(14.0)
+
+    def test_key_expiry_warnings_grouped_and_idempotent(self):
+        """TC-PERF-024: Job cảnh báo key hết hạn: 1 query, gom theo người nhận, 1 SMTP session, marker chống gửi trùng"""
+        from datetime import datetime, timedelta
+        from services import key_expiry_warnings
+
+        now = datetime(2030, 1, 1, 12, 0)
+
+        def key(key_id, days, email, notified=None, owner="x"):
+            return {
+                "id": key_id, "key_prefix": f"free_{key_id}", "tier": "free", "expires_at": now + timedelta(days=days, hours=-1),
+                "owner_email": owner, "user_email": email, "full_name": "A", "notified_window": notified,
+            }
+
+        rows = [
+            key(1, 2, "a@example.com"),
+            key(2, 6, "a@example.com"),
+            key(3, 1, "b@example.com", notified=1),   # đã báo ở mốc 1 ngày
+            key(4, 3, "b@example.com", notified=7),   # đã báo mốc 7 → giờ tới mốc 3
+            key(5, 2, None, owner="admin_test"),     # key test của admin
+        ]
+        conn, cursor = mock_db_connection()
+        cursor.fetchall.return_value = rows
+        session = MagicMock()
+        with patch.object(key_expiry_warnings.db_router, "get_primary_connection", return_value=conn), \
+                patch.dict(os.environ, {"KEY_EXPIRY_WARNING_DAYS": "7,3,1"}), \
+                self.app.test_request_context("/"):
+            result = key_expiry_warnings.run(session=session, now=now)
+
+        self.assertEqual(result, {"recipients": 2, "keys": 3, "failed": 0})
+        self.assertEqual(sum("FROM api_keys" in c.args[0] for c in cursor.execute.call_args_list), 1)
+        self.assertEqual(sorted(c.args[0] for c in session.send.call_args_list), ["a@example.com", "b@example.com"])
+        html = next(c.args[2] for c in session.send.call_args_list if c.args[0] == "a@example.com")
+        self.assertIn("free_1", html)
+        self.assertIn("free_2", html)
+        markers = [(m[0], m[2]) for c in cursor.executemany.call_args_list for m in c.args[1]]
+        self.assertEqual(sorted(markers), [(1, 3), (2, 7), (4, 3)])
+        # Marker gắn với expires_at đã cảnh báo; query chỉ tính marker của expires_at hiện tại
+        self.assertTrue(all(m[1] == rows[m[0] - 1]["expires_at"] for c in cursor.executemany.call_args_list for m in c.args[1]))
+        self.assertIn("n.expires_at = k.expires_at", cursor.execute.call_args_list[0].args[0])
+
+    def test_expiry_sweeper_chunked_and_single_runner(self):
+        """TC-PERF-025: Expiry sweeper: GET_LOCK 1 runner, UPDATE theo lô kèm change_log, hot path tin cờ active"""
+        from datetime import datetime, timedelta
+        from services import api_key_service, expiry_sweeper
+
+        conn, cursor = mock_db_connection()
+        cursor.fetchone.return_value = {"locked": 1}
+        cursor.fetchall.side_effect = [
+            [{"id": 1, "user_id": 10}, {"id": 2, "user_id": 11}],  # lô subscription đầy
+            [{"id": 3, "user_id": 10}],                           # lô cuối
+            [{"id": 7, "user_id": 10}],                           # key
+        ]
+        cursor.rowcount = 0
+        with patch.object(expiry_sweeper.db_router, "get_primary_connection", return_value=conn), \
+                patch.object(expiry_sweeper, "keys_enabled", return_value=True), \
+                patch.object(expiry_sweeper.admin_stats, "record_keys_removed") as removed, \
+                patch.object(expiry_sweeper.change_log, "publish") as publish, \
+                patch.object(expiry_sweeper.db_router, "mark_write"), \
+                patch.dict(os.environ, {"EXPIRY_SWEEPER_CHUNK_SIZE": "2"}):
+            expiry_sweeper.run_once()
+
+        sqls = [c.args[0] for c in cursor.execute.call_args_list]
+        self.assertEqual(sum("UPDATE subscriptions" in sql for sql in sqls), 2)
+        self.assertEqual(sum("UPDATE api_keys" in sql for sql in sqls), 1)
+        self.assertIn("RELEASE_LOCK", sqls[-1])
+        self.assertEqual([c.args[1:] for c in publish.call_args_list], [
+            ("subscription", [10, 11]), ("subscription", [10]), ("api_key", [7]),
+        ])
+        removed.assert_called_once()
+        self.assertEqual(conn.commit.call_count, 3)
+
+        # Process khác đang giữ lock → không quét
+        cursor.reset_mock()
+        cursor.fetchone.return_value = {"locked": 0}
+        with patch.object(expiry_sweeper.db_router, "get_primary_connection", return_value=conn):
+            self.assertIsNone(expiry_sweeper.run_once())
+        self.assertEqual(cursor.execute.call_count, 1)
+
+        past = datetime.now() - timedelta(days=1)
+        with patch.object(expiry_sweeper, "trust_active_flag", return_value=True):
+            self.assertFalse(api_key_service._is_expired(past))
+        with patch.object(expiry_sweeper, "trust_active_flag", return_value=False):
+            self.assertTrue(api_key_service._is_expired(past))
+
+    def test_manual_deactivate_clears_expired_at(self):
+        """TC-PERF-035: Vô hiệu hóa thủ công xóa expired_at → duyệt thanh toán không bật lại key"""
+        from services import api_key_service
+
+        conn, cursor = mock_db_connection()
+        cursor.rowcount = 1
+        cursor.fetchall.return_value = [{"id": 7}]
+        with patch.object(api_key_service, "_get_db_connection", return_value=conn), \
+                patch.object(api_key_service.schema_registry, "has_column", return_value=True), \
+                patch.object(api_key_service.admin_stats, "record_keys_removed"), \
+                patch.object(api_key_service.signed_keys, "record_revocations"), \
+                patch.object(api_key_service.change_log, "publish"):
+            self.assertTrue(api_key_service.deactivate_key("free_abc"))
+        update = next(c.args[0] for c in cursor.execute.call_args_list if "UPDATE api_keys" in c.args[0])
+        self.assertIn("expired_at = NULL", update)
+
+    def test_deactivate_key_by_prefix_shares_service_path(self):
+        """TC-PERF-034: Admin vô hiệu hóa key theo prefix qua api_key_service: revocation, change_log, quên LKG theo id"""
+        from services import api_key_service
+
+        conn, cursor = mock_db_connection()
+        cursor.rowcount = 1
+        cursor.fetchall.return_value = [{"id": 7}, {"id": 8}]
+        with patch.object(api_key_service, "_get_db_connection", return_value=conn), \
+                patch.object(api_key_service.schema_registry, "has_column", return_value=True), \
+                patch.object(api_key_service.admin_stats, "record_keys_removed") as removed, \
+                patch.object(api_key_service.signed_keys, "record_revocations") as revoked, \
+                patch.object(api_key_service.change_log, "publish") as publish, \
+                patch.object(api_key_service, "_lkg_forget") as forget:
+            self.assertTrue(api_key_service.deactivate_key_by_prefix("abcd1234"))
+
+        update = next(c for c in cursor.execute.call_args_list if "UPDATE api_keys" in c.args[0])
+        self.assertIn("WHERE key_prefix = %s", update.args[0])
+        self.assertEqual(update.args[1], ("abcd1234",))
+        removed.assert_called_once_with(cursor, "key_prefix = %s", ("abcd1234",), deleting=False)
+        revoked.assert_called_once_with(cursor, [7, 8], "deactivated")
+        publish.assert_called_once_with(cursor, "api_key", [7, 8])
+        self.assertEqual([c.kwargs for c in forget.call_args_list], [{"key_id": 7}, {"key_id": 8}])
+        conn.commit.assert_called_once()
+
+        # Route admin gọi đúng service; không có key → 404
+        with patch.object(api_key_service, "deactivate_key_by_prefix", return_value=False) as service:
+            resp = self.client.post("/admin/keys/abcd1234/deactivate", headers={"X-Admin-Key": self.admin_key})
+        service.assert_called_once_with("abcd1234")
+        self.assertEqual(resp.status_code, 404)
+
 
 def run_all_tests():
     """Run all comprehensive tests"""